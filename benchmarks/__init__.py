@@ -0,0 +1,9 @@
+"""
+Benchmarks of the Elo model and simulation hot paths.
+
+Run from the repository root with
+
+    python -m benchmarks.run --scale 1 10 100 --output bench.json
+
+and compare two runs with --compare, see benchmarks.run.
+"""
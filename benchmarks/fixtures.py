@@ -0,0 +1,80 @@
+"""
+Offline fixtures for the benchmarks.
+
+Every fixture is built from the season data files in nfl_model2/data
+without a database. Larger histories are made by repeating the seasons
+with later season years.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+from bson import ObjectId
+
+from nfl_model2.elo.elo_engine import GameArrays, replay
+from nfl_model2.models import Team, Game
+from nfl_model2.utils.ingest import DATA_DIR, iter_season_records, league_team_arrays, to_game_arrays
+
+
+@lru_cache(maxsize=None)
+def season_records(data_dir: str = DATA_DIR) -> tuple:
+    "Game records of every season data file in chronological order."
+    return tuple(record for season in iter_season_records(data_dir) for record in season)
+
+def scale_up(games: GameArrays, factor: int) -> GameArrays:
+    """
+    Repeats the games factor times. Every repeat is moved to the seasons
+    after the previous one so the history stays chronological.
+    """
+    if factor == 1:
+        return games
+    seasons = np.unique(games.season)
+    span = int(seasons[-1] - seasons[0] + 1)
+    n_games = len(games)
+    columns = {column: np.tile(getattr(games, column), factor) for column in GameArrays.COLUMNS}
+    columns["season"] = columns["season"] + np.repeat(np.arange(factor) * span, n_games)
+    return GameArrays(games.teams, range(n_games * factor), **columns)
+
+@lru_cache(maxsize=None)
+def game_history(factor: int = 1) -> GameArrays:
+    """
+    Game history built from the data files, repeated factor times. The
+    pregame elo columns are filled in by a replay like elo_sim.run.
+    """
+    games = scale_up(to_game_arrays(season_records(), league_team_arrays()), factor)
+    result = replay(games)
+    games.home_pregame_elo = result.home_pregame_elo.astype(np.int32)
+    games.away_pregame_elo = result.away_pregame_elo.astype(np.int32)
+    return games
+
+@lru_cache(maxsize=None)
+def team_documents() -> tuple:
+    "Unsaved Team documents in league_team_arrays order with generated ids."
+    teams = league_team_arrays()
+    return tuple(
+        Team(id=ObjectId(), name=name, ticker=ticker, latitude=latitude, longitude=longitude,
+             elo=int(elo))
+        for name, ticker, latitude, longitude, elo in zip(
+            teams.names, teams.tickers, teams.latitude.tolist(), teams.longitude.tolist(),
+            teams.elo.tolist())
+    )
+
+@lru_cache(maxsize=None)
+def game_documents() -> tuple:
+    """
+    Unsaved Game documents of the game history with their pregame elos,
+    as used by the scalar model functions.
+    """
+    games = game_history(1)
+    teams = team_documents()
+    records = season_records()
+    return tuple(
+        Game(season=record.season, week=record.week,
+             home_team=teams[h], away_team=teams[a],
+             home_points=record.home_points, away_points=record.away_points,
+             home_pregame_elo=home_elo, away_pregame_elo=away_elo,
+             neutral_destination=None if neutral < 0 else teams[neutral])
+        for record, h, a, neutral, home_elo, away_elo in zip(
+            records, games.home.tolist(), games.away.tolist(), games.neutral.tolist(),
+            games.home_pregame_elo.tolist(), games.away_pregame_elo.tolist())
+    )
@@ -0,0 +1,163 @@
+"""
+Runs the benchmarks and writes the timings as JSON.
+
+    python -m benchmarks.run [--scale 1 10 100] [--only NAME ...]
+                             [--repeat 5] [--output bench.json]
+                             [--compare baseline.json] [--threshold 1.2]
+
+Every benchmark is timed with timeit, the best of --repeat runs is the
+reported time. With --compare the run is compared to an earlier output
+and the exit code is 1 if any benchmark got slower than --threshold times
+its baseline.
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import timeit
+from datetime import datetime, timezone
+
+import numpy as np
+
+from .suite import BENCHMARKS
+
+RESULTS_VERSION = 1
+
+
+def git_commit() -> str:
+    "Commit of the working tree or None outside of a git checkout."
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment() -> dict:
+    return {
+        "commit": git_commit(),
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "system": platform.system(),
+    }
+
+def measure(name: str, scale: int, repeat: int = 5, min_time: float = 0.2) -> dict:
+    """
+    Times one benchmark.
+
+    Parameters
+    ----------
+    name : str
+        Name of the benchmark, see suite.BENCHMARKS.
+    scale : int
+        Number of times the game history is repeated.
+    repeat : int
+        Number of timing runs, the fastest one is reported.
+    min_time : float
+        Every timing run calls the benchmark enough times to take at
+        least min_time seconds.
+
+    Returns
+    -------
+    dict
+        Timings in seconds per call.
+    """
+    func, n_items = BENCHMARKS[name].setup(scale)
+    timer = timeit.Timer(func)
+    number = 1
+    while timer.timeit(number) < min_time and number < 1e6:
+        number *= 2
+    times = np.array(timer.repeat(repeat=repeat, number=number)) / number
+    return {
+        "name": name,
+        "scale": scale,
+        "n_items": n_items,
+        "number": number,
+        "repeat": repeat,
+        "min": float(times.min()),
+        "median": float(np.median(times)),
+        "mean": float(times.mean()),
+        "per_item": float(times.min()) / n_items,
+    }
+
+def run_suite(scales=(1,), names=None, repeat: int = 5, min_time: float = 0.2) -> dict:
+    "Runs the benchmarks at every scale they support and returns the JSON document."
+    names = list(BENCHMARKS) if not names else names
+    for name in names:
+        if name not in BENCHMARKS:
+            raise ValueError(f"unknown benchmark {name!r}")
+    results = []
+    for scale in scales:
+        for name in names:
+            max_scale = BENCHMARKS[name].max_scale
+            if max_scale is not None and scale > max_scale:
+                continue
+            result = measure(name, scale, repeat, min_time)
+            print(f"{name:<32}{scale:>5}x{result['min'] * 1e3:>12.3f} ms"
+                  f"{result['per_item'] * 1e6:>12.3f} us/item", file=sys.stderr)
+            results.append(result)
+    return {"version": RESULTS_VERSION, "environment": environment(), "results": results}
+
+def compare(current: dict, baseline: dict, threshold: float = 1.2) -> list[dict]:
+    """
+    Compares the minimum times of two runs.
+
+    Returns
+    -------
+    list[dict]
+        Ratio of the current to the baseline time of every benchmark in
+        both runs, 'regression' is True when the ratio is above threshold.
+    """
+    base = {(result["name"], result["scale"]): result for result in baseline["results"]}
+    comparison = []
+    for result in current["results"]:
+        key = (result["name"], result["scale"])
+        if key not in base:
+            continue
+        ratio = result["min"] / base[key]["min"]
+        comparison.append({"name": key[0], "scale": key[1], "baseline": base[key]["min"],
+                           "current": result["min"], "ratio": ratio,
+                           "regression": ratio > threshold})
+    return comparison
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks of the Elo model.")
+    parser.add_argument("--scale", type=int, nargs="+", default=[1],
+                        help="number of times the game history is repeated")
+    parser.add_argument("--only", nargs="+", help="benchmarks to run")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2)
+    parser.add_argument("--output", help="JSON file for the results, printed if not given")
+    parser.add_argument("--compare", help="JSON output of an earlier run")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="slowdown ratio counted as a regression")
+    parser.add_argument("--list", action="store_true", help="list the benchmarks")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, bench in BENCHMARKS.items():
+            print(name if bench.max_scale is None else f"{name} (max scale {bench.max_scale})")
+        return 0
+
+    results = run_suite(args.scale, args.only, args.repeat, args.min_time)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            results["comparison"] = compare(results, json.load(f), args.threshold)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    regressions = [c for c in results.get("comparison", []) if c["regression"]]
+    for c in regressions:
+        print(f"regression: {c['name']} {c['scale']}x is {c['ratio']:.2f}x slower", file=sys.stderr)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+"""
+Benchmark definitions.
+
+A benchmark is a setup function registered with @benchmark. It receives
+the scale factor of the game history, does the untimed preparation and
+returns the function to be timed and the number of items one call
+processes.
+"""
+
+from typing import Callable, NamedTuple
+
+import numpy as np
+
+from nfl_model2.elo.backtest import backtest
+from nfl_model2.elo.calibration import replay_params, param_grid
+from nfl_model2.elo.distance_table import DistanceTable
+from nfl_model2.elo.elo_engine import replay, pregame_elo_shifts
+from nfl_model2.elo.elo_model import (get_distance, pregame_elo_shift, post_game_elo_shift,
+                                      post_game_elo_shift_batch)
+from nfl_model2.elo.matchups import power_matrix
+from nfl_model2.elo.season_sim import division_index, simulate_seasons
+from nfl_model2.utils.ingest import DATA_DIR, iter_season_records
+from nfl_model2.utils.process_nn_data import build_nn_dataset
+from .fixtures import game_documents, game_history, team_documents
+
+
+class Benchmark(NamedTuple):
+    name: str
+    setup: Callable
+    # largest scale factor the benchmark is run at, None for every scale
+    max_scale: int
+
+
+BENCHMARKS = {}
+
+def benchmark(name: str = None, max_scale: int = None):
+    "Registers a benchmark setup function."
+    def register(setup):
+        bench_name = name or setup.__name__
+        BENCHMARKS[bench_name] = Benchmark(bench_name, setup, max_scale)
+        return setup
+    return register
+
+
+@benchmark(max_scale=1)
+def get_distance_scalar(scale):
+    games = game_documents()
+    def run():
+        for game in games:
+            get_distance(game.home_team, game.away_team)
+    return run, len(games)
+
+@benchmark(max_scale=1)
+def pregame_elo_shift_scalar(scale):
+    games = game_documents()
+    def run():
+        for game in games:
+            pregame_elo_shift(game)
+    return run, len(games)
+
+@benchmark(max_scale=1)
+def pregame_elo_shift_table(scale):
+    games = game_documents()
+    teams = team_documents()
+    table = DistanceTable([team.latitude for team in teams], [team.longitude for team in teams],
+                          [team.id for team in teams])
+    def run():
+        for game in games:
+            pregame_elo_shift(game, table)
+    return run, len(games)
+
+@benchmark(max_scale=1)
+def post_game_elo_shift_scalar(scale):
+    games = game_documents()
+    def run():
+        for game in games:
+            post_game_elo_shift(game)
+    return run, len(games)
+
+@benchmark()
+def pregame_elo_shifts_batch(scale):
+    games = game_history(scale)
+    return lambda: pregame_elo_shifts(games), len(games)
+
+@benchmark("post_game_elo_shift_batch")
+def post_game_elo_shifts_batch(scale):
+    games = game_history(scale)
+    return lambda: post_game_elo_shift_batch(games.home_pregame_elo, games.away_pregame_elo,
+                                             games.home_points, games.away_points), len(games)
+
+@benchmark()
+def full_replay(scale):
+    "Full history replay, the computation done by elo_sim.run."
+    games = game_history(scale)
+    return lambda: replay(games), len(games)
+
+@benchmark(max_scale=10)
+def calibration_replay(scale):
+    games = game_history(scale)
+    grid = param_grid(k=[15, 20, 25, 30], home_field=[40, 48, 56, 64])
+    return lambda: replay_params(games, grid), len(games) * len(grid)
+
+@benchmark()
+def full_backtest(scale):
+    "Scoring the pregame elos of the whole history per season and week."
+    games = game_history(scale)
+    return lambda: backtest(games), len(games)
+
+@benchmark(max_scale=10)
+def nn_feature_build(scale):
+    "Rolling window features built by process_nn_data."
+    games = game_history(scale)
+    return lambda: build_nn_dataset(games), len(games)
+
+@benchmark(max_scale=1)
+def init_db_parse(scale):
+    "Parsing the season data files, the first step of init_db.run."
+    def run():
+        for _ in iter_season_records(DATA_DIR):
+            pass
+    return run, len(game_history(1))
+
+@benchmark(max_scale=1)
+def power_matrix_32(scale):
+    teams = game_history(1).teams
+    table = DistanceTable(teams.latitude, teams.longitude)
+    active = np.flatnonzero(division_index(teams.tickers) >= 0)
+    return lambda: power_matrix(teams.elo, table, active), len(active) ** 2
+
+@benchmark(max_scale=1)
+def season_simulation(scale):
+    teams = game_history(1).teams
+    table = DistanceTable(teams.latitude, teams.longitude)
+    division = division_index(teams.tickers)
+    league = np.flatnonzero(division >= 0)
+    rng = np.random.default_rng(0)
+    home = np.concatenate([rng.permutation(league) for _ in range(8)])
+    away = np.concatenate([np.roll(home[i:i + len(league)], 1) for i in range(0, len(home), len(league))])
+    n_sims = 10000
+    return lambda: simulate_seasons(teams.elo, home, away, division, table, n_sims=n_sims, seed=0), n_sims
@@ -18,6 +18,6 @@ from django.contrib import admin
 from django.urls import path, include
 
 urlpatterns = [
-    path("nfl-prediction", include("nfl_model2.urls")),
+    path("nfl-prediction/", include("nfl_model2.urls")),
     path('admin/', admin.site.urls),
 ]
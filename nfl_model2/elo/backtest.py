@@ -0,0 +1,259 @@
+"""
+This module measures how well the pregame elos predicted the games.
+
+Every game is scored by the Brier score and log loss of its home win
+probability, whether the favourite won and the absolute error of the
+predicted spread. The per game scores are averaged per season and per week
+with np.bincount and the win probabilities are grouped into calibration
+buckets, so the whole history is scored in a few milliseconds.
+
+walk_forward picks the best parameter set of a grid on the seasons before
+each season and scores it on that season only, like the model would have
+been chosen at the time.
+"""
+
+from typing import NamedTuple
+
+import numpy as np
+
+from ..models import connect_to_database
+from .elo_engine import GameArrays, load_game_arrays, season_name
+from .elo_model import win_prob_batch, point_spread
+
+METRICS = ("brier", "log_loss", "accuracy", "spread_mae")
+
+
+class GameScores(NamedTuple):
+    """
+    Prediction and scores of every game. Arrays are (games,) or
+    (games x params).
+    """
+    home_win_prob: np.ndarray
+    outcome: np.ndarray
+    brier: np.ndarray
+    log_loss: np.ndarray
+    accuracy: np.ndarray
+    spread_mae: np.ndarray
+
+
+class BacktestResult(NamedTuple):
+    """
+    Scores of a backtest.
+
+    Attributes
+    ----------
+    overall : dict
+        Number of games and mean of every metric over the scored games.
+    by_season : dict
+        'season' holds the season codes, the other keys the number of games
+        and the mean of every metric of each season.
+    by_week : dict
+        Same as by_season per week, 'season' and 'week' hold the codes.
+    calibration : dict
+        Win probability buckets, see calibration_buckets.
+    """
+    overall: dict
+    by_season: dict
+    by_week: dict
+    calibration: dict
+
+
+def game_scores(games: GameArrays, home_pregame_elo=None, away_pregame_elo=None) -> GameScores:
+    """
+    Scores the pregame elos of every game. Ties count as half a win and
+    games the model called even count as half right.
+
+    Parameters
+    ----------
+    games : GameArrays
+        Games to score.
+    home_pregame_elo, away_pregame_elo : np.ndarray, optional
+        (games,) or (games x params) pregame elos. Default to the elos
+        stored with the games.
+    """
+    if home_pregame_elo is None:
+        home_pregame_elo, away_pregame_elo = games.home_pregame_elo, games.away_pregame_elo
+    elo_diff = np.asarray(home_pregame_elo, dtype=np.float64) - np.asarray(away_pregame_elo, dtype=np.float64)
+    margin = (games.home_points - games.away_points).astype(np.float64)
+    outcome = np.sign(margin)*0.5 + 0.5
+    if elo_diff.ndim == 2:
+        margin = margin[:, None]
+        outcome = outcome[:, None]
+
+    prob = win_prob_batch(elo_diff)
+    clipped = np.clip(prob, 1e-15, 1 - 1e-15)
+    return GameScores(
+        home_win_prob=prob,
+        outcome=np.broadcast_to(outcome, prob.shape),
+        brier=(prob - outcome)**2,
+        log_loss=-(outcome*np.log(clipped) + (1 - outcome)*np.log(1 - clipped)),
+        accuracy=1 - np.abs(np.sign(elo_diff)*0.5 + 0.5 - outcome),
+        spread_mae=np.abs(point_spread(elo_diff) - margin),
+    )
+
+def group_means(keys, scores: GameScores) -> dict:
+    """
+    Averages the scores of games with the same key.
+
+    Returns
+    -------
+    dict
+        'key' holds the sorted distinct keys, 'games' the number of games
+        and every metric the mean of its games.
+    """
+    keys, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(keys))
+    grouped = {"key": keys, "games": counts}
+    for metric in METRICS:
+        values = getattr(scores, metric)
+        if values.ndim == 1:
+            grouped[metric] = np.bincount(inverse, values, len(keys)) / counts
+        else:
+            grouped[metric] = np.stack([np.bincount(inverse, column, len(keys)) for column in values.T],
+                                       axis=1) / counts[:, None]
+    return grouped
+
+def calibration_buckets(prob, outcome, n_buckets: int = 10) -> dict:
+    """
+    Groups win probabilities into equal width buckets.
+
+    Returns
+    -------
+    dict
+        'lower' and 'upper' bounds, number of 'games', 'predicted' mean win
+        probability and 'observed' win rate of every bucket. Empty buckets
+        have nan rates.
+    """
+    prob, outcome = np.ravel(prob), np.ravel(outcome)
+    edges = np.linspace(0, 1, n_buckets + 1)
+    bucket = np.clip(np.searchsorted(edges, prob, side="right") - 1, 0, n_buckets - 1)
+    counts = np.bincount(bucket, minlength=n_buckets)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        predicted = np.bincount(bucket, prob, n_buckets) / counts
+        observed = np.bincount(bucket, outcome, n_buckets) / counts
+    return {"lower": edges[:-1], "upper": edges[1:], "games": counts,
+            "predicted": predicted, "observed": observed}
+
+def _scored_games(games: GameArrays, skip_seasons: int) -> np.ndarray:
+    seasons = np.unique(games.season)
+    if skip_seasons >= len(seasons):
+        raise ValueError("no games left to score")
+    return games.season >= seasons[skip_seasons]
+
+def backtest(games: GameArrays, home_pregame_elo=None, away_pregame_elo=None,
+             skip_seasons: int = 1, n_buckets: int = 10) -> BacktestResult:
+    """
+    Scores the pregame elos of a replay per season and per week.
+
+    Parameters
+    ----------
+    games : GameArrays
+        Games in chronological order.
+    home_pregame_elo, away_pregame_elo : np.ndarray, optional
+        Pregame elos of every game, see elo_engine.replay. Default to the
+        elos stored with the games.
+    skip_seasons : int
+        Number of seasons at the start left out while the ratings settle.
+    n_buckets : int
+        Number of calibration buckets.
+
+    Returns
+    -------
+    BacktestResult
+    """
+    scored = _scored_games(games, skip_seasons)
+    scores = game_scores(games, home_pregame_elo, away_pregame_elo)
+    scores = GameScores(*(values[scored] for values in scores))
+    season = games.season[scored].astype(np.int64)
+    week = games.week[scored].astype(np.int64)
+
+    overall = {"games": int(scored.sum())}
+    overall.update({metric: float(np.mean(getattr(scores, metric))) for metric in METRICS})
+    by_season = group_means(season, scores)
+    by_season["season"] = by_season.pop("key")
+    by_week = group_means(season*100 + week, scores)
+    keys = by_week.pop("key")
+    by_week["season"], by_week["week"] = keys // 100, keys % 100
+    return BacktestResult(overall, by_season, by_week,
+                          calibration_buckets(scores.home_win_prob, scores.outcome, n_buckets))
+
+def walk_forward(games: GameArrays, grid: list, metric: str = "brier", skip_seasons: int = 1,
+                 min_train_seasons: int = 1) -> dict:
+    """
+    Walk-forward evaluation of a parameter grid. Every parameter set is
+    replayed once, then each season is scored with the parameter set that
+    had the best metric over the seasons before it.
+
+    Parameters
+    ----------
+    games : GameArrays
+        Games in chronological order.
+    grid : list[EloParams]
+        Candidate parameter sets, see calibration.param_grid.
+    metric : str
+        Metric minimized on the training seasons, one of METRICS. accuracy
+        is maximized.
+    skip_seasons : int
+        Number of seasons at the start left out of training and testing.
+    min_train_seasons : int
+        Number of training seasons before the first test season.
+
+    Returns
+    -------
+    dict
+        'season' holds the test seasons, 'params' the chosen parameter set
+        and every metric the test score of each season.
+    """
+    from .calibration import replay_params
+
+    if metric not in METRICS:
+        raise ValueError(f"unknown metric {metric!r}")
+    grid = list(grid)
+    n_seasons = len(np.unique(games.season)) - skip_seasons
+    if min_train_seasons < 1 or min_train_seasons >= n_seasons:
+        raise ValueError("min_train_seasons leaves no seasons to test")
+    result = replay_params(games, grid)
+    scored = _scored_games(games, skip_seasons)
+    scores = game_scores(games, result.home_pregame_elo, result.away_pregame_elo)
+    by_season = group_means(games.season[scored], GameScores(*(values[scored] for values in scores)))
+
+    # running mean of the metric over the seasons before each season
+    sign = -1 if metric == "accuracy" else 1
+    totals = np.cumsum(by_season[metric]*by_season["games"][:, None], axis=0)
+    counts = np.cumsum(by_season["games"])[:, None]
+    train = sign*totals[:-1] / counts[:-1]
+    test = np.arange(min_train_seasons, len(by_season["key"]))
+    best = np.argmin(train[test - 1], axis=1)
+
+    walk = {"season": by_season["key"][test], "games": by_season["games"][test],
+            "params": [grid[i] for i in best.tolist()]}
+    for name in METRICS:
+        walk[name] = by_season[name][test, best]
+    return walk
+
+def run():
+    "Backtests the pregame elos stored in the database and prints the scores per season."
+    connect_to_database()
+
+    games = load_game_arrays()
+    result = backtest(games)
+
+    print(f"{'season':>10}{'games':>7}{'brier':>9}{'logloss':>9}{'acc':>7}{'mae':>7}")
+    by_season = result.by_season
+    for i, season in enumerate(by_season["season"].tolist()):
+        print(f"{season_name(season):>10}{by_season['games'][i]:>7}{by_season['brier'][i]:>9.4f}"
+              f"{by_season['log_loss'][i]:>9.4f}{by_season['accuracy'][i]:>7.3f}"
+              f"{by_season['spread_mae'][i]:>7.2f}")
+    overall = result.overall
+    print(f"{'all':>10}{overall['games']:>7}{overall['brier']:>9.4f}{overall['log_loss']:>9.4f}"
+          f"{overall['accuracy']:>7.3f}{overall['spread_mae']:>7.2f}")
+
+    print(f"\n{'bucket':>12}{'games':>7}{'predicted':>11}{'observed':>10}")
+    calibration = result.calibration
+    for i in range(len(calibration["games"])):
+        print(f"{calibration['lower'][i]:>5.1f}-{calibration['upper'][i]:<5.1f} "
+              f"{calibration['games'][i]:>7}{calibration['predicted'][i]:>11.3f}"
+              f"{calibration['observed'][i]:>10.3f}")
+
+if __name__ == "__main__":
+    run()
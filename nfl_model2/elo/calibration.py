@@ -0,0 +1,228 @@
+"""
+This module calibrates the constants of the Elo model against the game
+history.
+
+Every candidate EloParams is replayed over the whole history and scored by
+the Brier score and log loss of its pregame win probabilities. Candidates
+are replayed side by side: team elos are a (teams x params) array, so each
+game is one vectorized update for all of them. Chunks of the grid can be
+spread across a process pool.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from typing import NamedTuple
+
+import numpy as np
+
+from ..models import connect_to_database
+from .distance_table import DistanceTable
+from .elo_engine import GameArrays, ReplayResult, load_game_arrays, week_ends
+from .elo_model import EloParams, DEFAULT_PARAMS, win_prob_batch
+
+
+class CalibrationResult(NamedTuple):
+    """
+    Scores of every parameter set. Lower is better for both scores.
+    """
+    params: list
+    brier: np.ndarray
+    log_loss: np.ndarray
+
+    def best(self, metric: str = "brier") -> EloParams:
+        "Parameter set with the lowest score for metric."
+        return self.params[int(np.argmin(getattr(self, metric)))]
+
+    def ranking(self, metric: str = "brier") -> list[tuple[EloParams, float]]:
+        "Parameter sets and their scores sorted from best to worst."
+        scores = getattr(self, metric)
+        return [(self.params[i], float(scores[i])) for i in np.argsort(scores, kind="stable")]
+
+
+def param_grid(**values) -> list[EloParams]:
+    """
+    Builds every combination of the given parameter values. Parameters that
+    aren't given keep their default value.
+
+    Examples
+    --------
+    >>> param_grid(k=[15, 20, 25], home_field=[40, 48])
+    """
+    for name in values:
+        if name not in EloParams._fields:
+            raise ValueError(f"unknown parameter {name!r}")
+    names = list(values)
+    return [DEFAULT_PARAMS._replace(**dict(zip(names, combo)))
+            for combo in product(*(values[name] for name in names))]
+
+def replay_params(games: GameArrays, params: list) -> ReplayResult:
+    """
+    Replays the games once for every parameter set, see elo_engine.replay.
+    Every team starts at the mean elo of its parameter set.
+
+    Returns
+    -------
+    ReplayResult
+        Same as elo_engine.replay with an extra trailing axis of
+        len(params) on every array.
+    """
+    teams = games.teams
+    n_teams, n_games, n_params = len(teams), len(games), len(params)
+    p = np.array([tuple(param) for param in params], dtype=np.float64).T
+    p = dict(zip(EloParams._fields, p))
+
+    elo = np.tile(np.rint(p["mean"]).astype(np.int64), (n_teams, 1))
+    home_pregame = np.empty((n_games, n_params), dtype=np.int64)
+    away_pregame = np.empty((n_games, n_params), dtype=np.int64)
+    ends = week_ends(games)
+    if n_games == 0:
+        return ReplayResult(home_pregame, away_pregame, elo, ends,
+                            np.empty((0, n_teams, n_params), dtype=np.int64))
+
+    shifts = np.stack([
+        DistanceTable(teams.latitude, teams.longitude, teams.ids, param).pregame_elo_shift(
+            games.home, games.away, games.neutral, games.is_playoff)
+        for param in params
+    ], axis=1)
+    point_diff = (games.home_points - games.away_points).tolist()
+    result = np.where(games.home_points > games.away_points, 1.0,
+                      np.where(games.home_points < games.away_points, 0.0, 0.5)).tolist()
+    log_mov = np.log(np.abs(games.home_points - games.away_points) + 1).tolist()
+
+    is_week_end = np.zeros(n_games, dtype=bool)
+    is_week_end[ends] = True
+    weekly_elo = []
+    prev_season = int(games.season[0])
+    for i, (season, h, a) in enumerate(zip(games.season.tolist(), games.home.tolist(),
+                                           games.away.tolist())):
+        if season != prev_season:
+            elo = np.rint(elo - (elo - p["mean"])*p["regression"]).astype(np.int64)
+            prev_season = season
+
+        home_elo = elo[h] + shifts[i]
+        away_elo = elo[a] - shifts[i]
+        home_pregame[i] = home_elo
+        away_pregame[i] = away_elo
+
+        # see elo_model.post_game_elo_shift
+        elo_diff = (home_elo - away_elo).astype(np.float64)
+        forecast_delta = result[i] - win_prob_batch(elo_diff)
+        diff = point_diff[i]
+        if diff == 0:
+            mov = p["tie_mov"]
+        else:
+            if diff < 0:
+                elo_diff = -elo_diff
+            mov = log_mov[i]*(2.2/(elo_diff*0.001+2.2))
+        post_shift = np.rint(p["k"]*forecast_delta*mov).astype(np.int64)
+
+        elo[h] = home_elo + post_shift
+        elo[a] = away_elo - post_shift
+
+        if is_week_end[i]:
+            weekly_elo.append(elo.copy())
+
+    return ReplayResult(home_pregame, away_pregame, elo, ends, np.asarray(weekly_elo))
+
+def score(games: GameArrays, home_pregame_elo, away_pregame_elo,
+          skip_seasons: int = 1) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Scores pregame elos by the Brier score and log loss of their home win
+    probabilities. Ties count as half a win.
+
+    Parameters
+    ----------
+    games : GameArrays
+        Games the elos belong to.
+    home_pregame_elo, away_pregame_elo : np.ndarray
+        (games,) or (games x params) pregame elos.
+    skip_seasons : int
+        Number of seasons at the start left out of the scores while the
+        ratings settle.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        Brier score and log loss of every parameter set.
+    """
+    seasons = np.unique(games.season)
+    if skip_seasons >= len(seasons):
+        raise ValueError("no games left to score")
+    scored = games.season >= seasons[skip_seasons]
+    if not scored.any():
+        raise ValueError("no games left to score")
+
+    elo_diff = np.asarray(home_pregame_elo)[scored] - np.asarray(away_pregame_elo)[scored]
+    prob = win_prob_batch(elo_diff)
+    outcome = np.where(games.home_points > games.away_points, 1.0,
+                       np.where(games.home_points < games.away_points, 0.0, 0.5))[scored]
+    if prob.ndim == 2:
+        outcome = outcome[:, None]
+
+    brier = np.mean((prob - outcome)**2, axis=0)
+    prob = np.clip(prob, 1e-15, 1 - 1e-15)
+    log_loss = -np.mean(outcome*np.log(prob) + (1 - outcome)*np.log(1 - prob), axis=0)
+    return brier, log_loss
+
+def _score_chunk(args):
+    games, params, skip_seasons = args
+    result = replay_params(games, params)
+    return score(games, result.home_pregame_elo, result.away_pregame_elo, skip_seasons)
+
+def calibrate(games: GameArrays, grid: list, n_workers: int = 1, chunk_size: int = 64,
+              skip_seasons: int = 1) -> CalibrationResult:
+    """
+    Scores every parameter set of grid against the game history.
+
+    Parameters
+    ----------
+    games : GameArrays
+        Game history in chronological order.
+    grid : list[EloParams]
+        Parameter sets to be scored, see param_grid.
+    n_workers : int
+        Number of processes. Chunks of the grid are replayed in parallel
+        when greater than 1.
+    chunk_size : int
+        Number of parameter sets replayed together in one vectorized pass.
+    skip_seasons : int
+        Number of seasons at the start left out of the scores.
+
+    Returns
+    -------
+    CalibrationResult
+    """
+    grid = list(grid)
+    chunks = [(games, grid[start:start + chunk_size], skip_seasons)
+              for start in range(0, len(grid), chunk_size)]
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            scores = list(executor.map(_score_chunk, chunks))
+    else:
+        scores = [_score_chunk(chunk) for chunk in chunks]
+
+    brier = np.concatenate([chunk[0] for chunk in scores]) if scores else np.empty(0)
+    log_loss = np.concatenate([chunk[1] for chunk in scores]) if scores else np.empty(0)
+    return CalibrationResult(grid, brier, log_loss)
+
+def run(n_workers: int = 1):
+    """
+    Calibrates the K-factor, home field advantage and regression to the
+    mean against the games in the database and prints the best parameter
+    sets.
+    """
+    connect_to_database()
+
+    games = load_game_arrays()
+    grid = param_grid(k=[10, 15, 20, 25, 30], home_field=[32, 40, 48, 56, 64],
+                      regression=[1/4, 1/3, 1/2])
+    result = calibrate(games, grid, n_workers=n_workers)
+
+    print(f"{'k':>6}{'home':>6}{'regr':>7}{'brier':>9}{'logloss':>9}")
+    for params, brier in result.ranking()[:10]:
+        i = result.params.index(params)
+        print(f"{params.k:>6}{params.home_field:>6}{params.regression:>7.3f}"
+              f"{brier:>9.5f}{result.log_loss[i]:>9.5f}")
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,124 @@
+"""
+This module contains a precomputed table of the distances between every pair
+of teams and the pregame elo shifts derived from them.
+
+There are only a few dozen team locations so the haversine formula is
+evaluated once for every pair and pregame_elo_shift becomes a table read.
+"""
+
+import numpy as np
+
+from .elo_model import EloParams, DEFAULT_PARAMS, get_distance_batch
+
+
+class DistanceTable:
+    """
+    Team x team distance matrix and pregame elo shift tables.
+
+    Attributes
+    ----------
+    ids : list
+        Database ids of the teams. The position of an id is the index used
+        to look up the tables.
+    index : dict
+        Maps team ids to their index in the tables.
+    latitude, longitude : np.ndarray
+        Coordinates the table was built from.
+    distance : np.ndarray
+        distance[i, j] is the distance in miles between team i and team j.
+    travel_shift : np.ndarray
+        Elo penalty for travelling from team i to a neutral site at team j.
+    home_shift : np.ndarray
+        Regular season pregame elo shift for team i hosting team j.
+    playoff_shift : np.ndarray
+        Playoff pregame elo shift for team i hosting team j.
+    params : EloParams
+        Constants the shifts were calculated with.
+    """
+
+    def __init__(self, latitude, longitude, ids=None, params: EloParams = DEFAULT_PARAMS):
+        self.latitude = np.array(latitude, dtype=np.float64)
+        self.longitude = np.array(longitude, dtype=np.float64)
+        n_teams = len(self.latitude)
+        self.ids = list(range(n_teams)) if ids is None else list(ids)
+        self.index = {team_id: i for i, team_id in enumerate(self.ids)}
+        self.params = params
+
+        self.distance = get_distance_batch(
+            self.latitude[:, None], self.longitude[:, None],
+            self.latitude[None, :], self.longitude[None, :]
+        )
+        self.travel_shift = np.rint(self.distance*params.travel_factor).astype(np.int64)
+        home_shift = params.home_field/2 + np.rint(self.distance*params.travel_factor/2)
+        self.home_shift = np.rint(home_shift).astype(np.int64)
+        self.playoff_shift = np.rint(home_shift * params.playoff_multiplier).astype(np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def matches(self, latitude, longitude, ids=None, params: EloParams = DEFAULT_PARAMS) -> bool:
+        "Checks if the table was built from the given team locations and params."
+        if ids is not None and list(ids) != self.ids:
+            return False
+        if params != self.params:
+            return False
+        return (np.array_equal(np.asarray(latitude, dtype=np.float64), self.latitude)
+                and np.array_equal(np.asarray(longitude, dtype=np.float64), self.longitude))
+
+    def pregame_elo_shift(self, home, away, neutral=-1, is_playoff=False):
+        """
+        Looks up the pregame elo shift, see elo_model.pregame_elo_shift.
+        Works on single team indices or numpy arrays of indices.
+
+        Parameters
+        ----------
+        home, away : int or np.ndarray
+            Indices of the home and away teams.
+        neutral : int or np.ndarray
+            Index of the neutral site or -1 when the game is played at the
+            home team's stadium.
+        is_playoff : bool or np.ndarray
+            True for playoff games.
+
+        Returns
+        -------
+        int or np.ndarray
+            Amount of elo to add to the home team and subtract from the
+            away team.
+        """
+        if np.ndim(home) == 0 and np.ndim(neutral) == 0 and np.ndim(is_playoff) == 0:
+            if neutral >= 0:
+                return int(self.travel_shift[away, neutral] - self.travel_shift[home, neutral])
+            if is_playoff:
+                return int(self.playoff_shift[home, away])
+            return int(self.home_shift[home, away])
+
+        home = np.asarray(home)
+        away = np.asarray(away)
+        neutral = np.asarray(neutral)
+        site = np.maximum(neutral, 0)
+        hosted = np.where(is_playoff, self.playoff_shift[home, away], self.home_shift[home, away])
+        travel = self.travel_shift[away, site] - self.travel_shift[home, site]
+        return np.where(neutral >= 0, travel, hosted)
+
+
+_table = None
+
+def get_distance_table(latitude, longitude, ids=None, params: EloParams = DEFAULT_PARAMS) -> DistanceTable:
+    """
+    Returns the distance table for the given team locations. The table is
+    built on the first call and only rebuilt when a team's coordinates change.
+
+    Parameters
+    ----------
+    latitude, longitude : array_like
+        Coordinates of every team.
+    ids : list, optional
+        Database ids of the teams in the same order as the coordinates.
+    params : EloParams
+        Constants used for the pregame elo shifts.
+    """
+    global _table
+    if _table is None or not _table.matches(latitude, longitude, ids, params):
+        _table = DistanceTable(latitude, longitude, ids, params)
+    return _table
@@ -0,0 +1,450 @@
+"""
+This module contains an in-memory, array-backed replay engine for the Elo model.
+
+The whole game history is loaded once into compact numpy arrays indexed by
+integer team ids, replayed in a tight loop, and only written back to the
+database at the end. The results are identical to replaying the games one
+document at a time with the functions in elo_model.
+"""
+
+from typing import NamedTuple
+
+import numpy as np
+
+from ..models import EloCheckpoint
+from ..storage import Storage, get_storage
+from .elo_model import EloParams, DEFAULT_PARAMS, pre_season_elo, WIN_PROB_TABLE, WIN_PROB_RANGE
+from .distance_table import get_distance_table
+
+# Playoff weeks are stored as names in the database. They are given codes
+# after the last regular season week so that week codes sort chronologically.
+PLAYOFF_WEEK_CODES = {
+    "WildCard": 19,
+    "Division": 20,
+    "ConfChamp": 21,
+    "SuperBowl": 22,
+}
+PLAYOFF_WEEK_NAMES = {code: name for name, code in PLAYOFF_WEEK_CODES.items()}
+
+
+def week_code(week: str) -> int:
+    """
+    Converts a week name from the database into an integer code.
+
+    Parameters
+    ----------
+    week : str
+        Week of the season ex. '1' or 'WildCard'.
+
+    Returns
+    -------
+    int
+        Week number for regular season weeks or the playoff code from
+        PLAYOFF_WEEK_CODES for playoff weeks.
+    """
+    try:
+        return int(week)
+    except ValueError:
+        return PLAYOFF_WEEK_CODES[week]
+
+def season_code(season: str) -> int:
+    "Converts a season string like '2010-2011' into its starting year."
+    return int(season[:4])
+
+def week_name(code: int) -> str:
+    "Converts a week code back into the week name used in the database."
+    return PLAYOFF_WEEK_NAMES.get(code, str(code))
+
+def season_name(code: int) -> str:
+    "Converts a season's starting year into a season string like '2010-2011'."
+    return f"{code}-{code + 1}"
+
+
+class TeamArrays:
+    """
+    Columnar representation of the Team collection.
+
+    Attributes
+    ----------
+    ids : list
+        Database ids of the teams. The position of an id is the team index
+        used by GameArrays.
+    names : list[str]
+        Team names.
+    tickers : list[str]
+        Team tickers.
+    latitude : np.ndarray
+        Latitude of every team's home stadium.
+    longitude : np.ndarray
+        Longitude of every team's home stadium.
+    elo : np.ndarray
+        Current elo of every team.
+    """
+
+    def __init__(self, ids, names, tickers, latitude, longitude, elo):
+        self.ids = list(ids)
+        self.names = list(names)
+        self.tickers = list(tickers)
+        self.latitude = np.asarray(latitude, dtype=np.float64)
+        self.longitude = np.asarray(longitude, dtype=np.float64)
+        self.elo = np.asarray(elo, dtype=np.int64)
+        self.index = {team_id: i for i, team_id in enumerate(self.ids)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def with_locations(self, locations: dict) -> "TeamArrays":
+        """
+        Copy of the teams with the coordinates of the teams in locations
+        replaced.
+
+        Parameters
+        ----------
+        locations : dict
+            Maps team ids to dicts with 'latitude' and 'longitude' keys, for
+            example the TeamRefs of utils.flat_games.read_flat_games.
+        """
+        latitude, longitude = self.latitude.copy(), self.longitude.copy()
+        for team_id, location in locations.items():
+            i = self.index[team_id]
+            latitude[i], longitude[i] = location["latitude"], location["longitude"]
+        return TeamArrays(self.ids, self.names, self.tickers, latitude, longitude, self.elo)
+
+    @classmethod
+    def from_records(cls, records) -> "TeamArrays":
+        """
+        Builds the arrays from raw team documents, for example the output of
+        Team.objects.as_pymongo().
+
+        Parameters
+        ----------
+        records : iterable of dict
+            Team documents with '_id', 'name', 'ticker', 'latitude',
+            'longitude' and 'elo' keys.
+        """
+        records = list(records)
+        return cls(
+            ids=[r["_id"] for r in records],
+            names=[r["name"] for r in records],
+            tickers=[r["ticker"] for r in records],
+            latitude=[r["latitude"] for r in records],
+            longitude=[r["longitude"] for r in records],
+            elo=[r.get("elo") or 0 for r in records],
+        )
+
+
+class GameArrays:
+    """
+    Columnar representation of the Game collection in replay order.
+
+    Attributes
+    ----------
+    teams : TeamArrays
+        Teams referenced by the games.
+    ids : list
+        Database ids of the games.
+    season : np.ndarray
+        Starting year of the season of every game.
+    week : np.ndarray
+        Week code of every game, see week_code.
+    is_playoff : np.ndarray
+        True for playoff games.
+    home, away : np.ndarray
+        Team indices of the home and away teams.
+    home_points, away_points : np.ndarray
+        Final score of every game.
+    neutral : np.ndarray
+        Team index of the neutral site or -1 when the game is played at
+        the home team's stadium.
+    home_yards, away_yards : np.ndarray
+        Yards gained by each team.
+    home_turnovers, away_turnovers : np.ndarray
+        Turnovers committed by each team.
+    home_pregame_elo, away_pregame_elo : np.ndarray
+        Pregame elos stored in the database by the last replay.
+    """
+
+    # columns with one value per game
+    COLUMNS = ("season", "week", "is_playoff", "home", "away", "home_points", "away_points",
+               "neutral", "home_yards", "away_yards", "home_turnovers", "away_turnovers",
+               "home_pregame_elo", "away_pregame_elo")
+
+    def __init__(self, teams, ids, season, week, is_playoff, home, away,
+                 home_points, away_points, neutral, home_yards=None, away_yards=None,
+                 home_turnovers=None, away_turnovers=None, home_pregame_elo=None,
+                 away_pregame_elo=None):
+        self.teams = teams
+        self.ids = list(ids)
+        self.season = np.asarray(season, dtype=np.int32)
+        self.week = np.asarray(week, dtype=np.int8)
+        self.is_playoff = np.asarray(is_playoff, dtype=bool)
+        self.home = np.asarray(home, dtype=np.int32)
+        self.away = np.asarray(away, dtype=np.int32)
+        self.home_points = np.asarray(home_points, dtype=np.int32)
+        self.away_points = np.asarray(away_points, dtype=np.int32)
+        self.neutral = np.asarray(neutral, dtype=np.int32)
+
+        # optional box score and elo columns default to 0 like the database
+        def optional(values):
+            if values is None:
+                return np.zeros(len(self.ids), dtype=np.int32)
+            return np.asarray(values, dtype=np.int32)
+
+        self.home_yards = optional(home_yards)
+        self.away_yards = optional(away_yards)
+        self.home_turnovers = optional(home_turnovers)
+        self.away_turnovers = optional(away_turnovers)
+        self.home_pregame_elo = optional(home_pregame_elo)
+        self.away_pregame_elo = optional(away_pregame_elo)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def subset(self, index) -> "GameArrays":
+        """
+        Selects some of the games.
+
+        Parameters
+        ----------
+        index : slice or np.ndarray
+            Slice, integer indices or boolean mask of the games to keep.
+        """
+        positions = np.arange(len(self.ids))[index]
+        return GameArrays(self.teams, [self.ids[i] for i in positions.tolist()],
+                          **{column: getattr(self, column)[index] for column in self.COLUMNS})
+
+    @classmethod
+    def from_records(cls, records, teams: TeamArrays) -> "GameArrays":
+        """
+        Builds the arrays from raw game documents, for example the output of
+        Game.objects.as_pymongo(). Team references are resolved through
+        teams.index without dereferencing any documents.
+
+        Parameters
+        ----------
+        records : iterable of dict
+            Game documents in replay order.
+        teams : TeamArrays
+            Teams referenced by the games.
+        """
+        index = teams.index
+        ids = []
+        columns = {column: [] for column in cls.COLUMNS}
+        stats = ("home_yards", "away_yards", "home_turnovers", "away_turnovers",
+                 "home_pregame_elo", "away_pregame_elo")
+        for r in records:
+            ids.append(r["_id"])
+            columns["season"].append(season_code(r["season"]))
+            columns["week"].append(week_code(r["week"]))
+            columns["is_playoff"].append(not r["week"].isdigit())
+            columns["home"].append(index[r["home_team"]])
+            columns["away"].append(index[r["away_team"]])
+            columns["home_points"].append(r["home_points"])
+            columns["away_points"].append(r["away_points"])
+            neutral_dest = r.get("neutral_destination")
+            columns["neutral"].append(-1 if neutral_dest is None else index[neutral_dest])
+            for stat in stats:
+                columns[stat].append(r.get(stat) or 0)
+
+        return cls(teams, ids, **columns)
+
+
+class ReplayResult(NamedTuple):
+    """
+    Output of replay. week_end holds the index of the last game of every
+    (season, week) and weekly_elo the elo of every team after that game.
+    """
+    home_pregame_elo: np.ndarray
+    away_pregame_elo: np.ndarray
+    elo: np.ndarray
+    week_end: np.ndarray
+    weekly_elo: np.ndarray
+
+
+def load_team_arrays(storage: Storage = None) -> TeamArrays:
+    "Loads the Team collection into arrays. A database connection must already be open."
+    return TeamArrays.from_records(get_storage(storage).team_records())
+
+def load_game_arrays(after=None, teams: TeamArrays = None, storage: Storage = None) -> GameArrays:
+    """
+    Loads the Team and Game collections into arrays with one query each.
+    A database connection must already be open. When the storage keeps the
+    team locations with the games, see Storage.game_records_with_teams,
+    the distances are calculated from those.
+
+    Parameters
+    ----------
+    after : ObjectId, optional
+        Only load games inserted after the game with this id.
+    teams : TeamArrays, optional
+        Teams that have already been loaded.
+    storage : Storage, optional
+        Where the collections are read from, defaults to the database.
+    """
+    storage = get_storage(storage)
+    records, locations = storage.game_records_with_teams(after)
+    if teams is None:
+        teams = load_team_arrays(storage)
+    if locations:
+        teams = teams.with_locations(locations)
+    return GameArrays.from_records(records, teams)
+
+def pregame_elo_shifts(games: GameArrays, params: EloParams = DEFAULT_PARAMS) -> np.ndarray:
+    """
+    Looks up the pregame elo shift of every game in the distance table,
+    see elo_model.pregame_elo_shift.
+    """
+    teams = games.teams
+    table = get_distance_table(teams.latitude, teams.longitude, teams.ids, params)
+    return table.pregame_elo_shift(games.home, games.away, games.neutral, games.is_playoff)
+
+def week_ends(games: GameArrays) -> np.ndarray:
+    "Finds the index of the last game of every (season, week) in games."
+    key = games.season.astype(np.int64) * 100 + games.week
+    return np.flatnonzero(np.append(key[1:] != key[:-1], len(key) > 0))
+
+def replay(games: GameArrays, elo=None, prev_season=None, params: EloParams = DEFAULT_PARAMS) -> ReplayResult:
+    """
+    Replays the games in order and calculates the pregame elo of both teams
+    in every game. Gives the same results as simulating the games one at a
+    time with pregame_elo_shift, post_game_elo_shift and pre_season_elo.
+
+    Parameters
+    ----------
+    games : GameArrays
+        Games to be replayed in order.
+    elo : np.ndarray, optional
+        Elo of every team before the first game. Defaults to the mean elo
+        of params for every team.
+    prev_season : int, optional
+        Season the starting elo belongs to. pre_season_elo is applied to
+        every team whenever the season changes. Defaults to the season of
+        the first game.
+    params : EloParams
+        Constants of the model.
+
+    Returns
+    -------
+    ReplayResult
+        Pregame elos of every game, the elo of every team after the last
+        game and after every week.
+    """
+    n_teams = len(games.teams)
+    if elo is None:
+        elo = [int(params.mean)] * n_teams
+    else:
+        elo = [int(e) for e in elo]
+
+    n_games = len(games)
+    if n_games == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return ReplayResult(empty, empty.copy(), np.asarray(elo, dtype=np.int64),
+                            empty.copy(), np.empty((0, n_teams), dtype=np.int64))
+
+    if prev_season is None:
+        prev_season = int(games.season[0])
+
+    shifts = pregame_elo_shifts(games, params).tolist()
+    point_diff = (games.home_points - games.away_points).tolist()
+    # the log term of the mov multiplier only depends on the score
+    log_mov = np.log(np.abs(games.home_points - games.away_points) + 1).tolist()
+
+    home_pregame = [0] * n_games
+    away_pregame = [0] * n_games
+    ends = week_ends(games)
+    is_week_end = np.zeros(n_games, dtype=bool)
+    is_week_end[ends] = True
+    is_week_end = is_week_end.tolist()
+    weekly_elo = []
+    K = params.k
+    for i, (season, h, a) in enumerate(zip(games.season.tolist(), games.home.tolist(),
+                                           games.away.tolist())):
+        if season != prev_season:
+            elo = [pre_season_elo(e, params) for e in elo]
+            prev_season = season
+
+        home_elo = elo[h] + shifts[i]
+        away_elo = elo[a] - shifts[i]
+        home_pregame[i] = home_elo
+        away_pregame[i] = away_elo
+
+        # see elo_model.post_game_elo_shift
+        elo_diff = home_elo - away_elo
+        if -WIN_PROB_RANGE <= elo_diff <= WIN_PROB_RANGE:
+            win_probability = WIN_PROB_TABLE[elo_diff + WIN_PROB_RANGE]
+        else:
+            win_probability = 1/(10**(-elo_diff/400)+1)
+        diff = point_diff[i]
+        if diff == 0:
+            forecast_delta = 0.5 - win_probability
+            mov = params.tie_mov
+        else:
+            if diff > 0:
+                forecast_delta = 1 - win_probability
+            else:
+                forecast_delta = 0 - win_probability
+                elo_diff *= -1
+            mov = log_mov[i]*(2.2/(elo_diff*0.001+2.2))
+        post_shift = round(K*forecast_delta*mov)
+
+        elo[h] = home_elo + post_shift
+        elo[a] = away_elo - post_shift
+
+        if is_week_end[i]:
+            weekly_elo.append(list(elo))
+
+    return ReplayResult(
+        np.asarray(home_pregame, dtype=np.int64),
+        np.asarray(away_pregame, dtype=np.int64),
+        np.asarray(elo, dtype=np.int64),
+        ends,
+        np.asarray(weekly_elo, dtype=np.int64),
+    )
+
+def write_replay(games: GameArrays, result: ReplayResult, storage: Storage = None) -> None:
+    """
+    Writes the pregame elos of every game and the final elo of every team
+    to the database in one bulk write per collection.
+    """
+    storage = get_storage(storage)
+    storage.set_pregame_elos(games.ids, result.home_pregame_elo.tolist(),
+                             result.away_pregame_elo.tolist())
+    storage.set_team_elos(games.teams.ids, result.elo.tolist())
+
+def load_latest_checkpoint(teams: TeamArrays, elo_mean=1505, storage: Storage = None):
+    """
+    Loads the most recent elo checkpoint from the database.
+
+    Parameters
+    ----------
+    teams : TeamArrays
+        Teams to look up in the checkpoint. Teams missing from the
+        checkpoint get elo_mean.
+    elo_mean : int
+        Elo of teams missing from the checkpoint.
+    storage : Storage, optional
+        Where the checkpoints are read from, defaults to the database.
+
+    Returns
+    -------
+    tuple[EloCheckpoint, np.ndarray] or tuple[None, None]
+        The checkpoint and the elo of every team in teams order, or
+        (None, None) if there are no checkpoints.
+    """
+    checkpoint = get_storage(storage).latest_checkpoint()
+    if checkpoint is None:
+        return None, None
+
+    saved = dict(zip(checkpoint.team_ids, checkpoint.elos))
+    elo = np.array([saved.get(team_id, elo_mean) for team_id in teams.ids], dtype=np.int64)
+    return checkpoint, elo
+
+def write_checkpoints(games: GameArrays, result: ReplayResult, storage: Storage = None) -> None:
+    "Inserts a checkpoint for every week that was replayed."
+    team_ids = games.teams.ids
+    checkpoints = [
+        EloCheckpoint(season=season_name(int(games.season[i])), week=week_name(int(games.week[i])),
+                      last_game=games.ids[i], team_ids=team_ids, elos=elo)
+        for i, elo in zip(result.week_end.tolist(), result.weekly_elo.tolist())
+    ]
+    get_storage(storage).insert_checkpoints(checkpoints)
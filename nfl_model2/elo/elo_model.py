@@ -4,11 +4,51 @@ Elo Model developed by Jay Boice at FiveThirtyEight.
 see https://fivethirtyeight.com/methodology/how-our-nfl-predictions-work/
 """
 
+from typing import NamedTuple
+
 from ..models import Team, Game
 
 import numpy as np
 
 
+class EloParams(NamedTuple):
+    """
+    Constants of the Elo model.
+
+    Attributes
+    ----------
+    k : float
+        K-factor of the post game elo shift.
+    home_field : float
+        Home field advantage in elo points, half of it is added to the
+        home team and half subtracted from the away team. The shift is
+        rounded to whole points.
+    travel_factor : float
+        Elo points lost per mile travelled.
+    playoff_multiplier : float
+        Multiplier of the pregame elo shift in playoff games.
+    tie_mov : float
+        Margin of victory multiplier used for ties.
+    mean : float
+        Mean elo that teams regress to between seasons.
+    regression : float
+        Fraction of the distance to the mean regressed between seasons.
+    """
+    # recommended K-factor
+    k: float = 20
+    home_field: float = 48
+    travel_factor: float = 0.004
+    playoff_multiplier: float = 1.2
+    # The explanation for accounting for a tie doesn't seem to be on the website
+    # anymore but I've decided to keep this value because it makes sense
+    # that a team that is predicted to win ties should lose points.
+    tie_mov: float = 1.525
+    mean: float = 1505
+    regression: float = 1/3
+
+DEFAULT_PARAMS = EloParams()
+
+
 def get_distance(teamA: Team, teamB: Team) -> float:
     """
     Calculates distance between team home locations using the haversine formula.
@@ -26,11 +66,31 @@ def get_distance(teamA: Team, teamB: Team) -> float:
         Distance between teams in miles.
     """
 
+    return haversine(teamA.latitude, teamA.longitude, teamB.latitude, teamB.longitude)
+
+def haversine(lat_a, long_a, lat_b, long_b):
+    """
+    Calculates the distance between two coordinates using the haversine formula.
+    Works on scalars or numpy arrays of coordinates.
+
+    Parameters
+    ----------
+    lat_a, long_a : float or np.ndarray
+        Latitude and longitude of the first location in degrees.
+    lat_b, long_b : float or np.ndarray
+        Latitude and longitude of the second location in degrees.
+
+    Returns
+    -------
+    float or np.ndarray
+        Distance between the locations in miles.
+    """
+
     r = 6378.137 #Radius of earth (Km)
-    lat_a = np.radians(teamA.latitude)
-    lat_b = np.radians(teamB.latitude)
-    long_a = np.radians(teamA.longitude)
-    long_b = np.radians(teamB.longitude)
+    lat_a = np.radians(lat_a)
+    lat_b = np.radians(lat_b)
+    long_a = np.radians(long_a)
+    long_b = np.radians(long_b)
 
     # Haversine formula see: https://en.wikipedia.org/wiki/Haversine_formula
     distance = 2*r*np.arcsin(np.sqrt(np.sin((lat_b-lat_a)/2)**2 + 
@@ -38,7 +98,7 @@ def get_distance(teamA: Team, teamB: Team) -> float:
 
     return distance/1.609 # Miles
 
-def pregame_elo_shift(game: Game) -> int:
+def pregame_elo_shift(game: Game, table=None, params: EloParams = DEFAULT_PARAMS) -> int:
     """
     Calculate the pregame elo shift for a given game.
 
@@ -46,6 +106,12 @@ def pregame_elo_shift(game: Game) -> int:
     ----------
     game : Game
         game that the elo is to be calculated for
+    table : DistanceTable, optional
+        Precomputed distance table containing the game's teams. When given
+        the shift is looked up by team id instead of being calculated.
+        The table must have been built with the same params.
+    params : EloParams
+        Constants of the model.
 
     Returns
     -------
@@ -57,37 +123,59 @@ def pregame_elo_shift(game: Game) -> int:
     home_team = game.home_team
     away_team = game.away_team
 
+    if table is not None:
+        neutral = -1
+        if game.neutral_destination != None:
+            neutral = table.index[game.neutral_destination.id]
+        return table.pregame_elo_shift(table.index[home_team.id], table.index[away_team.id],
+                                       neutral, not game.week.isdigit())
+
     elo_shift = 0
     # check if it is superbowl
     if game.neutral_destination != None:
         neutral_dest = game.neutral_destination
         home_travel_dist = get_distance(home_team, neutral_dest)
         away_travel_dist = get_distance(away_team, neutral_dest)
-        home_team_shift = round(home_travel_dist*0.004)
-        away_team_shift = round(away_travel_dist*0.004)
+        home_team_shift = round(home_travel_dist*params.travel_factor)
+        away_team_shift = round(away_travel_dist*params.travel_factor)
         elo_shift = (away_team_shift - home_team_shift)
     else:
         # regular season game
         distance = get_distance(home_team, away_team)
-        elo_shift += 48/2
-        elo_shift += round(distance*0.004/2)
+        elo_shift += params.home_field/2
+        elo_shift += round(distance*params.travel_factor/2)
 
-        # check for playoffs and multiply by 1.2 if it is
+        # check for playoffs and multiply by the playoff multiplier if it is
         try:
             int(game.week)
         except ValueError:
             # Error because week is now something like 'WildCard'
             # therefore it is playoffs
-            elo_shift = round(elo_shift * 1.2) 
+            elo_shift = round(elo_shift * params.playoff_multiplier)
+        else:
+            # an odd home_field leaves half a point, rounded like the tables
+            elo_shift = round(elo_shift)
     
     return elo_shift
 
+# win probabilities of every whole elo difference within +-WIN_PROB_RANGE,
+# evaluated with python floats so a lookup equals the formula to the last bit
+WIN_PROB_RANGE = 1000
+WIN_PROB_TABLE = [1/(10**(-diff/400)+1) for diff in range(-WIN_PROB_RANGE, WIN_PROB_RANGE + 1)]
+_WIN_PROB_ARRAY = np.array(WIN_PROB_TABLE, dtype=np.float64)
+
 def win_prob(elo_diff: int) -> float:
     "Calculates win probability with respect to the home team"
+    if elo_diff.__class__ is int and -WIN_PROB_RANGE <= elo_diff <= WIN_PROB_RANGE:
+        return WIN_PROB_TABLE[elo_diff + WIN_PROB_RANGE]
     win_probability = 1/(10**(-elo_diff/400)+1)
     return win_probability
 
-def post_game_elo_shift(game: Game) -> int:
+def point_spread(elo_diff):
+    "Predicted home margin of victory, 25 elo points per point. Works on scalars or numpy arrays."
+    return elo_diff / 25
+
+def post_game_elo_shift(game: Game, params: EloParams = DEFAULT_PARAMS) -> int:
     """
     Calculates the points to be added or subtracted to the home team
     based on the game results. The opposite must be done to the away team
@@ -97,6 +185,8 @@ def post_game_elo_shift(game: Game) -> int:
     ----------
     game : Game
         Game to have the elo calculated from.
+    params : EloParams
+        Constants of the model.
 
     Returns
     -------
@@ -108,8 +198,7 @@ def post_game_elo_shift(game: Game) -> int:
     home_points = game.home_points
     away_points = game.away_points
 
-    # recommended K-factor
-    K = 20
+    K = params.k
 
     elo_diff = game.home_pregame_elo - game.away_pregame_elo
 
@@ -126,10 +215,7 @@ def post_game_elo_shift(game: Game) -> int:
     point_diff = home_points - away_points
     
     if point_diff == 0:
-        # The explanation for accounting for a tie doesn't seem to be on the website
-        # anymore but I've decided to keep this value because it makes sense 
-        # that a team that is predicted to win ties should lose points.
-        mov = 1.525
+        mov = params.tie_mov
     else:
         if point_diff < 0:
             elo_diff *= -1
@@ -137,7 +223,7 @@ def post_game_elo_shift(game: Game) -> int:
 
     return round(K*forecast_delta*mov)
 
-def pre_season_elo(elo):
+def pre_season_elo(elo, params: EloParams = DEFAULT_PARAMS):
     """
     Calculate team's pre-season elo rating. It is essentially
     just a regression to the mean.
@@ -146,12 +232,152 @@ def pre_season_elo(elo):
     -----------
     elo : int
         Elo of a team at the end of a season.
+    params : EloParams
+        Constants of the model.
 
     Returns:
     --------
     int
         New elo value for the team.
     """
-    mean = 1505
-    new_elo = elo - (elo - mean)/3
-    return round(new_elo)
\ No newline at end of file
+    new_elo = elo - (elo - params.mean)*params.regression
+    return round(new_elo)
+
+# Batch versions of the model functions. These accept numpy arrays and
+# evaluate a whole slate of games in one call. They return exactly the same
+# values as the scalar functions above, np.rint rounds half to even just
+# like round().
+
+def get_distance_batch(lat_a, long_a, lat_b, long_b) -> np.ndarray:
+    """
+    Calculates the distance between many pairs of locations.
+
+    Parameters
+    ----------
+    lat_a, long_a : np.ndarray
+        Coordinates of the first location of every pair in degrees.
+    lat_b, long_b : np.ndarray
+        Coordinates of the second location of every pair in degrees.
+
+    Returns
+    -------
+    np.ndarray
+        Distance between every pair in miles.
+    """
+    return haversine(np.asarray(lat_a, dtype=np.float64), np.asarray(long_a, dtype=np.float64),
+                     np.asarray(lat_b, dtype=np.float64), np.asarray(long_b, dtype=np.float64))
+
+def pregame_elo_shift_batch(home_lat, home_long, away_lat, away_long,
+                            neutral_lat, neutral_long, is_neutral, is_playoff,
+                            params: EloParams = DEFAULT_PARAMS) -> np.ndarray:
+    """
+    Calculate the pregame elo shift for many games, see pregame_elo_shift.
+
+    Parameters
+    ----------
+    home_lat, home_long : np.ndarray
+        Coordinates of the home team of every game.
+    away_lat, away_long : np.ndarray
+        Coordinates of the away team of every game.
+    neutral_lat, neutral_long : np.ndarray
+        Coordinates of the neutral site of every game. Ignored where
+        is_neutral is False.
+    is_neutral : np.ndarray
+        True for games played at a neutral site.
+    is_playoff : np.ndarray
+        True for playoff games.
+    params : EloParams
+        Constants of the model.
+
+    Returns
+    -------
+    np.ndarray
+        Amount of elo to add to the home team and subtract from the away
+        team for every game.
+    """
+    is_neutral = np.asarray(is_neutral, dtype=bool)
+    is_playoff = np.asarray(is_playoff, dtype=bool)
+
+    # regular season game
+    distance = get_distance_batch(home_lat, home_long, away_lat, away_long)
+    elo_shift = params.home_field/2 + np.rint(distance*params.travel_factor/2)
+    elo_shift = np.where(is_playoff, np.rint(elo_shift * params.playoff_multiplier), np.rint(elo_shift))
+
+    # neutral site game
+    home_travel_dist = get_distance_batch(home_lat, home_long, neutral_lat, neutral_long)
+    away_travel_dist = get_distance_batch(away_lat, away_long, neutral_lat, neutral_long)
+    neutral_shift = (np.rint(away_travel_dist*params.travel_factor)
+                     - np.rint(home_travel_dist*params.travel_factor))
+
+    return np.where(is_neutral, neutral_shift, elo_shift).astype(np.int64)
+
+def win_prob_batch(elo_diff) -> np.ndarray:
+    "Calculates win probabilities with respect to the home team for many games"
+    elo_diff = np.asarray(elo_diff)
+    if elo_diff.dtype.kind in "iu":
+        in_table = np.abs(elo_diff) <= WIN_PROB_RANGE
+        if in_table.all():
+            return _WIN_PROB_ARRAY[elo_diff + WIN_PROB_RANGE]
+    else:
+        elo_diff = elo_diff.astype(np.float64, copy=False)
+        in_table = (np.abs(elo_diff) <= WIN_PROB_RANGE) & (elo_diff == np.floor(elo_diff))
+
+    prob = np.empty(elo_diff.shape, dtype=np.float64)
+    prob[in_table] = _WIN_PROB_ARRAY[elo_diff[in_table].astype(np.int64) + WIN_PROB_RANGE]
+    # numpy's vectorized pow can differ from the scalar pow in the last bit,
+    # so the power is evaluated with python floats once per distinct elo diff
+    outside = ~in_table
+    if outside.any():
+        values, inverse = np.unique(elo_diff[outside].astype(np.float64), return_inverse=True)
+        powers = np.array([10**(-diff/400) for diff in values.tolist()], dtype=np.float64)
+        prob[outside] = 1/(powers[inverse]+1)
+    return prob
+
+def post_game_elo_shift_batch(home_pregame_elo, away_pregame_elo,
+                              home_points, away_points, params: EloParams = DEFAULT_PARAMS,
+                              win_probability=None) -> np.ndarray:
+    """
+    Calculates the post game elo shift for many games, see post_game_elo_shift.
+
+    Parameters
+    ----------
+    home_pregame_elo, away_pregame_elo : np.ndarray
+        Pregame elo of the home and away teams.
+    home_points, away_points : np.ndarray
+        Final score of every game.
+    params : EloParams
+        Constants of the model.
+    win_probability : np.ndarray, optional
+        Pregame home win probabilities if they have already been calculated.
+
+    Returns
+    -------
+    np.ndarray
+        The number of Elo points to be shifted from the away team to the
+        home team for every game.
+    """
+    home_points = np.asarray(home_points)
+    away_points = np.asarray(away_points)
+    elo_diff = (np.asarray(home_pregame_elo, dtype=np.float64)
+                - np.asarray(away_pregame_elo, dtype=np.float64))
+
+    # forcast delta
+    if win_probability is None:
+        win_probability = win_prob_batch(elo_diff)
+    result = np.where(home_points > away_points, 1.0,
+                      np.where(home_points < away_points, 0.0, 0.5))
+    forecast_delta = result - win_probability
+
+    # mov multiplier
+    point_diff = home_points - away_points
+    elo_diff = np.where(point_diff < 0, -elo_diff, elo_diff)
+    mov = np.where(point_diff == 0, params.tie_mov,
+                   np.log(np.abs(point_diff)+1)*(2.2/(elo_diff*0.001+2.2)))
+
+    return np.rint(params.k*forecast_delta*mov).astype(np.int64)
+
+def pre_season_elo_batch(elo, params: EloParams = DEFAULT_PARAMS) -> np.ndarray:
+    "Calculate the pre-season elo of many teams, see pre_season_elo."
+    elo = np.asarray(elo)
+    new_elo = elo - (elo - params.mean)*params.regression
+    return np.rint(new_elo).astype(np.int64)
@@ -1,69 +1,132 @@
 """
 This script simulates previous seasons by calculating the Elo score for every game
-that has been played since 2010 and stores the resulting pregame elo 
+that has been played since 2010 and stores the resulting pregame elo
 prediction in the Games collection in the database.
+
+The games are read from the local snapshot in utils.game_cache, replayed
+with the array-backed engine in elo_engine and the results are written back
+in bulk at the end. A checkpoint of every team's elo is stored after each
+week so that run_incremental only has to process the games added since the
+last checkpoint. The weekly elos are also saved as a RatingHistory, see
+rating_history. Every run ends with a JSON summary of its phase timings and
+document counts, see utils.instrumentation.
 """
 
 
-from mongoengine import connect
-from ..models import Team, Game, connect_to_database
-from .elo_model import post_game_elo_shift, pre_season_elo, pregame_elo_shift
-from pymongo import UpdateOne
-
-def run():
-    check = input("WARNING this script modifies the database.\nDo you still wish to continue? [y/n] ")
-    
-    if check.lower() != "y":
-        exit()
-
-    connect_to_database()
-
-    Team.objects.update(set__elo=1505)
-    games = Game.objects.order_by("id")
-
-    prev_week = "1"
-    prev_season = "2010-2011"
-    team_updates = []
-    game_updates = []
-    for game in games:
-
-        if prev_week != game.week:
-            print("week ", prev_week, " simulated")
-            Team.objects._collection.bulk_write(team_updates)
-            team_updates.clear()
-            prev_week = game.week
-
-        if prev_season != game.season:
-            # we can ignore the first season because elo is already set 
-            # to 1505 for all teams
-            for team in Team.objects:
-                team.elo = pre_season_elo(team.elo)
-                team_updates.append(UpdateOne({"_id": team.id}, {"$set": {"elo": team.elo}}))
-            Team.objects._collection.bulk_write(team_updates)
-            Game.objects._collection.bulk_write(game_updates)
-            team_updates.clear()
-            game_updates.clear()
-
-            print("Season ", prev_season, " processed")
-            prev_season = game.season
-
-        pre_elo_shift = pregame_elo_shift(game)
-
-        home_team = game.home_team
-        away_team = game.away_team
-
-        game.home_pregame_elo = home_team.elo + pre_elo_shift
-        game.away_pregame_elo = away_team.elo - pre_elo_shift
-
-        post_elo_shift = post_game_elo_shift(game)
-        home_team.elo = game.home_pregame_elo + post_elo_shift
-        away_team.elo = game.away_pregame_elo - post_elo_shift
-    
-        team_updates.append(UpdateOne({"_id": home_team.id}, {"$set": {"elo": home_team.elo}}))
-        team_updates.append(UpdateOne({"_id": away_team.id}, {"$set": {"elo": away_team.elo}}))
-        game_updates.append(UpdateOne({"_id": game.id}, {"$set": {"home_pregame_elo": game.home_pregame_elo, "away_pregame_elo": game.away_pregame_elo}}))
-
-    Game.objects._collection.bulk_write(game_updates)
-            
+from ..models import connect_to_database
+from ..storage import Storage, MongoStorage
+from ..utils.game_cache import load_games
+from ..utils.instrumentation import RunStats
+from . import rating_cache
+from .rating_history import save_history
+from .elo_engine import (load_team_arrays, load_game_arrays, replay, write_replay,
+                         season_code, load_latest_checkpoint, write_checkpoints)
+
+def write_results(games, result, storage: Storage, stats: RunStats, initial_elo=None) -> None:
+    "Writes the pregame elos, team elos, checkpoints and rating history of a replay."
+    with stats.phase("bulk_write"):
+        write_replay(games, result, storage)
+        if initial_elo is None:
+            storage.delete_checkpoints()
+        write_checkpoints(games, result, storage)
+    stats.count("games_written", len(games))
+    stats.count("teams_written", len(games.teams))
+    stats.count("checkpoints_written", len(result.week_end))
+    with stats.phase("history"):
+        save_history(games, result, storage, initial_elo=initial_elo)
+    rating_cache.invalidate()
+
+def run(storage: Storage = None, profile: bool = False, summary_path: str = None):
+    """
+    Replays every game and writes the pregame elos, team elos and weekly
+    checkpoints.
+
+    Parameters
+    ----------
+    storage : Storage, optional
+        Storage to simulate, for example a MemoryStorage. Defaults to the
+        database after asking for confirmation.
+    profile : bool
+        Profile the run with cProfile, see instrumentation.RunStats.
+    summary_path : str, optional
+        File the JSON summary of the run is written to.
+
+    Returns
+    -------
+    dict
+        Timings and counters of the run.
+    """
+    if storage is None:
+        check = input("WARNING this script modifies the database.\nDo you still wish to continue? [y/n] ")
+
+        if check.lower() != "y":
+            exit()
+
+    stats = RunStats("elo_sim.run", profile=profile)
+    if storage is None:
+        connect_to_database()
+        storage = MongoStorage(background=True, stats=stats)
+
+    with stats.phase("load"):
+        games = load_games(source="database", storage=storage)
+    stats.count("games_read", len(games))
+    print(f"{len(games)} games loaded")
+
+    with stats.phase("compute"):
+        result = replay(games)
+    print("Seasons ", games.season[0], " to ", games.season[-1], " simulated")
+
+    write_results(games, result, storage, stats)
+    return stats.report(summary_path)
+
+def run_incremental(storage: Storage = None, profile: bool = False, summary_path: str = None):
+    """
+    Updates the elo of every team with the games added since the last
+    checkpoint. pre_season_elo is applied if the new games start a new
+    season. Falls back to a full replay if there are no checkpoints.
+
+    Parameters
+    ----------
+    storage : Storage, optional
+        Storage to simulate. Defaults to the database.
+    profile : bool
+        Profile the run with cProfile, see instrumentation.RunStats.
+    summary_path : str, optional
+        File the JSON summary of the run is written to.
+
+    Returns
+    -------
+    dict
+        Timings and counters of the run.
+    """
+    stats = RunStats("elo_sim.run_incremental", profile=profile)
+    if storage is None:
+        with stats.phase("connect"):
+            connect_to_database()
+        storage = MongoStorage(background=True, stats=stats)
+
+    with stats.phase("load"):
+        teams = load_team_arrays(storage)
+        checkpoint, elo = load_latest_checkpoint(teams, storage=storage)
+        after = None if checkpoint is None else checkpoint.last_game
+        games = load_game_arrays(after=after, teams=teams, storage=storage)
+    stats.count("teams_read", len(teams))
+    stats.count("games_read", len(games))
+
+    if checkpoint is None:
+        print("No checkpoint found, simulating every season.")
+        with stats.phase("compute"):
+            result = replay(games)
+    else:
+        if len(games) == 0:
+            print(f"Elo is up to date as of week {checkpoint.week} of {checkpoint.season}.")
+            return stats.report(summary_path)
+        with stats.phase("compute"):
+            result = replay(games, elo=elo, prev_season=season_code(checkpoint.season))
+
+    write_results(games, result, storage, stats, initial_elo=elo)
+    print(f"{len(games)} games in {len(result.week_end)} weeks simulated")
+    return stats.report(summary_path)
+
 if __name__ == "__main__":
-    run()
\ No newline at end of file
+    run()
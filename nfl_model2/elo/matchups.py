@@ -0,0 +1,92 @@
+"""
+This module predicts many matchups at once.
+
+A slate of games, or every possible pairing of teams, is turned into
+arrays of team indices and predicted in one vectorized pass: the pregame
+elo shifts are read from the distance table and the win probabilities are
+calculated with win_prob_batch, which gives the same values as win_prob.
+"""
+
+from typing import NamedTuple
+
+import numpy as np
+
+from .distance_table import DistanceTable
+from .elo_model import win_prob_batch, point_spread
+
+
+class MatchupPredictions(NamedTuple):
+    """
+    Predictions of many games, every attribute has one value per game.
+    neutral is -1 for games at the home team's stadium.
+    """
+    home: np.ndarray
+    away: np.ndarray
+    neutral: np.ndarray
+    is_playoff: np.ndarray
+    elo_shift: np.ndarray
+    home_pregame_elo: np.ndarray
+    away_pregame_elo: np.ndarray
+    home_win_prob: np.ndarray
+    spread: np.ndarray
+
+
+def predict_matchups(elo, table: DistanceTable, home, away, neutral=-1,
+                     is_playoff=False) -> MatchupPredictions:
+    """
+    Predicts many games from the current ratings.
+
+    Parameters
+    ----------
+    elo : array_like
+        Current elo of every team in table order.
+    table : DistanceTable
+        Distance table of the teams.
+    home, away : array_like
+        Team indices of the home and away teams.
+    neutral : int or array_like
+        Index of the neutral site of every game or -1.
+    is_playoff : bool or array_like
+        True for playoff games.
+
+    Returns
+    -------
+    MatchupPredictions
+    """
+    elo = np.asarray(elo, dtype=np.int64)
+    home = np.asarray(home, dtype=np.int64)
+    away = np.asarray(away, dtype=np.int64)
+    neutral = np.broadcast_to(np.asarray(neutral, dtype=np.int64), home.shape)
+    is_playoff = np.broadcast_to(np.asarray(is_playoff, dtype=bool), home.shape)
+
+    shift = np.asarray(table.pregame_elo_shift(home, away, neutral, is_playoff), dtype=np.int64)
+    home_elo = elo[home] + shift
+    away_elo = elo[away] - shift
+    elo_diff = home_elo - away_elo
+    return MatchupPredictions(home, away, neutral, is_playoff, shift, home_elo, away_elo,
+                              win_prob_batch(elo_diff), point_spread(elo_diff))
+
+def power_matrix(elo, table: DistanceTable, teams=None, is_playoff=False) -> MatchupPredictions:
+    """
+    Predicts every pairing of teams with the first team at home.
+
+    Parameters
+    ----------
+    elo : array_like
+        Current elo of every team in table order.
+    table : DistanceTable
+        Distance table of the teams.
+    teams : array_like, optional
+        Indices of the teams to pair up. Defaults to every team.
+    is_playoff : bool
+        Predict the pairings as playoff games.
+
+    Returns
+    -------
+    MatchupPredictions
+        (teams x teams) arrays, entry [i, j] is teams[i] hosting teams[j].
+        The diagonal is not a real game.
+    """
+    teams = np.arange(len(table)) if teams is None else np.asarray(teams, dtype=np.int64)
+    home, away = np.meshgrid(teams, teams, indexing="ij")
+    return predict_matchups(elo, table, home, away, is_playoff=is_playoff)
@@ -0,0 +1,460 @@
+"""
+This module keeps an in-memory snapshot of the team ratings for serving
+predictions.
+
+The snapshot holds the Team collection as arrays, the distance table and
+the predictions of every week that has been requested, so a request only
+touches the database the first time a week is asked for. Seasons and weeks
+are validated before anything is read or cached and at most MAX_WEEKS weeks
+are kept, so requests can't grow the snapshot without limit. elo_sim calls
+invalidate() after it writes new ratings. Other processes notice new
+ratings by comparing the id of the latest EloCheckpoint with the snapshot's,
+which is checked at most once every max_age seconds.
+
+The rating history for charts is loaded the first time it is requested,
+from the file written by elo_sim or else from the checkpoints.
+
+The coroutines at the end are used by the async views. Database reads run
+in a thread pool so a worker can serve other requests while they wait, and
+a week's games are fetched at the same time as the snapshot is refreshed.
+"""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from asgiref.sync import sync_to_async
+
+from ..models import Game, EloCheckpoint, ensure_connection
+from ..utils.init_db import divisions
+from .distance_table import DistanceTable
+from .elo_engine import (TeamArrays, load_team_arrays, season_code, season_name, week_code,
+                         week_name, PLAYOFF_WEEK_NAMES)
+from .rating_history import RatingHistory, load_history
+from .spreads import spread_predictions
+from .matchups import predict_matchups, power_matrix
+from .elo_model import win_prob, point_spread
+
+# teams currently in the league, relocated franchises are left out
+ACTIVE_TICKERS = {ticker for tickers in divisions.values() for ticker in tickers}
+# most games accepted by RatingSnapshot.matchups
+MAX_MATCHUPS = 5000
+# most weeks whose predictions and spreads are kept by a snapshot
+MAX_WEEKS = 256
+# last regular season week
+LAST_WEEK = 18
+
+
+def week_key(season: str, week: str) -> tuple[str, str]:
+    """
+    Validates a season and week from a request, which must be written the
+    way they are stored in the database.
+
+    Raises
+    ------
+    ValueError
+        If season isn't like 2022-2023 or week isn't a regular season week
+        from 1 to LAST_WEEK or a playoff round.
+    """
+    try:
+        code = week_code(week)
+        valid = season_name(season_code(season)) == season and week_name(code) == week
+    except (ValueError, KeyError, TypeError):
+        valid = False
+    if not valid or not (1 <= code <= LAST_WEEK or code in PLAYOFF_WEEK_NAMES):
+        raise ValueError(f"unknown week {week!r} of {season!r}")
+    return season, week
+
+def playoff_flag(value) -> bool:
+    """
+    Reads the playoff flag of a game. Only booleans and the strings 'true'
+    and 'false' are accepted, so a JSON "false" isn't taken as True.
+
+    Raises
+    ------
+    ValueError
+        For any other value.
+    """
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    raise ValueError(f"playoff must be true or false, got {value!r}")
+
+def _cache(cache: OrderedDict, key, value) -> None:
+    "Adds value to cache and drops the least recently added entries beyond MAX_WEEKS."
+    cache[key] = value
+    while len(cache) > MAX_WEEKS:
+        cache.popitem(last=False)
+
+
+class RatingSnapshot:
+    """
+    Ratings and distance table at one point in time.
+
+    Attributes
+    ----------
+    teams : TeamArrays
+        Teams and their elo.
+    table : DistanceTable
+        Distances and pregame elo shifts between the teams.
+    version : ObjectId or None
+        Id of the latest EloCheckpoint when the snapshot was loaded.
+    checked_at : float
+        time.monotonic() of the last time the version was confirmed.
+    history : RatingHistory or None
+        Weekly elo of every team, see load_history.
+    """
+
+    def __init__(self, teams: TeamArrays, version=None):
+        self.teams = teams
+        self.version = version
+        self.checked_at = time.monotonic()
+        self.table = DistanceTable(teams.latitude, teams.longitude, teams.ids)
+        self.by_ticker = {ticker: i for i, ticker in enumerate(teams.tickers)}
+        self._weeks = OrderedDict()
+        # one matrix per value of is_playoff
+        self._power = {}
+        self._spreads = OrderedDict()
+        self.history = None
+
+    def team_index(self, ticker: str) -> int:
+        "Finds a team by ticker. Raises ValueError for unknown tickers."
+        try:
+            return self.by_ticker[ticker.upper()]
+        except (KeyError, AttributeError):
+            raise ValueError(f"unknown team {ticker!r}") from None
+
+    def ratings(self) -> list[dict]:
+        "Elo of every active team, highest first."
+        teams = self.teams
+        ratings = [
+            {"name": teams.names[i], "ticker": teams.tickers[i], "elo": int(teams.elo[i])}
+            for i in range(len(teams)) if teams.tickers[i] in ACTIVE_TICKERS
+        ]
+        return sorted(ratings, key=lambda team: -team["elo"])
+
+    def _prediction(self, h, a, home_elo, away_elo, shift) -> dict:
+        elo_diff = home_elo - away_elo
+        return {
+            "home": self.teams.tickers[h],
+            "away": self.teams.tickers[a],
+            "elo_shift": shift,
+            "home_pregame_elo": home_elo,
+            "away_pregame_elo": away_elo,
+            "home_win_prob": win_prob(elo_diff),
+            "spread": point_spread(elo_diff),
+        }
+
+    def matchup(self, home: str, away: str, neutral: str = None, is_playoff: bool = False) -> dict:
+        """
+        Predicts a game between two teams with their current ratings.
+
+        Parameters
+        ----------
+        home, away : str
+            Tickers of the home and away teams.
+        neutral : str, optional
+            Ticker of the team whose stadium is the neutral site.
+        is_playoff : bool
+            True for playoff games.
+
+        Returns
+        -------
+        dict
+            Pregame elos, home win probability and spread.
+        """
+        return self.matchups([(home, away, neutral, is_playoff)])[0]
+
+    def matchups(self, games) -> list[dict]:
+        """
+        Predicts many games in one vectorized pass, see matchups.predict_matchups.
+
+        Parameters
+        ----------
+        games : list
+            (home, away, neutral, is_playoff) tuples or dicts with 'home',
+            'away' and optional 'neutral' and 'playoff' keys. Teams are
+            tickers, neutral and is_playoff may be left out of tuples.
+            is_playoff must be a boolean or 'true' or 'false', see
+            playoff_flag.
+
+        Returns
+        -------
+        list[dict]
+            Prediction of every game, same format as matchup.
+        """
+        if len(games) > MAX_MATCHUPS:
+            raise ValueError(f"at most {MAX_MATCHUPS} games can be predicted at once")
+        home, away, neutral, is_playoff = [], [], [], []
+        for game in games:
+            if isinstance(game, dict):
+                game = (game.get("home"), game.get("away"), game.get("neutral"), game.get("playoff", False))
+            elif not isinstance(game, (list, tuple)) or not 2 <= len(game) <= 4:
+                raise ValueError(f"invalid game {game!r}")
+            game = tuple(game) + (None, False)[len(game) - 2:]
+            h, a = self.team_index(game[0]), self.team_index(game[1])
+            if h == a:
+                raise ValueError("a team can't play itself")
+            home.append(h)
+            away.append(a)
+            neutral.append(-1 if game[2] is None else self.team_index(game[2]))
+            is_playoff.append(playoff_flag(game[3]))
+
+        result = predict_matchups(self.teams.elo, self.table, home, away, neutral, is_playoff)
+        tickers = self.teams.tickers
+        return [
+            {
+                "home": tickers[h], "away": tickers[a], "elo_shift": shift,
+                "home_pregame_elo": home_elo, "away_pregame_elo": away_elo,
+                "home_win_prob": prob, "spread": spread,
+                "neutral": None if site < 0 else tickers[site], "playoff": playoff,
+            }
+            for h, a, site, playoff, shift, home_elo, away_elo, prob, spread in zip(*(
+                column.tolist() for column in result))
+        ]
+
+    def power_matrix(self, is_playoff: bool = False) -> dict:
+        """
+        Home win probability and spread of every pairing of active teams,
+        see matchups.power_matrix. The matrix is only calculated once per
+        snapshot.
+
+        Returns
+        -------
+        dict
+            'teams' holds the tickers in alphabetical order, entry [i][j]
+            of 'home_win_prob' and 'spread' is teams[i] hosting teams[j].
+            The diagonal is None.
+        """
+        is_playoff = playoff_flag(is_playoff)
+        if is_playoff not in self._power:
+            tickers = sorted(ticker for ticker in self.teams.tickers if ticker in ACTIVE_TICKERS)
+            result = power_matrix(self.teams.elo, self.table,
+                                  [self.by_ticker[ticker] for ticker in tickers], is_playoff)
+            diagonal = np.eye(len(tickers), dtype=bool)
+            self._power[is_playoff] = {
+                "teams": tickers,
+                "playoff": is_playoff,
+                "home_win_prob": np.where(diagonal, None, result.home_win_prob).tolist(),
+                "spread": np.where(diagonal, None, result.spread).tolist(),
+            }
+        return self._power[is_playoff]
+
+    def load_history(self) -> RatingHistory:
+        "Loads the rating history if it hasn't been loaded yet."
+        if self.history is None:
+            try:
+                self.history = RatingHistory.load(mmap_mode="r")
+            except FileNotFoundError:
+                ensure_connection()
+                self.history = load_history(self.teams.ids)
+        return self.history
+
+    def team_history(self, ticker: str, start: str = None, end: str = None) -> dict:
+        """
+        Elo of a team after every week, see RatingHistory.series. The
+        history must already be loaded.
+
+        Parameters
+        ----------
+        ticker : str
+            Ticker of the team.
+        start, end : str, optional
+            First and last season included ex. 2022-2023. Defaults to every
+            season.
+        """
+        team_id = self.teams.ids[self.team_index(ticker)]
+        if team_id not in self.history.index:
+            raise ValueError(f"no history for team {ticker!r}")
+        keys, elo = self.history.series(
+            [team_id], None if start is None else (start, 0), None if end is None else (end, 99))
+        return {
+            "ticker": self.teams.tickers[self.team_index(ticker)],
+            "seasons": [season_name(season) for season in (keys // 100).tolist()],
+            "weeks": [week_name(week) for week in (keys % 100).tolist()],
+            "elo": elo[:, 0].tolist(),
+        }
+
+    def predict_games(self, records) -> list[dict]:
+        """
+        Predicts raw game documents. Games that have been played and
+        simulated keep the pregame elos stored by elo_sim, the rest use the
+        current ratings.
+        """
+        index = self.teams.index
+        elo = self.teams.elo
+        predictions = []
+        for r in records:
+            h, a = index[r["home_team"]], index[r["away_team"]]
+            neutral_dest = r.get("neutral_destination")
+            site = -1 if neutral_dest is None else index[neutral_dest]
+            shift = self.table.pregame_elo_shift(h, a, site, not r["week"].isdigit())
+            home_elo, away_elo = r.get("home_pregame_elo"), r.get("away_pregame_elo")
+            if not home_elo or not away_elo:
+                home_elo, away_elo = int(elo[h]) + shift, int(elo[a]) - shift
+            prediction = self._prediction(h, a, home_elo, away_elo, shift)
+            prediction["home_points"] = r.get("home_points")
+            prediction["away_points"] = r.get("away_points")
+            predictions.append(prediction)
+        return predictions
+
+    def week_predictions(self, season: str, week: str) -> list[dict]:
+        """
+        Predicts every game of a week. The games are read from the database
+        the first time a week is requested.
+
+        Parameters
+        ----------
+        season : str
+            Season ex. 2022-2023.
+        week : str
+            Week number or playoff round ex. WildCard.
+
+        Raises
+        ------
+        ValueError
+            If the week is invalid, see week_key.
+        """
+        season, week = week_key(season, week)
+        predictions = self.cached_week(season, week)
+        if predictions is None:
+            predictions = self.add_week(season, week, load_week_games(season, week))
+        return predictions
+
+    def week_spreads(self, season: str, week: str) -> dict:
+        """
+        Spreads and margin of victory distributions of every game of a
+        week, see spreads.spread_predictions. They are calculated in one
+        batch the first time a week is requested.
+        """
+        season, week = week_key(season, week)
+        spreads = self._spreads.get((season, week))
+        if spreads is None:
+            spreads = spread_predictions(self.week_predictions(season, week))
+            if spreads["games"]:
+                _cache(self._spreads, (season, week), spreads)
+        return spreads
+
+    def cached_week(self, season: str, week: str):
+        "Predictions of a week if they have already been made, otherwise None."
+        return self._weeks.get((season, week))
+
+    def add_week(self, season: str, week: str, games) -> list[dict]:
+        """
+        Predicts the raw game documents of a validated week, see week_key,
+        and caches the predictions unless the week has no games.
+        """
+        predictions = self.predict_games(games)
+        if predictions:
+            _cache(self._weeks, (season, week), predictions)
+        return predictions
+
+
+_snapshot = None
+_lock = threading.Lock()
+
+def load_week_games(season: str, week: str) -> list[dict]:
+    "Reads the raw game documents of a week."
+    ensure_connection()
+    return list(Game.objects.week(season, week))
+
+def current_version():
+    "Id of the latest EloCheckpoint or None."
+    ensure_connection()
+    latest = EloCheckpoint.objects.order_by("-last_game").only("id").as_pymongo().first()
+    return None if latest is None else latest["_id"]
+
+def load_snapshot(version=None) -> RatingSnapshot:
+    "Loads a new snapshot from the database."
+    ensure_connection()
+    return RatingSnapshot(load_team_arrays(), version)
+
+def fresh_snapshot(max_age: float = 30.0):
+    "Returns the current snapshot if it has been checked in the last max_age seconds, otherwise None."
+    snapshot = _snapshot
+    if snapshot is not None and time.monotonic() - snapshot.checked_at < max_age:
+        return snapshot
+    return None
+
+def get_snapshot(max_age: float = 30.0) -> RatingSnapshot:
+    """
+    Returns the current snapshot, loading it on the first call. After
+    max_age seconds the version is checked against the database and the
+    snapshot is reloaded if elo_sim has written new ratings since.
+    """
+    global _snapshot
+    snapshot = fresh_snapshot(max_age)
+    if snapshot is not None:
+        return snapshot
+
+    with _lock:
+        snapshot = _snapshot
+        if snapshot is not None and time.monotonic() - snapshot.checked_at < max_age:
+            return snapshot
+        # read the version first so ratings written while loading trigger
+        # another reload on the next check
+        version = current_version()
+        if snapshot is None or version != snapshot.version:
+            snapshot = load_snapshot(version)
+        else:
+            snapshot.checked_at = time.monotonic()
+        _snapshot = snapshot
+        return snapshot
+
+def invalidate() -> None:
+    "Drops the snapshot so the next request loads the new ratings."
+    global _snapshot
+    with _lock:
+        _snapshot = None
+
+
+async def aget_snapshot(max_age: float = 30.0) -> RatingSnapshot:
+    "Async version of get_snapshot. Only waits on the thread pool when the snapshot needs checking."
+    snapshot = fresh_snapshot(max_age)
+    if snapshot is not None:
+        return snapshot
+    return await sync_to_async(get_snapshot, thread_sensitive=False)(max_age)
+
+async def ateam_history(ticker: str, start: str = None, end: str = None,
+                        max_age: float = 30.0) -> dict:
+    "Async version of RatingSnapshot.team_history that loads the history if needed."
+    snapshot = await aget_snapshot(max_age)
+    if snapshot.history is None:
+        await sync_to_async(snapshot.load_history, thread_sensitive=False)()
+    return snapshot.team_history(ticker, start, end)
+
+async def _aweek(season: str, week: str, max_age: float) -> RatingSnapshot:
+    """
+    Returns a snapshot and the predictions of a validated week, see
+    week_key. When the week isn't cached its games are read while the
+    snapshot is being checked.
+    """
+    snapshot = fresh_snapshot(max_age)
+    if snapshot is not None:
+        predictions = snapshot.cached_week(season, week)
+        if predictions is not None:
+            return snapshot, predictions
+
+    snapshot, games = await asyncio.gather(
+        aget_snapshot(max_age),
+        sync_to_async(load_week_games, thread_sensitive=False)(season, week),
+    )
+    predictions = snapshot.cached_week(season, week)
+    if predictions is None:
+        predictions = snapshot.add_week(season, week, games)
+    return snapshot, predictions
+
+async def aweek_predictions(season: str, week: str, max_age: float = 30.0) -> list[dict]:
+    "Async version of RatingSnapshot.week_predictions."
+    _, predictions = await _aweek(*week_key(season, week), max_age)
+    return predictions
+
+async def aweek_spreads(season: str, week: str, max_age: float = 30.0) -> dict:
+    "Async version of RatingSnapshot.week_spreads."
+    snapshot, predictions = await _aweek(*week_key(season, week), max_age)
+    if not predictions:
+        return spread_predictions(predictions)
+    return snapshot.week_spreads(season, week)
@@ -0,0 +1,280 @@
+"""
+This module contains the per-team, per-week rating history.
+
+The history is a (weeks x teams) elo matrix with a sorted key per week,
+key = season * 100 + week code, so the rating of a team as of any week is a
+binary search and the ratings between two weeks are a slice. It is built
+from a replay or from the EloCheckpoint collection and is stored on disk as
+.npy files next to a meta.json file, like the game snapshot in
+utils.game_cache.
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+from ..storage import Storage, get_storage
+from ..utils.game_cache import CACHE_DIR, _id_type, _restore_ids
+from .elo_engine import GameArrays, ReplayResult, season_code, week_code
+
+HISTORY_DIR = os.path.join(CACHE_DIR, "rating_history")
+
+# bump when the layout of the saved history changes
+HISTORY_VERSION = 1
+
+
+def history_key(season, week) -> int:
+    """
+    Chronological key of a week.
+
+    Parameters
+    ----------
+    season : str or int
+        Season ex. 2022-2023 or its starting year.
+    week : str or int
+        Week number or playoff round ex. WildCard, or a week code.
+    """
+    season = season_code(season) if isinstance(season, str) else int(season)
+    week = week_code(week) if isinstance(week, str) else int(week)
+    return season * 100 + week
+
+
+class RatingHistory:
+    """
+    Elo of every team after every week.
+
+    Attributes
+    ----------
+    team_ids : list
+        Database ids of the teams, the column order of elo.
+    index : dict
+        Maps team ids to their column in elo.
+    keys : np.ndarray
+        Sorted history_key of every week.
+    elo : np.ndarray
+        (weeks x teams) elo of every team after the games of the week.
+    initial_elo : np.ndarray
+        Elo of every team before the first week.
+    """
+
+    def __init__(self, team_ids, keys, elo, initial_elo=None):
+        self.team_ids = list(team_ids)
+        self.index = {team_id: i for i, team_id in enumerate(self.team_ids)}
+        self.keys = np.asarray(keys, dtype=np.int64)
+        self.elo = np.asarray(elo, dtype=np.int32).reshape(len(self.keys), len(self.team_ids))
+        if initial_elo is None:
+            initial_elo = np.full(len(self.team_ids), 1505)
+        self.initial_elo = np.asarray(initial_elo, dtype=np.int32)
+        if np.any(np.diff(self.keys) <= 0):
+            raise ValueError("weeks must be in chronological order")
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def seasons(self) -> np.ndarray:
+        "Season of every week."
+        return self.keys // 100
+
+    @property
+    def weeks(self) -> np.ndarray:
+        "Week code of every week."
+        return self.keys % 100
+
+    @classmethod
+    def from_replay(cls, games: GameArrays, result: ReplayResult, initial_elo=None) -> "RatingHistory":
+        """
+        Builds the history of a replay, see elo_engine.replay.
+
+        Parameters
+        ----------
+        games : GameArrays
+            Games that were replayed.
+        result : ReplayResult
+            Output of the replay.
+        initial_elo : array_like, optional
+            Elo of every team before the replay.
+        """
+        ends = result.week_end
+        keys = games.season[ends].astype(np.int64) * 100 + games.week[ends]
+        return cls(games.teams.ids, keys, result.weekly_elo, initial_elo)
+
+    @classmethod
+    def from_checkpoints(cls, checkpoints, team_ids, initial_elo=None) -> "RatingHistory":
+        """
+        Builds the history from raw EloCheckpoint documents. A week that was
+        replayed in several runs has several checkpoints, the last one holds
+        the elos after all of its games.
+
+        Parameters
+        ----------
+        checkpoints : iterable of dict
+            Checkpoints in chronological order.
+        team_ids : list
+            Teams of the history. Teams missing from a checkpoint keep
+            their previous elo.
+        initial_elo : array_like, optional
+            Elo of every team before the first checkpoint.
+        """
+        history = cls(team_ids, [], np.empty((0, len(team_ids))), initial_elo)
+        keys, rows = [], []
+        elo = history.initial_elo.copy()
+        for checkpoint in checkpoints:
+            elo = elo.copy()
+            for team_id, team_elo in zip(checkpoint["team_ids"], checkpoint["elos"]):
+                if team_id in history.index:
+                    elo[history.index[team_id]] = team_elo
+            key = history_key(checkpoint["season"], checkpoint["week"])
+            if keys and keys[-1] == key:
+                rows[-1] = elo
+            else:
+                keys.append(key)
+                rows.append(elo)
+        if rows:
+            history = cls(team_ids, keys, np.stack(rows), initial_elo)
+        return history
+
+    def extend(self, other: "RatingHistory") -> "RatingHistory":
+        """
+        Returns the history followed by the weeks of other, which must start
+        from the last ratings of the history. Weeks of the history that other
+        starts at or before are replaced, so the rest of a week that was
+        already partly replayed overwrites it.
+        """
+        if other.team_ids != self.team_ids:
+            raise ValueError("histories have different teams")
+        last = self.elo[-1] if len(self) else self.initial_elo
+        if not np.array_equal(last, other.initial_elo):
+            raise ValueError("other doesn't start from the last ratings of the history")
+        keep = int(np.searchsorted(self.keys, other.keys[0], side="left")) if len(other) else len(self)
+        return RatingHistory(self.team_ids, np.concatenate([self.keys[:keep], other.keys]),
+                             np.concatenate([self.elo[:keep], other.elo]), self.initial_elo)
+
+    def _row(self, season, week) -> int:
+        "Row of the last week at or before (season, week), -1 if it is before the first week."
+        return int(np.searchsorted(self.keys, history_key(season, week), side="right")) - 1
+
+    def ratings_as_of(self, season, week) -> np.ndarray:
+        "Elo of every team after the games of (season, week) or the latest week before it."
+        row = self._row(season, week)
+        return self.initial_elo.copy() if row < 0 else self.elo[row].copy()
+
+    def rating(self, team_id, season, week) -> int:
+        "Elo of one team after the games of (season, week) or the latest week before it."
+        row = self._row(season, week)
+        column = self.index[team_id]
+        return int(self.initial_elo[column] if row < 0 else self.elo[row, column])
+
+    def series(self, team_ids=None, start=None, end=None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Ratings between two weeks for charting.
+
+        Parameters
+        ----------
+        team_ids : list, optional
+            Teams to include, defaults to every team.
+        start, end : tuple, optional
+            (season, week) of the first and last week, both included.
+            Defaults to the whole history.
+
+        Returns
+        -------
+        tuple[np.ndarray, np.ndarray]
+            Keys of the weeks and the (weeks x teams) elo.
+        """
+        lo = 0 if start is None else int(np.searchsorted(self.keys, history_key(*start), side="left"))
+        hi = len(self.keys) if end is None else int(np.searchsorted(self.keys, history_key(*end), side="right"))
+        elo = self.elo[lo:hi]
+        if team_ids is not None:
+            elo = elo[:, [self.index[team_id] for team_id in team_ids]]
+        return self.keys[lo:hi], elo
+
+    def save(self, path: str = HISTORY_DIR) -> None:
+        "Writes the history to a directory, replacing it atomically."
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, "keys.npy"), self.keys)
+        np.save(os.path.join(tmp_path, "elo.npy"), self.elo)
+        np.save(os.path.join(tmp_path, "initial_elo.npy"), self.initial_elo)
+        meta = {
+            "version": HISTORY_VERSION,
+            "team_id_type": _id_type(self.team_ids),
+            "team_ids": [str(i) for i in self.team_ids],
+        }
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = HISTORY_DIR, mmap_mode: str = None) -> "RatingHistory":
+        """
+        Loads a history written by save.
+
+        Raises
+        ------
+        FileNotFoundError
+            If there is no history with the current version at path.
+        """
+        try:
+            with open(os.path.join(path, "meta.json"), "r") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = None
+        if meta is None or meta.get("version") != HISTORY_VERSION:
+            raise FileNotFoundError(f"no rating history found at {path}")
+
+        def column(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+
+        return cls(_restore_ids(meta["team_ids"], meta["team_id_type"]),
+                   column("keys"), column("elo"), column("initial_elo"))
+
+
+def load_history(team_ids, storage: Storage = None, initial_elo=None) -> RatingHistory:
+    "Builds the history from the checkpoints in storage."
+    return RatingHistory.from_checkpoints(get_storage(storage).checkpoint_records(), team_ids,
+                                          initial_elo)
+
+def save_history(games: GameArrays, result: ReplayResult, storage: Storage = None,
+                 initial_elo=None, path: str = HISTORY_DIR):
+    """
+    Writes the rating history of a replay to path. Call it after the
+    checkpoints of the replay have been written.
+
+    Parameters
+    ----------
+    games : GameArrays
+        Games that were replayed.
+    result : ReplayResult
+        Output of the replay.
+    storage : Storage, optional
+        Storage that was simulated. Nothing is written for storage that
+        isn't cacheable, load_history builds its history from the
+        checkpoints.
+    initial_elo : np.ndarray, optional
+        Elo an incremental replay started from. The replayed weeks are
+        appended to the saved history if it ends with these elos, otherwise
+        the history is rebuilt from the checkpoints.
+    path : str
+        History directory.
+
+    Returns
+    -------
+    RatingHistory or None
+        The written history.
+    """
+    storage = get_storage(storage)
+    if not storage.cacheable:
+        return None
+    history = RatingHistory.from_replay(games, result, initial_elo)
+    if initial_elo is not None:
+        try:
+            history = RatingHistory.load(path).extend(history)
+        except (FileNotFoundError, ValueError):
+            history = load_history(games.teams.ids, storage)
+    history.save(path)
+    return history
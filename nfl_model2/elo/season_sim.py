@@ -0,0 +1,298 @@
+"""
+This module contains a Monte Carlo simulator for the rest of a season.
+
+Starting from the current team elos and standings, every remaining game is
+sampled with win_prob and the ratings are updated in-sim with the
+post_game_elo_shift logic. The regular season is followed by the playoffs
+(7 teams per conference, top seed gets a bye, reseeding after the wild card
+round). All simulations are run at once as numpy arrays and batches of
+simulations can be spread across a process pool.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
+import numpy as np
+
+from ..models import Team, Game, connect_to_database
+from ..utils.init_db import divisions, superbowl_locations
+from .distance_table import DistanceTable, get_distance_table
+from .elo_engine import TeamArrays
+from .elo_model import win_prob_batch, post_game_elo_shift_batch
+
+
+class SeasonSimResult(NamedTuple):
+    """
+    Probabilities of every team reaching each stage of the season.
+    Teams that aren't in a division have probabilities of 0.
+    """
+    n_sims: int
+    mean_wins: np.ndarray
+    make_playoffs: np.ndarray
+    win_division: np.ndarray
+    win_conference: np.ndarray
+    win_superbowl: np.ndarray
+
+
+def division_index(tickers) -> np.ndarray:
+    """
+    Finds the division of every team.
+
+    Parameters
+    ----------
+    tickers : list[str]
+        Team tickers in team index order.
+
+    Returns
+    -------
+    np.ndarray
+        Index of every team's division in init_db.divisions or -1 for teams
+        that aren't in a division, for example relocated franchises.
+    """
+    lookup = {}
+    for i, tickers_in_division in enumerate(divisions.values()):
+        for ticker in tickers_in_division:
+            lookup[ticker] = i
+    return np.array([lookup.get(ticker, -1) for ticker in tickers], dtype=np.int64)
+
+def _play(elo, home, away, shift, rng, margin):
+    """
+    Samples one game in every simulation and updates elo in place.
+    elo has shape (n_teams, n_sims), home, away and shift are either
+    scalars or arrays with one value per simulation.
+
+    Returns a boolean array that is True where the home team won.
+    """
+    if np.ndim(home) == 0:
+        sims = slice(None)
+    else:
+        sims = np.arange(elo.shape[1])
+    home_elo = elo[home, sims] + shift
+    away_elo = elo[away, sims] - shift
+    win_probability = win_prob_batch(home_elo - away_elo)
+    home_win = rng.random(elo.shape[1]) < win_probability
+
+    # the winner is given a win by margin points
+    home_points = np.where(home_win, margin, 0)
+    away_points = np.where(home_win, 0, margin)
+    post_shift = post_game_elo_shift_batch(home_elo, away_elo, home_points, away_points,
+                                           win_probability=win_probability)
+    elo[home, sims] = home_elo + post_shift
+    elo[away, sims] = away_elo - post_shift
+    return home_win
+
+def _playoff_round(elo, table, teams, seeds, pairs, rng, margin):
+    """
+    Plays one playoff round for one conference. pairs is a list of
+    (home column, away column) into teams and seeds. Returns the winning
+    teams and seeds with one column per game.
+    """
+    winners, winner_seeds = [], []
+    for home_col, away_col in pairs:
+        home, away = teams[:, home_col], teams[:, away_col]
+        home_win = _play(elo, home, away, table.playoff_shift[home, away], rng, margin)
+        winners.append(np.where(home_win, home, away))
+        winner_seeds.append(np.where(home_win, seeds[:, home_col], seeds[:, away_col]))
+    return np.stack(winners, axis=1), np.stack(winner_seeds, axis=1)
+
+def _sort_by_seed(teams, seeds):
+    order = np.argsort(seeds, axis=1)
+    return np.take_along_axis(teams, order, axis=1), np.take_along_axis(seeds, order, axis=1)
+
+def _simulate_batch(args):
+    """
+    Simulates a batch of seasons. Returns the number of times each team
+    reached every stage and the total number of wins of every team.
+    """
+    (elo, home, away, shifts, division, wins, table, superbowl_site,
+     margin, n_sims, seed) = args
+    rng = np.random.default_rng(seed)
+    n_teams = len(elo)
+
+    # elo is stored (teams x sims) so every game reads contiguous rows
+    elo = np.repeat(np.asarray(elo, dtype=np.float64)[:, None], n_sims, axis=1)
+    sim_wins = np.repeat(np.asarray(wins, dtype=np.float64)[:, None], n_sims, axis=1)
+
+    # regular season
+    for h, a, shift in zip(home.tolist(), away.tolist(), shifts.tolist()):
+        home_win = _play(elo, h, a, shift, rng, margin)
+        sim_wins[h] += home_win
+        sim_wins[a] += ~home_win
+
+    counts = {stage: np.zeros(n_teams, dtype=np.int64)
+              for stage in ("make_playoffs", "win_division", "win_conference", "win_superbowl")}
+    # random tie breaker, smaller than half a win so it only splits ties
+    standing = (sim_wins + rng.random(sim_wins.shape) * 0.25).T
+    conference = np.where(division >= 0, division // 4, -1)
+    n_divisions = len(divisions)
+    champions = []
+    for conf in range(n_divisions // 4):
+        division_winners = []
+        for div in range(conf * 4, conf * 4 + 4):
+            members = np.flatnonzero(division == div)
+            division_winners.append(members[np.argmax(standing[:, members], axis=1)])
+        division_winners = np.stack(division_winners, axis=1)
+
+        # seeds 1-4 are the division winners ordered by record
+        order = np.argsort(-np.take_along_axis(standing, division_winners, axis=1), axis=1)
+        division_winners = np.take_along_axis(division_winners, order, axis=1)
+
+        # seeds 5-7 are the best remaining teams in the conference
+        wild_card_standing = np.where(conference == conf, standing, -np.inf)
+        np.put_along_axis(wild_card_standing, division_winners, -np.inf, axis=1)
+        wild_cards = np.argsort(-wild_card_standing, axis=1)[:, :3]
+
+        teams = np.concatenate([division_winners, wild_cards], axis=1)
+        seeds = np.broadcast_to(np.arange(7), teams.shape)
+        np.add.at(counts["make_playoffs"], teams.ravel(), 1)
+        np.add.at(counts["win_division"], division_winners.ravel(), 1)
+
+        # wild card round, the top seed has a bye
+        winners, winner_seeds = _playoff_round(elo, table, teams, seeds,
+                                               [(1, 6), (2, 5), (3, 4)], rng, margin)
+        teams = np.concatenate([teams[:, :1], winners], axis=1)
+        seeds = np.concatenate([seeds[:, :1], winner_seeds], axis=1)
+        # divisional round, the best remaining seed hosts the worst
+        teams, seeds = _sort_by_seed(teams, seeds)
+        teams, seeds = _playoff_round(elo, table, teams, seeds, [(0, 3), (1, 2)], rng, margin)
+        # conference championship
+        teams, seeds = _sort_by_seed(teams, seeds)
+        teams, seeds = _playoff_round(elo, table, teams, seeds, [(0, 1)], rng, margin)
+        np.add.at(counts["win_conference"], teams[:, 0], 1)
+        champions.append(teams[:, 0])
+
+    # super bowl at a neutral site
+    home, away = champions
+    shift = 0
+    if superbowl_site >= 0:
+        shift = table.travel_shift[away, superbowl_site] - table.travel_shift[home, superbowl_site]
+    home_win = _play(elo, home, away, shift, rng, margin)
+    np.add.at(counts["win_superbowl"], np.where(home_win, home, away), 1)
+
+    return counts, sim_wins.sum(axis=1)
+
+def superbowl_site(season: str, teams: TeamArrays) -> int:
+    """
+    Team index of the stadium hosting the super bowl of a season, the same
+    site the ingest gives the super bowl game, or -1 if it isn't known.
+
+    Parameters
+    ----------
+    season : str
+        Season ex. 2022-2023, its super bowl is played in the second year.
+    teams : TeamArrays
+        Teams to look the host up in.
+    """
+    host = superbowl_locations.get(season[5:])
+    if host not in teams.names:
+        return -1
+    return teams.names.index(host)
+
+def simulate_seasons(elo, home, away, division, table: DistanceTable, wins=None,
+                     n_sims=100000, seed=None, n_workers=1, batch_size=10000,
+                     superbowl_site=-1, margin=7) -> SeasonSimResult:
+    """
+    Simulates the rest of a season many times.
+
+    Parameters
+    ----------
+    elo : array_like
+        Current elo of every team.
+    home, away : array_like
+        Team indices of the remaining regular season games in order.
+    division : np.ndarray
+        Division index of every team, see division_index.
+    table : DistanceTable
+        Distance table for the teams, used for the pregame elo shifts.
+    wins : array_like, optional
+        Wins of every team so far, ties count as half a win. Defaults to 0.
+    n_sims : int
+        Number of seasons to simulate.
+    seed : int, optional
+        Seed of the random number generator. Every batch gets its own
+        stream spawned from the seed so the results don't depend on
+        n_workers.
+    n_workers : int
+        Number of processes used to simulate the batches.
+    batch_size : int
+        Number of seasons simulated at once by one worker.
+    superbowl_site : int
+        Team index of the super bowl location or -1 for no travel shift.
+    margin : int
+        Margin of victory used for the in-sim elo updates.
+
+    Returns
+    -------
+    SeasonSimResult
+    """
+    elo = np.asarray(elo, dtype=np.int64)
+    home = np.asarray(home, dtype=np.int64)
+    away = np.asarray(away, dtype=np.int64)
+    division = np.asarray(division, dtype=np.int64)
+    if wins is None:
+        wins = np.zeros(len(elo))
+    shifts = table.pregame_elo_shift(home, away)
+
+    sizes = [batch_size] * (n_sims // batch_size)
+    if n_sims % batch_size:
+        sizes.append(n_sims % batch_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    batches = [(elo, home, away, shifts, division, wins, table, superbowl_site, margin, size, batch_seed)
+               for size, batch_seed in zip(sizes, seeds)]
+
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_simulate_batch, batches))
+    else:
+        results = [_simulate_batch(batch) for batch in batches]
+
+    total_wins = sum(result[1] for result in results)
+    counts = {stage: sum(result[0][stage] for result in results) / n_sims
+              for stage in results[0][0]}
+    return SeasonSimResult(n_sims=n_sims, mean_wins=total_wins / n_sims, **counts)
+
+def run(season, n_sims=100000, n_workers=1, seed=None):
+    """
+    Simulates the rest of a season from the ratings in the database and
+    prints every team's playoff, division, conference and super bowl odds.
+    Games of the season without a score are the remaining schedule.
+
+    Parameters
+    ----------
+    season : str
+        Season to simulate ex. 2022-2023.
+    """
+    connect_to_database()
+
+    teams = TeamArrays.from_records(Team.objects.as_pymongo())
+    games = Game.objects.season_games(season, weeks=range(1, 19), fields=(
+        "home_team", "away_team", "home_points", "away_points"))
+
+    wins = np.zeros(len(teams))
+    home, away = [], []
+    for game in games:
+        h, a = teams.index[game["home_team"]], teams.index[game["away_team"]]
+        home_points, away_points = game.get("home_points"), game.get("away_points")
+        if home_points is None or away_points is None:
+            home.append(h)
+            away.append(a)
+        elif home_points == away_points:
+            wins[h] += 0.5
+            wins[a] += 0.5
+        else:
+            wins[h if home_points > away_points else a] += 1
+
+    table = get_distance_table(teams.latitude, teams.longitude, teams.ids)
+    result = simulate_seasons(teams.elo, home, away, division_index(teams.tickers), table,
+                              wins=wins, n_sims=n_sims, seed=seed, n_workers=n_workers,
+                              superbowl_site=superbowl_site(season, teams))
+
+    print(f"{'team':<25}{'wins':>6}{'playoffs':>10}{'division':>10}{'conf':>8}{'sb':>8}")
+    for i in np.argsort(-result.win_superbowl):
+        if division_index([teams.tickers[i]])[0] < 0:
+            continue
+        print(f"{teams.names[i]:<25}{result.mean_wins[i]:>6.1f}{result.make_playoffs[i]:>10.3f}"
+              f"{result.win_division[i]:>10.3f}{result.win_conference[i]:>8.3f}{result.win_superbowl[i]:>8.3f}")
+
+if __name__ == "__main__":
+    run(input("Season to simulate ex. 2022-2023: "))
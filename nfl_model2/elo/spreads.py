@@ -0,0 +1,157 @@
+"""
+This module turns elo differences into point spreads and margin of victory
+distributions.
+
+The expected home margin is the point spread, 25 elo points per point, see
+elo_model.point_spread. The actual margin is modelled as a normal
+distribution around it with a standard deviation of MARGIN_SD points, the
+root mean square error of the spreads over the 2011-2022 seasons (see
+fit_margin_sd). The distribution is discretized to whole point margins so
+the probability of covering any line is a sum over the table.
+"""
+
+import math
+from typing import NamedTuple
+
+import numpy as np
+
+from .elo_engine import GameArrays
+from .elo_model import point_spread
+
+MARGIN_SD = 13.5
+# margins beyond +-MAX_MARGIN are added to the end points of the table
+MAX_MARGIN = 50
+
+
+class MarginDistribution(NamedTuple):
+    """
+    Margin of victory distribution of many games.
+
+    Attributes
+    ----------
+    spread : np.ndarray
+        Expected home margin of every game.
+    sd : float
+        Standard deviation of the margins.
+    margins : np.ndarray
+        Whole point home margins from -MAX_MARGIN to MAX_MARGIN.
+    prob : np.ndarray
+        (games x margins) probability of every margin.
+    """
+    spread: np.ndarray
+    sd: float
+    margins: np.ndarray
+    prob: np.ndarray
+
+    def cover_prob(self, line) -> np.ndarray:
+        """
+        Probability that the home team wins by more than line points, with
+        line a number or one line per game. A push on a whole number line
+        counts as not covering.
+        """
+        line = np.broadcast_to(np.asarray(line, dtype=np.float64), self.spread.shape)
+        return np.sum(self.prob * (self.margins > line[:, None]), axis=1)
+
+    def push_prob(self, line) -> np.ndarray:
+        "Probability that the home margin equals line, zero for half point lines."
+        line = np.broadcast_to(np.asarray(line, dtype=np.float64), self.spread.shape)
+        return np.sum(self.prob * (self.margins == line[:, None]), axis=1)
+
+
+def _normal_cdf(x) -> np.ndarray:
+    x = np.asarray(x, dtype=np.float64)
+    values, inverse = np.unique(x.ravel(), return_inverse=True)
+    cdf = np.array([0.5*(1 + math.erf(value/math.sqrt(2))) for value in values.tolist()])
+    return cdf[inverse].reshape(x.shape)
+
+def margin_distribution(elo_diff, sd: float = MARGIN_SD,
+                        max_margin: int = MAX_MARGIN) -> MarginDistribution:
+    """
+    Margin of victory distribution of games with the given pregame elo
+    differences.
+
+    Parameters
+    ----------
+    elo_diff : array_like
+        Home pregame elo minus away pregame elo, pregame shifts included.
+    sd : float
+        Standard deviation of the margins.
+    max_margin : int
+        Largest margin in the table.
+
+    Returns
+    -------
+    MarginDistribution
+    """
+    spread = np.atleast_1d(point_spread(np.asarray(elo_diff, dtype=np.float64)))
+    margins = np.arange(-max_margin, max_margin + 1)
+    # every margin m covers (m - 0.5, m + 0.5) and the end points cover the tails
+    edges = np.concatenate([[-np.inf], margins[:-1] + 0.5, [np.inf]])
+    cdf = _normal_cdf((edges[None, :] - spread[:, None]) / sd)
+    return MarginDistribution(spread, sd, margins, np.diff(cdf, axis=1))
+
+def fit_margin_sd(games: GameArrays, home_pregame_elo=None, away_pregame_elo=None,
+                  skip_seasons: int = 1) -> float:
+    """
+    Root mean square error of the point spreads of past games, the
+    standard deviation to use in margin_distribution.
+
+    Parameters
+    ----------
+    games : GameArrays
+        Games in chronological order.
+    home_pregame_elo, away_pregame_elo : np.ndarray, optional
+        Pregame elos of every game. Default to the elos stored with the
+        games.
+    skip_seasons : int
+        Number of seasons at the start left out while the ratings settle.
+    """
+    if home_pregame_elo is None:
+        home_pregame_elo, away_pregame_elo = games.home_pregame_elo, games.away_pregame_elo
+    seasons = np.unique(games.season)
+    if skip_seasons >= len(seasons):
+        raise ValueError("no games left to fit")
+    fitted = games.season >= seasons[skip_seasons]
+    elo_diff = (np.asarray(home_pregame_elo) - np.asarray(away_pregame_elo))[fitted]
+    margin = (games.home_points - games.away_points)[fitted]
+    return float(np.sqrt(np.mean((margin - point_spread(elo_diff))**2)))
+
+def spread_predictions(predictions: list[dict], sd: float = MARGIN_SD,
+                       lines=(-7, -3, 0, 3, 7)) -> dict:
+    """
+    Adds margin distributions to game predictions, see
+    rating_cache.RatingSnapshot.predict_games.
+
+    Parameters
+    ----------
+    predictions : list[dict]
+        Predictions with home and away pregame elos.
+    sd : float
+        Standard deviation of the margins.
+    lines : tuple
+        Home lines the cover probabilities are given for.
+
+    Returns
+    -------
+    dict
+        'margins' holds the whole point home margins and 'games' the spread,
+        the probability of every margin and the cover probability of every
+        line of each game.
+    """
+    elo_diff = [prediction["home_pregame_elo"] - prediction["away_pregame_elo"]
+                for prediction in predictions]
+    distribution = margin_distribution(elo_diff, sd)
+    covers = {line: distribution.cover_prob(line).tolist() for line in lines}
+    games = [
+        {
+            "home": prediction["home"],
+            "away": prediction["away"],
+            "spread": spread,
+            "margin_sd": sd,
+            "margin_prob": prob,
+            "cover_prob": {str(line): covers[line][i] for line in lines},
+        }
+        for i, (prediction, spread, prob) in enumerate(zip(
+            predictions, distribution.spread.tolist(), distribution.prob.tolist()))
+    ]
+    return {"margins": distribution.margins.tolist(), "games": games}
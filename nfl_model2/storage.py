@@ -0,0 +1,363 @@
+"""
+This module contains the storage backends used by the scripts.
+
+Scripts read and write the Team, Game, EloCheckpoint and NNData collections
+through a Storage object instead of the mongoengine documents directly.
+MongoStorage is the MongoDB database and MemoryStorage keeps raw documents
+in dictionaries, so simulations and feature builds can run locally without
+a database. A MemoryStorage can be pickled and sent to other processes.
+
+Documents are exchanged as raw dicts shaped like the output of
+QuerySet.as_pymongo().
+"""
+
+import hashlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from .models import Team, Game, GameFlat, EloCheckpoint, NNData
+from .utils.bulk_writer import BulkWriter
+from .utils.flat_games import from_flat_record, read_flat_games, team_refs, write_flat_games
+
+
+class Storage:
+    """
+    Interface of the storage backends.
+
+    Attributes
+    ----------
+    cacheable : bool
+        True if game_cache should keep a local snapshot of the games
+        because reading them is slow.
+    """
+
+    cacheable = False
+
+    def team_records(self) -> list[dict]:
+        "Every team document."
+        raise NotImplementedError
+
+    def insert_teams(self, records: list[dict]) -> list:
+        "Inserts team documents and returns their ids."
+        raise NotImplementedError
+
+    def set_team_elos(self, team_ids, elos) -> None:
+        "Sets the elo of every team in team_ids."
+        raise NotImplementedError
+
+    def game_records(self, after=None) -> list[dict]:
+        """
+        Game documents in id order without the day and bye fields. Only games
+        inserted after the game with id after are returned if it is given.
+        """
+        raise NotImplementedError
+
+    def game_records_with_teams(self, after=None) -> tuple[list[dict], dict]:
+        """
+        Game documents, see game_records, and the team locations stored
+        with the games as dicts with 'latitude' and 'longitude' keys by team
+        id. The locations are empty if the games only reference their teams.
+        """
+        return self.game_records(after), {}
+
+    def upsert_games(self, records, team_ids: dict) -> tuple[int, int]:
+        """
+        Upserts game records, see ingest.game_upsert. Returns the number of
+        inserted and modified games. Inserted and modified games get a new
+        'updated' time.
+        """
+        raise NotImplementedError
+
+    def set_pregame_elos(self, game_ids, home_pregame_elo, away_pregame_elo) -> None:
+        "Sets the pregame elos of every game in game_ids."
+        raise NotImplementedError
+
+    def latest_checkpoint(self):
+        "The EloCheckpoint with the latest last_game or None."
+        raise NotImplementedError
+
+    def checkpoint_records(self) -> list[dict]:
+        "Every EloCheckpoint document sorted by last_game."
+        raise NotImplementedError
+
+    def insert_checkpoints(self, checkpoints: list[EloCheckpoint]) -> None:
+        raise NotImplementedError
+
+    def delete_checkpoints(self) -> None:
+        raise NotImplementedError
+
+    def nndata_count(self) -> int:
+        raise NotImplementedError
+
+    def nndata_records(self, batch_size: int = 1000):
+        "Iterates over the NNData documents in id order without their ids."
+        raise NotImplementedError
+
+    def insert_nndata(self, documents: list[NNData]) -> None:
+        raise NotImplementedError
+
+    def delete_nndata(self) -> None:
+        raise NotImplementedError
+
+    def fingerprint(self) -> str:
+        """
+        Fingerprints the Team and Game collections without reading the
+        games. Inserted games change the newest game id, corrected games the
+        latest 'updated' time, moved or renamed teams the hash of the team
+        fields in TEAM_FINGERPRINT_FIELDS and every elo replay writes new
+        checkpoints, so any of them changes the fingerprint.
+        """
+        raise NotImplementedError
+
+
+TEAM_FINGERPRINT_FIELDS = ("_id", "name", "ticker", "latitude", "longitude")
+
+def teams_hash(team_records) -> str:
+    "Hash of the fingerprinted fields of the teams, see Storage.fingerprint."
+    teams = sorted((tuple(team.get(field) for field in TEAM_FINGERPRINT_FIELDS) for team in team_records),
+                   key=lambda team: team[0])
+    return hashlib.sha256(repr(teams).encode()).hexdigest()
+
+
+class MongoStorage(Storage):
+    """
+    The MongoDB database. A database connection must already be open.
+
+    Parameters
+    ----------
+    flat : bool
+        Read the games and the team locations from the denormalized GameFlat
+        collection, see utils.flat_games. Writes go to the Game collection
+        and are copied to GameFlat.
+    batch_size : int
+        Number of documents in each bulk write of elo updates.
+    background : bool
+        Send the elo updates from a background thread while the next batch
+        is being built, see utils.bulk_writer.BulkWriter.
+    stats : RunStats, optional
+        Records the bulk writes of elo updates.
+    """
+
+    cacheable = True
+
+    def __init__(self, flat: bool = False, batch_size: int = 1000, background: bool = False,
+                 stats=None):
+        self.flat = flat
+        self.batch_size = batch_size
+        self.background = background
+        self.stats = stats
+
+    def _set_fields(self, documents, ids, fields) -> None:
+        "Sets fields, a list of dicts in ids order, on every document id in bulk writes."
+        for document in documents:
+            with BulkWriter(document._get_collection(), self.batch_size, background=self.background,
+                            stats=self.stats) as writer:
+                for doc_id, doc_fields in zip(ids, fields):
+                    writer.set(doc_id, doc_fields)
+
+    def team_records(self) -> list[dict]:
+        return list(Team.objects.as_pymongo())
+
+    def insert_teams(self, records: list[dict]) -> list:
+        return [Team(**record).save().id for record in records]
+
+    def set_team_elos(self, team_ids, elos) -> None:
+        self._set_fields([Team], team_ids, [{"elo": elo} for elo in elos])
+
+    def _games(self, after=None):
+        games = GameFlat.objects if self.flat else Game.objects
+        if after is not None:
+            games = games(id__gt=after)
+        return games.order_by("id").exclude("day", "home_bye", "away_bye").as_pymongo()
+
+    def game_records(self, after=None) -> list[dict]:
+        if self.flat:
+            return [from_flat_record(game) for game in self._games(after)]
+        return self._games(after)
+
+    def game_records_with_teams(self, after=None) -> tuple[list[dict], dict]:
+        if self.flat:
+            return read_flat_games(self._games(after))
+        return self._games(after), {}
+
+    def upsert_games(self, records, team_ids: dict) -> tuple[int, int]:
+        from .utils.ingest import game_upsert, game_upsert_fields
+        updated = datetime.now(timezone.utc)
+        updates = [update for record in records for update in game_upsert(record, team_ids, updated)]
+        if not updates:
+            return 0, 0
+        result = Game._get_collection().bulk_write(updates, ordered=False)
+        if self.flat:
+            # copy the written games, they are looked up by key because
+            # the ids of existing games aren't known
+            keys = [game_upsert_fields(record, team_ids)[0] for record in records]
+            games = Game.objects(__raw__={"$or": keys}).order_by("id").as_pymongo()
+            write_flat_games(games, team_refs(self.team_records()))
+        return result.upserted_count, result.modified_count
+
+    def set_pregame_elos(self, game_ids, home_pregame_elo, away_pregame_elo) -> None:
+        fields = [{"home_pregame_elo": home_elo, "away_pregame_elo": away_elo}
+                  for home_elo, away_elo in zip(home_pregame_elo, away_pregame_elo)]
+        self._set_fields([Game, GameFlat] if self.flat else [Game], game_ids, fields)
+
+    def latest_checkpoint(self):
+        return EloCheckpoint.objects.order_by("-last_game").first()
+
+    def checkpoint_records(self) -> list[dict]:
+        return list(EloCheckpoint.objects.order_by("last_game").as_pymongo())
+
+    def insert_checkpoints(self, checkpoints: list[EloCheckpoint]) -> None:
+        if checkpoints:
+            EloCheckpoint.objects.insert(checkpoints)
+
+    def delete_checkpoints(self) -> None:
+        EloCheckpoint.objects.delete()
+
+    def nndata_count(self) -> int:
+        return NNData.objects.count()
+
+    def nndata_records(self, batch_size: int = 1000):
+        return NNData.objects.order_by("id").exclude("id").as_pymongo().batch_size(batch_size)
+
+    def insert_nndata(self, documents: list[NNData]) -> None:
+        if documents:
+            NNData.objects.insert(documents)
+
+    def delete_nndata(self) -> None:
+        NNData.objects.delete()
+
+    def fingerprint(self) -> str:
+        last_checkpoint = EloCheckpoint.objects.order_by("-id").only("id").as_pymongo().first()
+        teams = Team.objects.only("id", "name", "ticker", "latitude", "longitude").as_pymongo()
+        parts = [
+            Team.objects.count(),
+            teams_hash(teams),
+            Game.objects.count(),
+            Game.objects.latest_id(),
+            Game.objects.latest_update(),
+            last_checkpoint and last_checkpoint["_id"],
+        ]
+        return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+class MemoryStorage(Storage):
+    """
+    Collections held in memory as raw documents keyed by id. Ids are
+    generated ObjectIds so games stay in insertion order.
+    """
+
+    def __init__(self):
+        self.teams = OrderedDict()
+        self.games = OrderedDict()
+        self.checkpoints = []
+        self.nndata = []
+        # (season, week, home_team, away_team) -> game id
+        self._game_keys = {}
+        self._latest_update = None
+
+    def team_records(self) -> list[dict]:
+        return [dict(team) for team in self.teams.values()]
+
+    def insert_teams(self, records: list[dict]) -> list:
+        ids = []
+        for record in records:
+            team = Team(**record).to_mongo().to_dict()
+            team.setdefault("_id", ObjectId())
+            self.teams[team["_id"]] = team
+            ids.append(team["_id"])
+        return ids
+
+    def set_team_elos(self, team_ids, elos) -> None:
+        for team_id, elo in zip(team_ids, elos):
+            self.teams[team_id]["elo"] = elo
+
+    def game_records(self, after=None) -> list[dict]:
+        games = self.games.values()
+        if after is not None:
+            games = (game for game in games if game["_id"] > after)
+        excluded = ("day", "home_bye", "away_bye")
+        return [{field: value for field, value in game.items() if field not in excluded}
+                for game in sorted(games, key=lambda game: game["_id"])]
+
+    def upsert_games(self, records, team_ids: dict) -> tuple[int, int]:
+        from .utils.ingest import game_upsert_fields
+        updated = datetime.now(timezone.utc)
+        inserted = modified = 0
+        for record in records:
+            key, fields, on_insert = game_upsert_fields(record, team_ids)
+            game_key = (key["season"], key["week"], key["home_team"], key["away_team"])
+            game_id = self._game_keys.get(game_key)
+            if game_id is None:
+                game = {**on_insert, **key, **fields, "updated": updated}
+                self.games[game["_id"]] = game
+                self._game_keys[game_key] = game["_id"]
+                inserted += 1
+            else:
+                game = self.games[game_id]
+                if any(game.get(field) != value for field, value in fields.items()):
+                    game.update(fields, updated=updated)
+                    modified += 1
+        if inserted or modified:
+            self._latest_update = updated
+        return inserted, modified
+
+    def set_pregame_elos(self, game_ids, home_pregame_elo, away_pregame_elo) -> None:
+        for game_id, home_elo, away_elo in zip(game_ids, home_pregame_elo, away_pregame_elo):
+            game = self.games[game_id]
+            game["home_pregame_elo"] = home_elo
+            game["away_pregame_elo"] = away_elo
+
+    def latest_checkpoint(self):
+        if not self.checkpoints:
+            return None
+        latest = max(self.checkpoints, key=lambda checkpoint: checkpoint["last_game"])
+        return EloCheckpoint._from_son(latest)
+
+    def checkpoint_records(self) -> list[dict]:
+        return [dict(checkpoint) for checkpoint in
+                sorted(self.checkpoints, key=lambda checkpoint: checkpoint["last_game"])]
+
+    def insert_checkpoints(self, checkpoints: list[EloCheckpoint]) -> None:
+        for checkpoint in checkpoints:
+            document = checkpoint.to_mongo().to_dict()
+            document.setdefault("_id", ObjectId())
+            self.checkpoints.append(document)
+
+    def delete_checkpoints(self) -> None:
+        self.checkpoints.clear()
+
+    def nndata_count(self) -> int:
+        return len(self.nndata)
+
+    def nndata_records(self, batch_size: int = 1000):
+        for document in self.nndata:
+            yield {field: value for field, value in document.items() if field != "_id"}
+
+    def insert_nndata(self, documents: list[NNData]) -> None:
+        for document in documents:
+            raw = document.to_mongo().to_dict()
+            raw.setdefault("_id", ObjectId())
+            self.nndata.append(raw)
+
+    def delete_nndata(self) -> None:
+        self.nndata.clear()
+
+    def fingerprint(self) -> str:
+        last_game = next(reversed(self.games), None)
+        last_checkpoint = self.checkpoints[-1]["_id"] if self.checkpoints else None
+        parts = [len(self.teams), teams_hash(self.teams.values()), len(self.games), last_game,
+                 self._latest_update, last_checkpoint]
+        return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+_default_storage = None
+
+def get_storage(storage: Storage = None) -> Storage:
+    "Returns storage, or the MongoDB storage if it is None."
+    global _default_storage
+    if storage is not None:
+        return storage
+    if _default_storage is None:
+        _default_storage = MongoStorage()
+    return _default_storage
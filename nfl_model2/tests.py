@@ -1,9 +1,45 @@
-from unittest import TestCase
+import asyncio
+import os
+import tempfile
+from functools import partial
+from unittest import TestCase, mock
 
-from .models import Team, Game
+import numpy as np
+from bson import ObjectId
+
+from .models import Team, Game, GameFlat, GameQuerySet, connect_to_database
+from .storage import MemoryStorage, MongoStorage
 from .elo.elo_model import (get_distance, pregame_elo_shift, 
                             win_prob, post_game_elo_shift,
-                            pre_season_elo)
+                            pre_season_elo, get_distance_batch,
+                            pregame_elo_shift_batch, win_prob_batch,
+                            post_game_elo_shift_batch, pre_season_elo_batch,
+                            EloParams, DEFAULT_PARAMS, WIN_PROB_RANGE)
+from .elo.distance_table import DistanceTable, get_distance_table
+from .elo.elo_engine import (TeamArrays, GameArrays, replay, season_name, load_game_arrays,
+                             load_latest_checkpoint)
+from .elo.season_sim import division_index, simulate_seasons, superbowl_site
+from .elo import rating_cache, elo_sim
+from .elo.matchups import predict_matchups, power_matrix
+from .elo.calibration import param_grid, replay_params, score, calibrate
+from .elo.backtest import backtest, game_scores, calibration_buckets, walk_forward
+from .elo.spreads import margin_distribution, fit_margin_sd, spread_predictions
+from .elo.rating_history import RatingHistory, load_history, save_history
+from .utils import init_db
+from .utils.init_db import teams as team_locations
+from .utils.ingest import (parse_row, parse_season_file, season_files, iter_season_records, to_game_arrays,
+                           write_games, league_team_arrays, game_upsert)
+from .utils.rolling_window import (RollingWindow, build_window_features, feature_columns,
+                                   window_state, build_window_features_by_season, team_stats)
+from .utils.process_nn_data import build_nn_dataset, to_nndata_documents
+from .utils.nn_export import export_nn_dataset, nndata_row, NNDataReader
+from .utils.game_cache import save_snapshot, load_snapshot, read_meta, load_games
+from .utils.flat_games import (team_refs, to_flat_record, from_flat_record, read_flat_games,
+                               refresh_team_refs)
+from .utils.instrumentation import RunStats
+from .utils.bulk_writer import BulkWriter
+from benchmarks.fixtures import scale_up
+from benchmarks.run import compare, measure
 
 
 
@@ -120,4 +156,1096 @@ class EloModelTests(TestCase):
         self.assertEquals(post_game_elo_shift(self.playoff_game), 19)
 
     def test_pre_season_elo(self):
-        self.assertEquals(pre_season_elo(1753), 1670)
\ No newline at end of file
+        self.assertEquals(pre_season_elo(1753), 1670)
+
+
+class EloModelBatchTests(TestCase):
+
+    setUp = EloModelTests.setUp
+
+    def test_get_distance_batch(self):
+        distances = get_distance_batch([self.teamA.latitude, self.teamB.latitude],
+                                       [self.teamA.longitude, self.teamB.longitude],
+                                       [self.teamB.latitude, self.teamC.latitude],
+                                       [self.teamB.longitude, self.teamC.longitude])
+        self.assertEqual(distances.tolist(), [get_distance(self.teamA, self.teamB),
+                                              get_distance(self.teamB, self.teamC)])
+
+    def test_pregame_elo_shift_batch(self):
+        games = [self.neutral_game, self.regular_game, self.playoff_game]
+        shifts = pregame_elo_shift_batch(
+            [g.home_team.latitude for g in games], [g.home_team.longitude for g in games],
+            [g.away_team.latitude for g in games], [g.away_team.longitude for g in games],
+            [self.teamC.latitude] * 3, [self.teamC.longitude] * 3,
+            [True, False, False], [True, False, True]
+        )
+        self.assertEqual(shifts.tolist(), [pregame_elo_shift(g) for g in games])
+
+    def test_win_prob_batch(self):
+        elo_diffs = list(range(-1000, 1001))
+        self.assertEqual(win_prob_batch(elo_diffs).tolist(), [win_prob(d) for d in elo_diffs])
+
+    def test_win_prob_table_matches_formula(self):
+        formula = lambda elo_diff: 1/(10**(-elo_diff/400)+1)
+        elo_diffs = list(range(-WIN_PROB_RANGE - 50, WIN_PROB_RANGE + 51))
+        self.assertEqual([win_prob(d) for d in elo_diffs], [formula(d) for d in elo_diffs])
+        self.assertEqual(win_prob_batch(np.array(elo_diffs)).tolist(), [formula(d) for d in elo_diffs])
+        halves = [d + 0.5 for d in elo_diffs]
+        self.assertEqual(win_prob_batch(halves).tolist(), [formula(d) for d in halves])
+        self.assertEqual(win_prob_batch(np.array([[24.0, -7.0]])).tolist(), [[formula(24), formula(-7)]])
+        self.assertEqual(win_prob_batch(np.empty(0, dtype=np.int64)).shape, (0,))
+
+    def test_post_game_elo_shift_batch(self):
+        games = []
+        for home_elo, away_elo in [(1600, 1500), (1450, 1550), (1505, 1505)]:
+            for home_points, away_points in [(31, 25), (10, 24), (17, 17)]:
+                games.append(Game(home_pregame_elo=home_elo, away_pregame_elo=away_elo,
+                                  home_points=home_points, away_points=away_points))
+        shifts = post_game_elo_shift_batch([g.home_pregame_elo for g in games],
+                                           [g.away_pregame_elo for g in games],
+                                           [g.home_points for g in games],
+                                           [g.away_points for g in games])
+        self.assertEqual(shifts.tolist(), [post_game_elo_shift(g) for g in games])
+
+    def test_pre_season_elo_batch(self):
+        elos = list(range(1300, 1800))
+        self.assertEqual(pre_season_elo_batch(elos).tolist(), [pre_season_elo(e) for e in elos])
+
+class DistanceTableTests(TestCase):
+
+    setUp = EloModelTests.setUp
+
+    def make_table(self):
+        for team_id, team in enumerate([self.teamA, self.teamB, self.teamC]):
+            team.id = team_id
+        teams = [self.teamA, self.teamB, self.teamC]
+        return DistanceTable([t.latitude for t in teams], [t.longitude for t in teams],
+                             [t.id for t in teams])
+
+    def test_distance(self):
+        table = self.make_table()
+        self.assertEqual(table.distance[0, 1], get_distance(self.teamA, self.teamB))
+        self.assertEqual(table.distance[1, 2], get_distance(self.teamB, self.teamC))
+
+    def test_pregame_elo_shift_lookup(self):
+        table = self.make_table()
+        for game in [self.neutral_game, self.regular_game, self.playoff_game]:
+            self.assertEqual(pregame_elo_shift(game, table), pregame_elo_shift(game))
+
+    def test_pregame_elo_shift_arrays(self):
+        table = self.make_table()
+        shifts = table.pregame_elo_shift([0, 0, 0], [1, 1, 1], [2, -1, -1], [True, False, True])
+        self.assertEqual(shifts.tolist(), [5, 27, round(27 * 1.2)])
+
+    def test_odd_home_field_rounds_the_same_everywhere(self):
+        games = [self.neutral_game, self.regular_game, self.playoff_game]
+        for home_field in (49, 47, 48.6):
+            params = EloParams(home_field=home_field)
+            table = DistanceTable([t.latitude for t in (self.teamA, self.teamB, self.teamC)],
+                                  [t.longitude for t in (self.teamA, self.teamB, self.teamC)], params=params)
+            expected = [pregame_elo_shift(game, params=params) for game in games]
+            self.assertTrue(all(isinstance(shift, int) for shift in expected))
+            self.assertEqual(table.pregame_elo_shift([0, 0, 0], [1, 1, 1], [2, -1, -1],
+                                                     [True, False, True]).tolist(), expected)
+            shifts = pregame_elo_shift_batch(
+                [self.teamA.latitude] * 3, [self.teamA.longitude] * 3,
+                [self.teamB.latitude] * 3, [self.teamB.longitude] * 3,
+                [self.teamC.latitude] * 3, [self.teamC.longitude] * 3,
+                [True, False, False], [True, False, True], params=params
+            )
+            self.assertEqual(shifts.tolist(), expected)
+
+    def test_get_distance_table_rebuilds_on_move(self):
+        table = get_distance_table([39.1, 47.6], [-94.6, -122.3])
+        self.assertIs(get_distance_table([39.1, 47.6], [-94.6, -122.3]), table)
+        self.assertIsNot(get_distance_table([39.1, 32.7], [-94.6, -97.1]), table)
+
+
+class EloEngineTests(TestCase):
+
+    def setUp(self):
+        self.team_records = [
+            {"_id": "KC", "name": "Kansas City Chiefs", "ticker": "KC",
+             "latitude": 39.099789, "longitude": -94.57856, "elo": 1505},
+            {"_id": "SEA", "name": "Seattle Seahawks", "ticker": "SEA",
+             "latitude": 47.60323, "longitude": -122.330276, "elo": 1505},
+            {"_id": "DAL", "name": "Dallas Cowboys", "ticker": "DAL",
+             "latitude": 32.7480062696302, "longitude": -97.09303478136525, "elo": 1505},
+        ]
+        schedule = [
+            ("2010-2011", "1", "KC", "SEA", 31, 25, None),
+            ("2010-2011", "2", "SEA", "DAL", 10, 10, None),
+            ("2010-2011", "3", "DAL", "KC", 3, 38, None),
+            ("2010-2011", "WildCard", "KC", "DAL", 24, 27, None),
+            ("2010-2011", "SuperBowl", "DAL", "SEA", 20, 17, "KC"),
+            ("2011-2012", "1", "SEA", "KC", 14, 13, None),
+            ("2011-2012", "2", "KC", "DAL", 7, 35, None),
+        ]
+        self.game_records = [
+            {"_id": i, "season": season, "week": week, "home_team": home,
+             "away_team": away, "home_points": home_points,
+             "away_points": away_points, "neutral_destination": neutral}
+            for i, (season, week, home, away, home_points, away_points, neutral)
+            in enumerate(schedule)
+        ]
+
+    def scalar_replay(self):
+        "Replays the games one document at a time like the original elo_sim."
+        teams = {r["_id"]: Team(name=r["name"], ticker=r["ticker"], latitude=r["latitude"],
+                                longitude=r["longitude"], elo=1505)
+                 for r in self.team_records}
+        pregame = []
+        prev_season = self.game_records[0]["season"]
+        for r in self.game_records:
+            if r["season"] != prev_season:
+                for team in teams.values():
+                    team.elo = pre_season_elo(team.elo)
+                prev_season = r["season"]
+            game = Game(season=r["season"], week=r["week"],
+                        home_team=teams[r["home_team"]], away_team=teams[r["away_team"]],
+                        home_points=r["home_points"], away_points=r["away_points"],
+                        neutral_destination=teams.get(r["neutral_destination"]))
+            shift = pregame_elo_shift(game)
+            game.home_pregame_elo = game.home_team.elo + shift
+            game.away_pregame_elo = game.away_team.elo - shift
+            post_shift = post_game_elo_shift(game)
+            game.home_team.elo = game.home_pregame_elo + post_shift
+            game.away_team.elo = game.away_pregame_elo - post_shift
+            pregame.append((game.home_pregame_elo, game.away_pregame_elo))
+        return pregame, [teams[r["_id"]].elo for r in self.team_records]
+
+    def test_replay_matches_scalar_model(self):
+        teams = TeamArrays.from_records(self.team_records)
+        games = GameArrays.from_records(self.game_records, teams)
+        result = replay(games)
+
+        expected_pregame, expected_elo = self.scalar_replay()
+        self.assertEqual(list(zip(result.home_pregame_elo.tolist(), result.away_pregame_elo.tolist())),
+                         expected_pregame)
+        self.assertEqual(result.elo.tolist(), expected_elo)
+
+    def test_incremental_replay_from_checkpoint(self):
+        teams = TeamArrays.from_records(self.team_records)
+        games = GameArrays.from_records(self.game_records, teams)
+        full = replay(games)
+        self.assertEqual(full.week_end.tolist(), list(range(len(games))))
+
+        # resume after the super bowl, pre_season_elo must still be applied
+        checkpoint = 4
+        first = replay(games.subset(slice(0, checkpoint + 1)))
+        second = replay(games.subset(slice(checkpoint + 1, None)), elo=first.weekly_elo[-1],
+                        prev_season=int(games.season[checkpoint]))
+        self.assertEqual(second.elo.tolist(), full.elo.tolist())
+        self.assertEqual(second.home_pregame_elo.tolist(),
+                         full.home_pregame_elo[checkpoint + 1:].tolist())
+
+    def test_game_arrays_codes(self):
+        teams = TeamArrays.from_records(self.team_records)
+        games = GameArrays.from_records(self.game_records, teams)
+        self.assertEqual(games.season.tolist(), [2010] * 5 + [2011] * 2)
+        self.assertEqual(games.week.tolist(), [1, 2, 3, 19, 22, 1, 2])
+        self.assertEqual(games.neutral.tolist(), [-1, -1, -1, -1, 0, -1, -1])
+        self.assertEqual(games.is_playoff.tolist(), [False] * 3 + [True] * 2 + [False] * 2)
+
+
+class SeasonSimTests(TestCase):
+
+    def setUp(self):
+        locations = {value[2]: value for value in team_locations.values()}
+        self.tickers = sorted(locations)
+        self.table = DistanceTable([locations[t][0] for t in self.tickers],
+                                   [locations[t][1] for t in self.tickers])
+        self.division = division_index(self.tickers)
+        self.elo = [1300 + 10 * i for i in range(len(self.tickers))]
+        self.elo[self.tickers.index("KC")] = 1900
+        league = np.flatnonzero(self.division >= 0)
+        rng = np.random.default_rng(0)
+        self.home = np.concatenate([rng.permutation(league) for _ in range(8)])
+        self.away = np.concatenate([np.roll(self.home[i:i + len(league)], 1)
+                                    for i in range(0, len(self.home), len(league))])
+
+    def simulate(self, **kwargs):
+        return simulate_seasons(self.elo, self.home, self.away, self.division, self.table,
+                                n_sims=2000, seed=5, batch_size=500, **kwargs)
+
+    def test_superbowl_site(self):
+        teams = league_team_arrays()
+        self.assertEqual(teams.names[superbowl_site("2022-2023", teams)], "Arizona Cardinals")
+        self.assertEqual(teams.names[superbowl_site("2010-2011", teams)], "Dallas Cowboys")
+        self.assertEqual(superbowl_site("2030-2031", teams), -1)
+
+    def test_relocated_teams_have_no_division(self):
+        self.assertEqual((self.division >= 0).sum(), 32)
+        self.assertEqual(self.division[self.tickers.index("OAK")], -1)
+
+    def test_probabilities(self):
+        result = self.simulate()
+        self.assertAlmostEqual(result.make_playoffs.sum(), 14)
+        self.assertAlmostEqual(result.win_division.sum(), 8)
+        self.assertAlmostEqual(result.win_conference.sum(), 2)
+        self.assertAlmostEqual(result.win_superbowl.sum(), 1)
+        self.assertAlmostEqual(result.mean_wins.sum(), len(self.home))
+        self.assertEqual(result.make_playoffs[self.division < 0].tolist(), [0] * 3)
+        # the highest rated team is the favourite
+        self.assertEqual(int(np.argmax(result.win_superbowl)), self.tickers.index("KC"))
+
+    def test_seeding_is_independent_of_workers(self):
+        result = self.simulate()
+        pooled = self.simulate(n_workers=2)
+        for single, multi in zip(result, pooled):
+            self.assertTrue(np.array_equal(single, multi))
+
+
+class CalibrationTests(TestCase):
+
+    setUp = EloEngineTests.setUp
+
+    def games(self):
+        teams = TeamArrays.from_records(self.team_records)
+        return GameArrays.from_records(self.game_records, teams)
+
+    def test_param_grid(self):
+        grid = param_grid(k=[15, 20], home_field=[40, 48, 56])
+        self.assertEqual(len(grid), 6)
+        self.assertIn(DEFAULT_PARAMS, grid)
+        self.assertEqual({params.regression for params in grid}, {DEFAULT_PARAMS.regression})
+        with self.assertRaises(ValueError):
+            param_grid(K=[20])
+
+    def test_replay_params_matches_replay(self):
+        games = self.games()
+        grid = param_grid(k=[10, 20, 30], home_field=[0, 48], regression=[1/4, 1/3])
+        result = replay_params(games, grid)
+        for i, params in enumerate(grid):
+            expected = replay(games, params=params)
+            self.assertEqual(result.home_pregame_elo[:, i].tolist(), expected.home_pregame_elo.tolist())
+            self.assertEqual(result.away_pregame_elo[:, i].tolist(), expected.away_pregame_elo.tolist())
+            self.assertEqual(result.weekly_elo[:, :, i].tolist(), expected.weekly_elo.tolist())
+
+    def test_calibrate(self):
+        games = self.games()
+        grid = param_grid(k=[5, 20, 40], home_field=[0, 48])
+        result = calibrate(games, grid, chunk_size=4, skip_seasons=0)
+        expected = replay(games)
+        brier, log_loss = score(games, expected.home_pregame_elo, expected.away_pregame_elo,
+                                skip_seasons=0)
+        i = grid.index(DEFAULT_PARAMS)
+        self.assertAlmostEqual(result.brier[i], brier)
+        self.assertAlmostEqual(result.log_loss[i], log_loss)
+        self.assertEqual(result.best(), result.ranking()[0][0])
+        self.assertEqual(result.brier.min(), result.ranking()[0][1])
+        with self.assertRaises(ValueError):
+            score(games, expected.home_pregame_elo, expected.away_pregame_elo, skip_seasons=2)
+
+
+class BacktestTests(TestCase):
+
+    def setUp(self):
+        self.games = to_game_arrays([record for season in iter_season_records() for record in season])
+        self.result = replay(self.games)
+
+    def test_backtest_matches_scalar_scores(self):
+        result = backtest(self.games, self.result.home_pregame_elo, self.result.away_pregame_elo)
+        brier, log_loss = score(self.games, self.result.home_pregame_elo, self.result.away_pregame_elo)
+        self.assertAlmostEqual(result.overall["brier"], brier, places=12)
+        self.assertAlmostEqual(result.overall["log_loss"], log_loss, places=12)
+        self.assertEqual(result.by_season["season"].tolist(), list(range(2011, 2023)))
+        self.assertEqual(result.by_season["games"].sum(), result.overall["games"])
+        self.assertEqual(result.by_week["games"].sum(), result.overall["games"])
+        self.assertEqual(result.calibration["games"].sum(), result.overall["games"])
+
+        season = self.games.season == 2015
+        diff = (self.result.home_pregame_elo - self.result.away_pregame_elo)[season]
+        margin = (self.games.home_points - self.games.away_points)[season]
+        favourite_won = np.where(diff * margin > 0, 1.0, np.where((diff == 0) | (margin == 0), 0.5, 0.0))
+        i = result.by_season["season"].tolist().index(2015)
+        self.assertAlmostEqual(result.by_season["accuracy"][i], favourite_won.mean())
+        self.assertAlmostEqual(result.by_season["spread_mae"][i], np.abs(diff / 25 - margin).mean())
+
+    def test_game_scores_and_buckets(self):
+        scores = game_scores(self.games.subset(slice(0, 3)), [1600, 1500, 1500], [1500, 1600, 1500])
+        self.assertEqual(scores.home_win_prob.tolist(), [win_prob(100), win_prob(-100), 0.5])
+        buckets = calibration_buckets([0.05, 0.55, 0.58, 1.0], [0, 1, 0, 1], n_buckets=10)
+        self.assertEqual(buckets["games"].tolist(), [1, 0, 0, 0, 0, 2, 0, 0, 0, 1])
+        self.assertEqual(buckets["observed"][5], 0.5)
+        self.assertTrue(np.isnan(buckets["observed"][1]))
+
+    def test_walk_forward(self):
+        grid = param_grid(k=[15, 20], home_field=[40, 48])
+        walk = walk_forward(self.games, grid, min_train_seasons=2)
+        self.assertEqual(walk["season"].tolist(), list(range(2013, 2023)))
+        # the 2013 pick has the best brier over 2011 and 2012
+        replays = replay_params(self.games, grid)
+        mask = (self.games.season >= 2011) & (self.games.season <= 2012)
+        brier, _ = score(self.games.subset(mask), replays.home_pregame_elo[mask], replays.away_pregame_elo[mask], skip_seasons=0)
+        self.assertEqual(walk["params"][0], grid[int(np.argmin(brier))])
+        with self.assertRaises(ValueError):
+            walk_forward(self.games, grid, min_train_seasons=12)
+
+
+class SpreadTests(TestCase):
+
+    def test_margin_distribution(self):
+        distribution = margin_distribution([0, 75, -200], sd=13.5)
+        self.assertEqual(distribution.spread.tolist(), [0, 3, -8])
+        np.testing.assert_allclose(distribution.prob.sum(axis=1), 1)
+        np.testing.assert_allclose(distribution.prob @ distribution.margins, [0, 3, -8], atol=0.01)
+        even = distribution.prob[0]
+        np.testing.assert_allclose(even, even[::-1])
+        self.assertEqual(int(distribution.margins[np.argmax(distribution.prob[1])]), 3)
+
+        covers = distribution.cover_prob(0)
+        pushes = distribution.push_prob(0)
+        self.assertAlmostEqual(covers[0] * 2 + pushes[0], 1)
+        self.assertGreater(covers[1], 0.5)
+        self.assertLess(covers[2], 0.5)
+        self.assertEqual(distribution.push_prob([0.5, 0.5, 0.5]).tolist(), [0, 0, 0])
+        self.assertEqual(margin_distribution([]).prob.shape, (0, 101))
+
+    def test_fit_margin_sd(self):
+        games = to_game_arrays([record for season in iter_season_records() for record in season])
+        result = replay(games)
+        self.assertAlmostEqual(fit_margin_sd(games, result.home_pregame_elo, result.away_pregame_elo),
+                               13.5, delta=0.1)
+
+    def test_spread_predictions(self):
+        predictions = [{"home": "KC", "away": "SEA", "home_pregame_elo": 1600, "away_pregame_elo": 1500}]
+        spreads = spread_predictions(predictions, lines=(3.5,))
+        game = spreads["games"][0]
+        self.assertEqual(game["spread"], 4)
+        self.assertEqual(len(game["margin_prob"]), len(spreads["margins"]))
+        self.assertGreater(game["cover_prob"]["3.5"], 0.5)
+
+
+class RatingCacheTests(TestCase):
+
+    def setUp(self):
+        EloEngineTests.setUp(self)
+        self.team_records[0]["elo"] = 1600
+        self.teams = TeamArrays.from_records(self.team_records)
+        self.snapshot = rating_cache.RatingSnapshot(self.teams, version=1)
+
+    def tearDown(self):
+        rating_cache.invalidate()
+
+    def test_ratings(self):
+        self.assertEqual([team["ticker"] for team in self.snapshot.ratings()], ["KC", "SEA", "DAL"])
+
+    def test_matchup(self):
+        prediction = self.snapshot.matchup("kc", "SEA")
+        shift = self.snapshot.table.pregame_elo_shift(0, 1)
+        self.assertEqual(prediction["home_pregame_elo"], 1600 + shift)
+        self.assertEqual(prediction["away_pregame_elo"], 1505 - shift)
+        self.assertEqual(prediction["home_win_prob"], win_prob(95 + 2 * shift))
+        self.assertEqual(prediction["spread"], (95 + 2 * shift) / 25)
+
+        neutral = self.snapshot.matchup("SEA", "DAL", neutral="KC", is_playoff=True)
+        self.assertEqual(neutral["elo_shift"], self.snapshot.table.pregame_elo_shift(1, 2, 0, True))
+        self.assertEqual(neutral["neutral"], "KC")
+        with self.assertRaises(ValueError):
+            self.snapshot.matchup("KC", "XXX")
+        with self.assertRaises(ValueError):
+            self.snapshot.matchup("KC", "KC")
+
+    def test_matchups(self):
+        predictions = self.snapshot.matchups([("KC", "SEA"), ["SEA", "DAL", "KC", True],
+                                              {"home": "DAL", "away": "KC", "playoff": True}])
+        self.assertEqual(predictions[0], self.snapshot.matchup("KC", "SEA"))
+        self.assertEqual(predictions[1], self.snapshot.matchup("SEA", "DAL", "KC", True))
+        self.assertEqual(predictions[2], self.snapshot.matchup("DAL", "KC", is_playoff=True))
+        for game in [("KC",), 5, "KC", None]:
+            with self.assertRaises(ValueError):
+                self.snapshot.matchups([game])
+
+        # JSON payloads may send the flag as a string but never as a truthy value
+        self.assertEqual(self.snapshot.matchups([["KC", "SEA", None, "false"]])[0]["playoff"], False)
+        self.assertEqual(self.snapshot.matchups([{"home": "KC", "away": "SEA", "playoff": "True"}])[0]["playoff"],
+                         True)
+        for flag in ("no", 1, None, "1"):
+            with self.assertRaises(ValueError):
+                self.snapshot.matchups([{"home": "KC", "away": "SEA", "playoff": flag}])
+
+    def test_power_matrix(self):
+        elo = self.teams.elo
+        result = power_matrix(elo, self.snapshot.table)
+        self.assertEqual(result.home_win_prob.shape, (3, 3))
+        for h in range(3):
+            for a in range(3):
+                shift = self.snapshot.table.pregame_elo_shift(h, a)
+                self.assertEqual(result.home_win_prob[h, a], win_prob(elo[h] - elo[a] + 2 * shift))
+        single = predict_matchups(elo, self.snapshot.table, [0], [1])
+        self.assertEqual(single.spread[0], result.spread[0, 1])
+
+        matrix = self.snapshot.power_matrix()
+        self.assertEqual(matrix["teams"], ["DAL", "KC", "SEA"])
+        self.assertIsNone(matrix["home_win_prob"][1][1])
+        self.assertEqual(matrix["home_win_prob"][1][2], self.snapshot.matchup("KC", "SEA")["home_win_prob"])
+        self.assertIs(self.snapshot.power_matrix(), matrix)
+
+    def test_predict_games_keeps_stored_pregame_elo(self):
+        played, upcoming = dict(self.game_records[0]), dict(self.game_records[1])
+        played.update(home_pregame_elo=1550, away_pregame_elo=1450)
+        upcoming.update(home_points=None, away_points=None, home_pregame_elo=0, away_pregame_elo=0)
+        first, second = self.snapshot.predict_games([played, upcoming])
+        self.assertEqual((first["home_pregame_elo"], first["home_points"]), (1550, 31))
+        shift = self.snapshot.table.pregame_elo_shift(1, 2)
+        self.assertEqual((second["home_pregame_elo"], second["away_pregame_elo"]),
+                         (1505 + shift, 1505 - shift))
+
+    def test_snapshot_reloads_when_version_changes(self):
+        with mock.patch.object(rating_cache, "current_version", return_value=1), \
+             mock.patch.object(rating_cache, "load_snapshot",
+                               side_effect=lambda version: rating_cache.RatingSnapshot(self.teams, version)) as load:
+            first = rating_cache.get_snapshot()
+            self.assertIs(rating_cache.get_snapshot(), first)
+            self.assertIs(rating_cache.get_snapshot(max_age=0), first)
+            rating_cache.current_version.return_value = 2
+            self.assertIs(rating_cache.get_snapshot(), first)
+            self.assertEqual(rating_cache.get_snapshot(max_age=0).version, 2)
+            rating_cache.invalidate()
+            rating_cache.get_snapshot()
+            self.assertEqual(load.call_count, 3)
+
+    def test_async_week_predictions_are_cached(self):
+        load = lambda version: rating_cache.RatingSnapshot(self.teams, version)
+        with mock.patch.object(rating_cache, "current_version", return_value=1), \
+             mock.patch.object(rating_cache, "load_snapshot", side_effect=load), \
+             mock.patch.object(rating_cache, "load_week_games",
+                               return_value=self.game_records[:3]) as load_week:
+            first = asyncio.run(rating_cache.aweek_predictions("2010-2011", "1"))
+            second = asyncio.run(rating_cache.aweek_predictions("2010-2011", "1"))
+            self.assertIs(first, second)
+            self.assertEqual(load_week.call_count, 1)
+            self.assertEqual([game["home"] for game in first], ["KC", "SEA", "DAL"])
+            self.assertIs(asyncio.run(rating_cache.aget_snapshot()), rating_cache.get_snapshot())
+
+            spreads = asyncio.run(rating_cache.aweek_spreads("2010-2011", "1"))
+            self.assertIs(spreads, rating_cache.get_snapshot().week_spreads("2010-2011", "1"))
+            self.assertEqual(load_week.call_count, 1)
+            self.assertEqual([game["spread"] for game in spreads["games"]],
+                             [game["spread"] for game in first])
+
+    def test_week_key(self):
+        self.assertEqual(rating_cache.week_key("2022-2023", "5"), ("2022-2023", "5"))
+        self.assertEqual(rating_cache.week_key("2022-2023", "WildCard"), ("2022-2023", "WildCard"))
+        for season, week in [("2022-2024", "1"), ("2022", "1"), ("2022-2023", "0"),
+                             ("2022-2023", "05"),
+                             ("2022-2023", "19"), ("2022-2023", "wildcard"), ("x", "1"), (None, "1")]:
+            with self.assertRaises(ValueError):
+                rating_cache.week_key(season, week)
+
+    def test_week_cache_is_bounded(self):
+        with mock.patch.object(rating_cache, "load_week_games", return_value=[]) as load_week:
+            self.assertEqual(self.snapshot.week_predictions("2030-2031", "1"), [])
+            self.assertEqual(self.snapshot.week_spreads("2030-2031", "1")["games"], [])
+            self.assertEqual(load_week.call_count, 2)
+            self.assertEqual((len(self.snapshot._weeks), len(self.snapshot._spreads)), (0, 0))
+            with self.assertRaises(ValueError):
+                self.snapshot.week_predictions("2030-2031", "99")
+            self.assertEqual(load_week.call_count, 2)
+
+        with mock.patch.object(rating_cache, "MAX_WEEKS", 3):
+            for season in range(2010, 2015):
+                self.snapshot.add_week(season_name(season), "1", self.game_records[:1])
+        self.assertEqual(list(self.snapshot._weeks), [(season_name(season), "1") for season in range(2012, 2015)])
+
+    def test_connect_without_credentials(self):
+        with mock.patch.dict(os.environ, {"NFL_MODEL_DB_USER": "", "NFL_MODEL_DB_PASSWORD": ""}):
+            with self.assertRaises(RuntimeError):
+                connect_to_database(interactive=False)
+
+
+class IngestTests(TestCase):
+
+    def test_parse_row_away_winner(self):
+        cols = "1,Thu,2022-09-08,8:20PM,Buffalo Bills,@,Los Angeles Rams,boxscore,31,10,413,4,243,3".split(",")
+        record = parse_row(cols, "2022-2023")
+        self.assertEqual((record.home_team, record.away_team), ("Los Angeles Rams", "Buffalo Bills"))
+        self.assertEqual((record.home_points, record.away_points), (10, 31))
+        self.assertEqual((record.home_turnovers, record.away_turnovers), (3, 4))
+        self.assertIsNone(record.neutral_destination)
+
+    def test_parse_row_neutral_site(self):
+        cols = ("SuperBowl,Sun,2011-02-06,6:34PM,Green Bay Packers,N,Pittsburgh Steelers,"
+                "boxscore,31,25,338,0,387,3").split(",")
+        record = parse_row(cols, "2010-2011")
+        self.assertEqual(record.home_team, "Green Bay Packers")
+        self.assertEqual(record.neutral_destination, "Dallas Cowboys")
+
+    def test_parse_row_normalizes_names(self):
+        cols = "1,Sun,2010-09-12,1:00PM,Washington Redskins,,St. Louis Rams,boxscore,13,7,1,1,1,1".split(",")
+        record = parse_row(cols, "2010-2011")
+        self.assertEqual((record.home_team, record.away_team), ("Washington Commanders", "Los Angeles Rams"))
+
+    def test_parse_row_rejects_bad_rows(self):
+        with self.assertRaises(ValueError):
+            parse_row("1,Sun,2010-09-12,1:00PM,Nowhere,,St. Louis Rams,boxscore,1,0,1,1,1,1".split(","), "2010-2011")
+        with self.assertRaises(ValueError):
+            parse_row("1,Sun,2010-09-12,1:00PM,Washington Redskins,,St. Louis Rams".split(","), "2010-2011")
+
+    def test_parse_season_file_reports_bad_rows(self):
+        unknown_site = ("SuperBowl,Sun,1999-02-06,6:34PM,Green Bay Packers,N,Pittsburgh Steelers,"
+                        "boxscore,31,25,338,0,387,3")
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "NFL_2010.txt")
+            for row in (unknown_site, "1,Sun", "1"):
+                with open(path, "w") as f:
+                    f.write("Week,Day,Date\n" + row + "\n")
+                with self.assertRaisesRegex(ValueError, "NFL_2010.txt:2: "):
+                    parse_season_file(path)
+
+    def test_parse_season_file(self):
+        files = season_files()
+        self.assertEqual(len(files), 13)
+        records = parse_season_file(files[0])
+        self.assertEqual(len(records), 267)
+        self.assertTrue(all(record.season == "2010-2011" for record in records))
+        self.assertEqual(records[-1].week, "SuperBowl")
+
+    def test_game_upsert_stamps_changed_games(self):
+        record = parse_season_file(season_files()[0])[0]
+        team_ids = {record.home_team: ObjectId(), record.away_team: ObjectId()}
+        insert, correction = game_upsert(record, team_ids)
+        self.assertTrue(insert._upsert)
+        self.assertEqual(set(insert._doc), {"$setOnInsert"})
+        self.assertIn("updated", insert._doc["$setOnInsert"])
+        # the correction only matches the existing game if a field differs
+        self.assertFalse(correction._upsert)
+        self.assertEqual(correction._filter["home_team"], insert._filter["home_team"])
+        self.assertIn({"home_points": {"$ne": record.home_points}}, correction._filter["$or"])
+        self.assertEqual(correction._doc["$set"]["updated"], insert._doc["$setOnInsert"]["updated"])
+
+
+class MemoryStorageTests(TestCase):
+
+    def setUp(self):
+        self.storage = MemoryStorage()
+        teams = league_team_arrays()
+        ids = self.storage.insert_teams([
+            {"name": name, "ticker": ticker, "latitude": latitude, "longitude": longitude, "elo": 1505}
+            for name, ticker, latitude, longitude in zip(teams.names, teams.tickers,
+                                                         teams.latitude.tolist(), teams.longitude.tolist())
+        ])
+        self.team_ids = dict(zip(teams.names, ids))
+        self.records = [record for season in iter_season_records() for record in season]
+
+    def test_write_games_is_idempotent(self):
+        self.assertEqual(write_games(self.records, self.team_ids, storage=self.storage),
+                         (len(self.records), 0))
+        fingerprint = self.storage.fingerprint()
+        self.assertEqual(write_games(self.records, self.team_ids, storage=self.storage), (0, 0))
+        self.assertEqual(self.storage.fingerprint(), fingerprint)
+        changed = self.records[0]._replace(home_points=self.records[0].home_points + 1)
+        self.assertEqual(write_games(self.records[1:] + [changed], self.team_ids, storage=self.storage),
+                         (0, 1))
+        # a corrected game refreshes the snapshot although no game was added
+        self.assertNotEqual(self.storage.fingerprint(), fingerprint)
+        games = self.storage.game_records()
+        self.assertEqual(len(games), len(self.records))
+        self.assertNotIn("day", games[0])
+        self.assertEqual(games[0]["home_points"], changed.home_points)
+
+    def test_elo_sim_matches_replay(self):
+        write_games(self.records, self.team_ids, storage=self.storage)
+        elo_sim.run(storage=self.storage)
+        expected = replay(to_game_arrays(self.records))
+        games = load_game_arrays(storage=self.storage)
+        self.assertEqual(games.home_pregame_elo.tolist(), expected.home_pregame_elo.tolist())
+        self.assertEqual(len(self.storage.checkpoints), len(expected.week_end))
+
+        # roll back the last two weeks and catch up incrementally
+        self.storage.checkpoints = self.storage.checkpoints[:-2]
+        elo_sim.run_incremental(storage=self.storage)
+        teams = load_game_arrays(storage=self.storage).teams
+        self.assertEqual(teams.elo.tolist(), expected.elo.tolist())
+        checkpoint, elo = load_latest_checkpoint(teams, storage=self.storage)
+        self.assertEqual(checkpoint.week, "SuperBowl")
+        self.assertEqual(elo.tolist(), expected.elo.tolist())
+
+    def test_load_games_skips_snapshot(self):
+        write_games(self.records[:10], self.team_ids, storage=self.storage)
+        with tempfile.TemporaryDirectory() as path:
+            games = load_games(source="database", path=path, storage=self.storage)
+            self.assertIsNone(read_meta(path))
+        self.assertEqual(len(games), 10)
+
+    def test_snapshot_rebuilds_when_a_team_moves(self):
+        storage = CacheableMemoryStorage()
+        storage.teams = self.storage.teams
+        write_games(self.records[:10], self.team_ids, storage=storage)
+        kc = next(team_id for team_id, team in storage.teams.items() if team["ticker"] == "KC")
+        with tempfile.TemporaryDirectory() as path, mock.patch("builtins.print"):
+            games = load_games(source="database", path=path, storage=storage)
+            fingerprint = storage.fingerprint()
+            storage.teams[kc]["latitude"] = 10.0
+            self.assertNotEqual(storage.fingerprint(), fingerprint)
+            moved = load_games(source="database", path=path, storage=storage)
+        self.assertNotEqual(games.teams.latitude[games.teams.index[kc]], 10.0)
+        self.assertEqual(moved.teams.latitude[moved.teams.index[kc]], 10.0)
+
+
+class RatingHistoryTests(TestCase):
+
+    setUp = MemoryStorageTests.setUp
+
+    def test_lookups_match_replay(self):
+        games = to_game_arrays(self.records)
+        result = replay(games)
+        history = RatingHistory.from_replay(games, result)
+        self.assertEqual(len(history), len(result.week_end))
+
+        team_id = games.teams.ids[5]
+        row = int(np.flatnonzero(history.keys == 2015 * 100 + 5)[0])
+        self.assertEqual(history.rating(team_id, "2015-2016", "5"), result.weekly_elo[row, 5])
+        self.assertEqual(history.rating(team_id, 2015, "WildCard"), result.weekly_elo[row + 13, 5])
+        # weeks without games and the offseason keep the latest ratings
+        self.assertEqual(history.ratings_as_of("2015-2016", 23).tolist(),
+                         history.ratings_as_of("2016-2017", 0).tolist())
+        self.assertEqual(history.ratings_as_of("2009-2010", "1").tolist(), [1505] * len(games.teams))
+        self.assertEqual(history.ratings_as_of("2030-2031", "1").tolist(), result.elo.tolist())
+
+        keys, elo = history.series([team_id], start=("2015-2016", 0), end=("2015-2016", 99))
+        self.assertTrue(np.all(keys // 100 == 2015))
+        self.assertEqual(len(keys), 21)
+        self.assertEqual(elo[:, 0].tolist(), result.weekly_elo[row - 4:row + 17, 5].tolist())
+
+    def test_checkpoints_and_extend(self):
+        write_games(self.records, self.team_ids, storage=self.storage)
+        elo_sim.run(storage=self.storage)
+        games = load_game_arrays(storage=self.storage)
+        expected = RatingHistory.from_replay(games, replay(games))
+        history = load_history(games.teams.ids, storage=self.storage)
+        self.assertEqual(history.keys.tolist(), expected.keys.tolist())
+        self.assertEqual(history.elo.tolist(), expected.elo.tolist())
+
+        split = 100
+        head = RatingHistory(expected.team_ids, expected.keys[:split], expected.elo[:split])
+        tail = RatingHistory(expected.team_ids, expected.keys[split:], expected.elo[split:],
+                             expected.elo[split - 1])
+        self.assertEqual(head.extend(tail).elo.tolist(), expected.elo.tolist())
+        with self.assertRaises(ValueError):
+            tail.extend(head)
+        with self.assertRaises(ValueError):
+            head.extend(RatingHistory(expected.team_ids, expected.keys[split:], expected.elo[split:],
+                                      expected.elo[split - 2]))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "history")
+            expected.save(path)
+            loaded = RatingHistory.load(path, mmap_mode="r")
+            self.assertEqual(loaded.team_ids, expected.team_ids)
+            self.assertEqual(loaded.elo.tolist(), expected.elo.tolist())
+            with self.assertRaises(FileNotFoundError):
+                RatingHistory.load(tmp)
+
+        snapshot = rating_cache.RatingSnapshot(games.teams)
+        snapshot.history = history
+        chart = snapshot.team_history("sea", start="2020-2021", end="2020-2021")
+        self.assertEqual(chart["ticker"], "SEA")
+        self.assertEqual(chart["seasons"], ["2020-2021"] * len(chart["elo"]))
+        self.assertEqual(chart["weeks"][0], "1")
+        self.assertEqual(chart["elo"][-1], history.rating(games.teams.ids[snapshot.team_index("SEA")],
+                                                          "2020-2021", "SuperBowl"))
+
+    def test_week_ingested_in_two_runs(self):
+        storage = CacheableMemoryStorage()
+        storage.teams = self.storage.teams
+        records = [record for record in self.records if record.season == "2010-2011"]
+        week_17 = [i for i, record in enumerate(records) if record.week == "17"]
+        sunday, monday = records[:week_17[10]], records[week_17[10]:week_17[-1] + 1]
+
+        with tempfile.TemporaryDirectory() as tmp, mock.patch("builtins.print"):
+            path = os.path.join(tmp, "history")
+            with mock.patch.object(elo_sim, "save_history", partial(save_history, path=path)):
+                write_games(sunday, self.team_ids, storage=storage)
+                elo_sim.run_incremental(storage=storage)
+                write_games(monday, self.team_ids, storage=storage)
+                elo_sim.run_incremental(storage=storage)
+            saved = RatingHistory.load(path)
+
+        games = load_game_arrays(storage=storage)
+        expected = RatingHistory.from_replay(games, replay(games))
+        self.assertEqual(expected.keys[-1], 2010 * 100 + 17)
+        self.assertEqual(len(storage.checkpoints), len(expected) + 1)
+        for history in (saved, load_history(games.teams.ids, storage=storage)):
+            self.assertEqual(history.keys.tolist(), expected.keys.tolist())
+            self.assertEqual(history.elo.tolist(), expected.elo.tolist())
+
+
+class CacheableMemoryStorage(MemoryStorage):
+    "MemoryStorage that writes a rating history like the database."
+
+    cacheable = True
+
+
+class InstrumentationTests(TestCase):
+
+    def test_run_stats(self):
+        stats = RunStats("test", profile=True)
+        with stats.phase("compute"):
+            sum(range(1000))
+        self.assertEqual(list(stats.timed("parse", [1, 2, 3])), [1, 2, 3])
+        stats.count("documents", 3)
+        stats.count("documents")
+        stats.batch("games", 500)
+        stats.batch("games", 100)
+        summary = stats.summary()
+        self.assertEqual(summary["phases"]["compute"]["calls"], 1)
+        self.assertEqual(summary["phases"]["parse"]["calls"], 4)
+        self.assertEqual(summary["counters"], {"documents": 4})
+        self.assertEqual(summary["batches"]["games"], {"count": 2, "total": 600, "max": 500, "mean": 300})
+        self.assertTrue(summary["profile"])
+        self.assertGreaterEqual(summary["seconds"], summary["phases"]["compute"]["seconds"])
+
+    def test_script_summaries(self):
+        storage = MemoryStorage()
+        with tempfile.TemporaryDirectory() as tmp, mock.patch("builtins.print"):
+            path = os.path.join(tmp, "init_db.json")
+            summary = init_db.run(batch_size=200, storage=storage, summary_path=path)
+            self.assertTrue(os.path.exists(path))
+            sim = elo_sim.run(storage=storage)
+            incremental = elo_sim.run_incremental(storage=storage)
+        n_games = len(storage.games)
+        self.assertEqual(summary["counters"]["games_parsed"], n_games)
+        self.assertEqual(summary["counters"]["games_inserted"], n_games)
+        self.assertEqual(summary["batches"]["games"]["max"], 200)
+        self.assertEqual(sim["counters"]["games_written"], n_games)
+        self.assertEqual(sim["counters"]["checkpoints_written"], len(storage.checkpoints))
+        # only the bulk writes actually sent are reported, MemoryStorage sends none
+        self.assertEqual(sim["batches"], {})
+        self.assertEqual(set(sim["phases"]), {"load", "compute", "bulk_write", "history"})
+        self.assertEqual(incremental["counters"]["games_read"], 0)
+
+
+class RecordingCollection:
+    "Stands in for a pymongo collection and keeps the bulk writes."
+
+    name = "recording"
+
+    def __init__(self):
+        self.writes = []
+
+    def bulk_write(self, requests, ordered=True):
+        self.ordered = ordered
+        self.writes.append([(request._filter["_id"], request._doc["$set"]) for request in requests])
+
+
+class BulkWriterTests(TestCase):
+
+    def test_updates_are_coalesced_and_batched(self):
+        collection = RecordingCollection()
+        stats = RunStats("test")
+        with BulkWriter(collection, batch_size=2, stats=stats) as writer:
+            writer.set(1, {"elo": 1500})
+            writer.set(1, {"elo": 1510, "ticker": "KC"})
+            self.assertEqual(collection.writes, [])
+            writer.set(2, {"elo": 1490})
+            self.assertEqual(collection.writes, [[(1, {"elo": 1510, "ticker": "KC"}), (2, {"elo": 1490})]])
+            writer.set(3, {"elo": 1505})
+            writer.flush()
+            writer.flush()
+        self.assertEqual(len(collection.writes), 2)
+        self.assertFalse(collection.ordered)
+        self.assertEqual(writer.summary()["documents"], 3)
+        self.assertEqual(stats.counters, {"recording_updates": 4, "recording_coalesced": 1})
+        self.assertEqual(stats.batches["recording"]["total"], 3)
+
+        with BulkWriter(collection) as writer:
+            pass
+        self.assertEqual(len(collection.writes), 2)
+
+    def test_background_and_max_delay(self):
+        collection = RecordingCollection()
+        with BulkWriter(collection, batch_size=10, background=True, max_in_flight=1) as writer:
+            for i in range(95):
+                writer.set(i, {"elo": i})
+        self.assertEqual([doc_id for batch in collection.writes for doc_id, _ in batch], list(range(95)))
+        self.assertEqual(len(collection.writes), 10)
+
+        collection = RecordingCollection()
+        writer = BulkWriter(collection, batch_size=10, max_delay=0)
+        writer.set(1, {"elo": 1})
+        self.assertEqual(len(collection.writes), 1)
+
+    def test_mongo_storage_writes_through_buffer(self):
+        collection = RecordingCollection()
+        with mock.patch.object(Game, "_get_collection", return_value=collection):
+            MongoStorage(batch_size=2, background=True).set_pregame_elos([1, 2, 3], [1500, 1510, 1520],
+                                                                         [1490, 1480, 1470])
+        self.assertEqual(collection.writes, [
+            [(1, {"home_pregame_elo": 1500, "away_pregame_elo": 1490}),
+             (2, {"home_pregame_elo": 1510, "away_pregame_elo": 1480})],
+            [(3, {"home_pregame_elo": 1520, "away_pregame_elo": 1470})],
+        ])
+
+
+class FlatGamesTests(TestCase):
+
+    setUp = MemoryStorageTests.setUp
+
+    def test_flat_round_trip(self):
+        write_games(self.records[-20:], self.team_ids, storage=self.storage)
+        games = self.storage.game_records()
+        refs = team_refs(self.storage.team_records())
+        flat = [to_flat_record(game, refs) for game in games]
+
+        superbowl = flat[-1]
+        self.assertEqual(superbowl["week"], "SuperBowl")
+        self.assertEqual(set(superbowl["neutral_destination"]), {"team_id", "ticker", "latitude", "longitude"})
+        self.assertIsNone(flat[0]["neutral_destination"])
+        document = GameFlat._from_son(superbowl)
+        document.validate()
+        self.assertEqual(document.home_team.team_id, games[-1]["home_team"])
+
+        self.assertEqual([from_flat_record(game) for game in flat], games)
+        teams = TeamArrays.from_records(self.storage.team_records())
+        restored = GameArrays.from_records(map(from_flat_record, flat), teams)
+        self.assertEqual(restored.neutral.tolist(), GameArrays.from_records(games, teams).neutral.tolist())
+
+    def test_team_locations_come_from_the_games(self):
+        write_games(self.records[-20:], self.team_ids, storage=self.storage)
+        teams = self.storage.team_records()
+        refs = team_refs(teams)
+        flat = [to_flat_record(game, refs) for game in self.storage.game_records()]
+        kc = next(team["_id"] for team in teams if team["ticker"] == "KC")
+        for game in flat:
+            for field in ("home_team", "away_team"):
+                if game[field]["team_id"] == kc:
+                    game[field] = {**refs[kc], "latitude": 10.0}
+
+        games, locations = read_flat_games(flat)
+        self.assertEqual(games, self.storage.game_records())
+        self.assertEqual(locations[kc]["latitude"], 10.0)
+
+        class FlatStorage(MemoryStorage):
+            def game_records_with_teams(self, after=None):
+                return read_flat_games(flat)
+
+        storage = FlatStorage()
+        storage.__dict__.update(self.storage.__dict__)
+        arrays = load_game_arrays(storage=storage)
+        team_arrays = TeamArrays.from_records(teams)
+        self.assertEqual(arrays.teams.latitude[team_arrays.index[kc]], 10.0)
+        self.assertEqual(team_arrays.latitude[team_arrays.index[kc]], refs[kc]["latitude"])
+        self.assertEqual(load_game_arrays(storage=self.storage).teams.latitude[team_arrays.index[kc]],
+                         refs[kc]["latitude"])
+
+    def test_refresh_team_refs(self):
+        class Collection:
+            def bulk_write(self, requests, ordered=True):
+                self.requests = requests
+                return mock.Mock(modified_count=len(requests))
+
+        collection = Collection()
+        teams = self.storage.team_records()
+        with mock.patch.object(GameFlat, "_get_collection", return_value=collection):
+            self.assertEqual(refresh_team_refs(teams), 3 * len(teams))
+            self.assertEqual(refresh_team_refs([]), 0)
+        kc = next(team["_id"] for team in teams if team["ticker"] == "KC")
+        update = next(request for request in collection.requests
+                      if request._filter == {"away_team.team_id": kc})
+        team = next(team for team in teams if team["_id"] == kc)
+        self.assertEqual(update._doc, {"$set": {"away_team.ticker": "KC",
+                                                "away_team.latitude": team["latitude"],
+                                                "away_team.longitude": team["longitude"]}})
+
+    def test_season_week_index(self):
+        self.assertIn({"fields": [("season", 1), ("week", 1)]}, GameFlat._meta["index_specs"])
+
+
+class GameQueryTests(TestCase):
+
+    def setUp(self):
+        # querysets are built without a database connection
+        self.games = GameQuerySet(Game, None)
+
+    def test_indexes(self):
+        specs = [spec["fields"] for spec in Game._meta["index_specs"]]
+        self.assertIn([("season", 1), ("week", 1)], specs)
+        self.assertIn([("home_team", 1), ("season", 1)], specs)
+        self.assertIn([("away_team", 1), ("season", 1)], specs)
+
+    def test_week_query(self):
+        query = self.games.week("2022-2023", "WildCard", fields=("home_points", "away_points"))
+        self.assertEqual(query._query, {"season": "2022-2023", "week": "WildCard"})
+        self.assertEqual(query._loaded_fields.as_dict(), {"home_points": 1, "away_points": 1})
+        self.assertTrue(query._as_pymongo)
+
+    def test_season_and_team_queries(self):
+        query = self.games.season_games("2022-2023", weeks=range(1, 3))
+        self.assertEqual(query._query, {"season": "2022-2023", "week": {"$in": ["1", "2"]}})
+        team_id = ObjectId()
+        query = self.games.team_games(team_id, "2022-2023")
+        self.assertEqual(query._query, {"$or": [{"home_team": team_id, "season": "2022-2023"},
+                                                {"away_team": team_id, "season": "2022-2023"}]})
+
+
+class GameCacheTests(TestCase):
+
+    def test_snapshot_round_trip(self):
+        games = to_game_arrays(record for season in iter_season_records() for record in season)
+        with tempfile.TemporaryDirectory() as tmp:
+            save_snapshot(games, "abc", tmp + "/games")
+            self.assertEqual(read_meta(tmp + "/games")["source_hash"], "abc")
+            loaded = load_snapshot(tmp + "/games")
+            self.assertEqual(loaded.ids, games.ids)
+            self.assertEqual(loaded.teams.ids, games.teams.ids)
+            for column in games.COLUMNS:
+                self.assertTrue(np.array_equal(getattr(loaded, column), getattr(games, column)))
+            self.assertEqual(replay(loaded).elo.tolist(), replay(games).elo.tolist())
+
+    def test_missing_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.assertIsNone(read_meta(tmp))
+            with self.assertRaises(FileNotFoundError):
+                load_snapshot(tmp)
+
+
+class RollingWindowTests(TestCase):
+
+    setUp = EloEngineTests.setUp
+
+    def test_ring_buffer_order(self):
+        windows = RollingWindow(n_teams=2, window=3, n_stats=1)
+        windows.push(0, [1])
+        windows.push(0, [2])
+        self.assertTrue(np.array_equal(windows.snapshot(0).ravel(), [1, 2, np.nan], equal_nan=True))
+        windows.push(0, [3])
+        windows.push(0, [4])
+        self.assertEqual(windows.snapshot(0).ravel().tolist(), [2, 3, 4])
+        self.assertTrue(np.isnan(windows.snapshot(1)).all())
+
+    def test_snapshot_is_a_copy(self):
+        windows = RollingWindow(n_teams=1, window=2, n_stats=1)
+        windows.push(0, [1])
+        snapshot = windows.snapshot(0)
+        windows.push(0, [2])
+        self.assertTrue(np.isnan(snapshot[1, 0]))
+
+    def test_build_window_features(self):
+        teams = TeamArrays.from_records(self.team_records)
+        games = GameArrays.from_records(self.game_records, teams)
+        features = build_window_features(games, window=2, warmup_seasons=1)
+        self.assertEqual(features.columns, feature_columns(2))
+        self.assertEqual(features.matrix.shape, (2, 2 * (1 + 8 * 2)))
+        self.assertEqual(features.game_index.tolist(), [5, 6])
+        self.assertEqual(features.week_number.tolist(), [1, 2])
+
+        # SEA hosts KC in the first game of 2011, SEA's last games were
+        # the week 2 tie with DAL and the super bowl loss to DAL
+        row = dict(zip(features.columns, features.matrix[0]))
+        self.assertEqual([row["home_points_for_0"], row["home_points_for_1"]], [10, 17])
+        self.assertEqual([row["home_points_against_0"], row["home_points_against_1"]], [10, 20])
+        # KC's last two games were week 3 and the wild card game
+        self.assertEqual([row["away_points_for_0"], row["away_points_for_1"]], [38, 24])
+
+    def test_window_state_matches_pushing(self):
+        games = to_game_arrays([record for season in iter_season_records() for record in season])
+        home_stats, away_stats = team_stats(games)
+        windows = RollingWindow(len(games.teams), 14)
+        for end in range(0, 700):
+            if end in (0, 1, 267, 699):
+                state = window_state(games, end)
+                self.assertTrue(np.array_equal(state.buffer, windows.buffer, equal_nan=True))
+                self.assertEqual(state.count.tolist(), windows.count.tolist())
+            windows.push(games.home[end], home_stats[end])
+            windows.push(games.away[end], away_stats[end])
+
+    def test_features_by_season_match_sequential(self):
+        games = to_game_arrays([record for season in iter_season_records() for record in season])
+        expected = build_window_features(games, window=6, stats=("points_for", "yards_against"))
+        for n_workers in (1, 2):
+            features = build_window_features_by_season(games, window=6, stats=("points_for", "yards_against"),
+                                                       n_workers=n_workers)
+            self.assertTrue(np.array_equal(features.matrix, expected.matrix, equal_nan=True))
+            self.assertEqual(features.game_index.tolist(), expected.game_index.tolist())
+            self.assertEqual(features.week_number.tolist(), expected.week_number.tolist())
+            self.assertEqual(features.columns, expected.columns)
+        empty = build_window_features_by_season(games, window=6, warmup_seasons=20)
+        self.assertEqual(empty.matrix.shape, (0, 2 * (1 + 8 * 6)))
+
+
+class NNDatasetTests(TestCase):
+
+    setUp = EloEngineTests.setUp
+
+    def test_build_nn_dataset(self):
+        teams = TeamArrays.from_records(self.team_records)
+        games = GameArrays.from_records(self.game_records, teams)
+        dataset = build_nn_dataset(games, window=2, features=["points_for", "points_against"])
+        self.assertEqual(dataset.matrix.shape, (2, 2 * (1 + 2 * 2)))
+        self.assertEqual(dataset.labels.tolist(), [1, -28])
+        # building twice gives the same result
+        again = build_nn_dataset(games, window=2, features=["points_for", "points_against"])
+        self.assertTrue(np.array_equal(dataset.matrix, again.matrix))
+
+    def test_unknown_feature(self):
+        teams = TeamArrays.from_records(self.team_records)
+        games = GameArrays.from_records(self.game_records, teams)
+        with self.assertRaises(ValueError):
+            build_nn_dataset(games, features=["passing_yards"])
+
+    def test_to_nndata_documents(self):
+        teams = TeamArrays.from_records(self.team_records)
+        games = GameArrays.from_records(self.game_records, teams)
+        documents = to_nndata_documents(build_nn_dataset(games, window=3))
+        self.assertEqual(len(documents), 2)
+        self.assertEqual(documents[0].home_points_for, [25, 10, 17])
+        self.assertEqual(documents[1].home_points_for, [38, 24, 13])
+        self.assertIsNot(documents[0].home_points_for, documents[1].home_points_for)
+
+
+class NNExportTests(TestCase):
+
+    def setUp(self):
+        games = to_game_arrays(record for season in iter_season_records() for record in season)
+        self.dataset = build_nn_dataset(games, window=3)
+
+    def test_export_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            export_nn_dataset(self.dataset, tmp, chunk_rows=1000)
+            reader = NNDataReader(tmp)
+            self.assertEqual(len(reader), len(self.dataset.labels))
+            self.assertEqual(reader.columns, self.dataset.columns)
+            self.assertEqual(reader.features.dtype, np.float32)
+
+            batches = list(reader.iter_batches(batch_size=500))
+            features = np.concatenate([batch[0] for batch in batches])
+            labels = np.concatenate([batch[1] for batch in batches])
+            self.assertTrue(np.array_equal(features, self.dataset.matrix.astype(np.float32), equal_nan=True))
+            self.assertTrue(np.array_equal(labels, self.dataset.labels))
+
+            shuffled = list(reader.iter_batches(batch_size=500, shuffle=True, seed=1, drop_last=True))
+            self.assertEqual(len(shuffled), len(reader) // 500)
+            self.assertEqual(sum(len(batch[1]) for batch in shuffled), len(reader) // 500 * 500)
+
+    def test_nndata_row_matches_dataset(self):
+        document = to_nndata_documents(self.dataset)[100].to_mongo().to_dict()
+        row = np.empty(self.dataset.matrix.shape[1], dtype=np.float32)
+        nndata_row(document, 3, row)
+        self.assertTrue(np.array_equal(row, self.dataset.matrix[100].astype(np.float32), equal_nan=True))
+
+
+class BenchmarkTests(TestCase):
+
+    setUp = EloEngineTests.setUp
+
+    def test_scale_up_keeps_history_chronological(self):
+        teams = TeamArrays.from_records(self.team_records)
+        games = GameArrays.from_records(self.game_records, teams)
+        scaled = scale_up(games, 3)
+        self.assertEqual(len(scaled), 3 * len(games))
+        self.assertEqual(np.unique(scaled.season).tolist(), list(range(2010, 2016)))
+        self.assertTrue((np.diff(scaled.season) >= 0).all())
+        self.assertEqual(scaled.home_points[len(games):2 * len(games)].tolist(), games.home_points.tolist())
+
+    def test_measure_and_compare(self):
+        result = measure("power_matrix_32", 1, repeat=2, min_time=0)
+        self.assertEqual(result["n_items"], 32 * 32)
+        self.assertLessEqual(result["min"], result["median"])
+
+        baseline = {"results": [dict(result, min=result["min"] / 2)]}
+        comparison = compare({"results": [result]}, baseline, threshold=1.5)
+        self.assertEqual(len(comparison), 1)
+        self.assertTrue(comparison[0]["regression"])
+        self.assertEqual(compare({"results": [result]}, {"results": []}), [])
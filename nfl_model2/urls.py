@@ -4,4 +4,11 @@ from . import views
 
 urlpatterns = [
     path("", views.index, name="index"),
-]
\ No newline at end of file
+    path("ratings/", views.ratings, name="ratings"),
+    path("matchup/", views.matchup, name="matchup"),
+    path("matchups/", views.matchups, name="matchups"),
+    path("power-matrix/", views.power_matrix, name="power_matrix"),
+    path("spreads/<str:season>/<str:week>/", views.week_spreads, name="week_spreads"),
+    path("history/<str:ticker>/", views.team_history, name="team_history"),
+    path("predictions/<str:season>/<str:week>/", views.week_predictions, name="week_predictions"),
+]
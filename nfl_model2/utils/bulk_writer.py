@@ -0,0 +1,145 @@
+"""
+This module contains a write-behind buffer for $set updates.
+
+Updates are collected per document id, so setting several fields of a
+document or setting the same field again before a flush sends a single
+UpdateOne. The buffer is flushed with an unordered bulk write when it holds
+batch_size documents or its oldest update is max_delay seconds old, and
+never with an empty batch. Flushes can run on a background thread so the
+caller keeps computing while a batch is in flight.
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import UpdateOne
+
+
+class BulkWriter:
+    """
+    Buffers $set updates of one collection.
+
+    Parameters
+    ----------
+    collection : pymongo.collection.Collection
+        Collection the updates are written to.
+    batch_size : int
+        Number of documents that triggers a flush.
+    max_delay : float, optional
+        Age in seconds of the oldest buffered update that triggers a flush
+        on the next update.
+    background : bool
+        Send the bulk writes from a background thread. At most
+        max_in_flight batches are waiting to be written at any time.
+    max_in_flight : int
+        Number of background batches after which set waits for the oldest.
+    name : str, optional
+        Name of the writes in stats, defaults to the collection name.
+    stats : RunStats, optional
+        Records the size of every bulk write, see instrumentation.RunStats.
+
+    Examples
+    --------
+    >>> with BulkWriter(Team._get_collection()) as writer:
+    ...     writer.set(team_id, {"elo": 1510})
+    """
+
+    def __init__(self, collection, batch_size: int = 1000, max_delay: float = None,
+                 background: bool = False, max_in_flight: int = 2, name: str = None, stats=None):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_in_flight = max_in_flight
+        self.name = name or collection.name
+        self.stats = stats
+        self.updates = 0
+        self.coalesced = 0
+        self.documents = 0
+        self.batches = 0
+        self.write_seconds = 0.0
+        self._pending = {}
+        self._pending_since = None
+        self._lock = threading.Lock()
+        self._in_flight = deque()
+        self._executor = ThreadPoolExecutor(max_workers=1) if background else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def set(self, doc_id, fields: dict) -> None:
+        "Buffers a $set of fields on the document with id doc_id."
+        pending = self._pending.get(doc_id)
+        if pending is None:
+            self._pending[doc_id] = dict(fields)
+            if self._pending_since is None:
+                self._pending_since = time.monotonic()
+        else:
+            pending.update(fields)
+            self.coalesced += 1
+        self.updates += 1
+
+        if len(self._pending) >= self.batch_size or (
+                self.max_delay is not None and time.monotonic() - self._pending_since >= self.max_delay):
+            self.flush()
+
+    def flush(self) -> None:
+        "Sends the buffered updates, in the background if enabled."
+        if not self._pending:
+            return
+        updates = [UpdateOne({"_id": doc_id}, {"$set": fields}) for doc_id, fields in self._pending.items()]
+        self._pending = {}
+        self._pending_since = None
+        if self._executor is None:
+            self._write(updates)
+            return
+        self._in_flight.append(self._executor.submit(self._write, updates))
+        while len(self._in_flight) > self.max_in_flight:
+            self._in_flight.popleft().result()
+
+    def _write(self, updates: list) -> None:
+        start = time.perf_counter()
+        self.collection.bulk_write(updates, ordered=False)
+        with self._lock:
+            self.write_seconds += time.perf_counter() - start
+            self.documents += len(updates)
+            self.batches += 1
+            if self.stats is not None:
+                self.stats.batch(self.name, len(updates))
+
+    def close(self) -> None:
+        """
+        Flushes the buffer and waits for the background writes. Errors of
+        background writes are raised here.
+        """
+        try:
+            self.flush()
+            while self._in_flight:
+                self._in_flight.popleft().result()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+        if self.stats is not None and self.updates:
+            self.stats.count(f"{self.name}_updates", self.updates)
+            self.stats.count(f"{self.name}_coalesced", self.coalesced)
+            # counted once even if close is called again
+            self.stats = None
+
+    def summary(self) -> dict:
+        "Counters of the writer."
+        with self._lock:
+            return {
+                "updates": self.updates,
+                "coalesced": self.coalesced,
+                "documents": self.documents,
+                "batches": self.batches,
+                "write_seconds": self.write_seconds,
+            }
@@ -0,0 +1,159 @@
+"""
+This module migrates the Game collection to the denormalized GameFlat
+collection and converts between the two.
+
+GameFlat documents embed the id, ticker and coordinates of their teams, so
+the whole history and the team locations the replay needs are read with a
+single scan of one collection, see read_flat_games. The embedded teams are
+copies, refresh_team_refs updates them after a team moves. The
+migration copies the games in id order with upserts keyed by id, so it can
+be re-run at any time or only for the games added since the last run.
+Reading the flat collection is enabled with MongoStorage(flat=True).
+"""
+
+from pymongo import ReplaceOne, UpdateMany
+
+from ..models import Team, Game, GameFlat, connect_to_database
+
+TEAM_REF_FIELDS = ("ticker", "latitude", "longitude")
+TEAM_FIELDS = ("home_team", "away_team", "neutral_destination")
+
+
+def team_refs(team_records) -> dict:
+    "Maps team ids to the embedded TeamRef of the team."
+    return {
+        team["_id"]: {"team_id": team["_id"], **{field: team.get(field) for field in TEAM_REF_FIELDS}}
+        for team in team_records
+    }
+
+def to_flat_record(game: dict, refs: dict) -> dict:
+    "Converts a raw Game document into a raw GameFlat document."
+    flat = dict(game)
+    for field in TEAM_FIELDS:
+        team_id = game.get(field)
+        flat[field] = None if team_id is None else refs[team_id]
+    return flat
+
+def from_flat_record(flat: dict, refs: dict = None) -> dict:
+    """
+    Converts a raw GameFlat document back into the shape of a raw Game
+    document. The embedded teams are added to refs by team id if it is given.
+    """
+    game = dict(flat)
+    for field in TEAM_FIELDS:
+        team = flat.get(field)
+        if team is None:
+            game[field] = None
+        else:
+            game[field] = team["team_id"]
+            if refs is not None:
+                refs[team["team_id"]] = team
+    return game
+
+def read_flat_games(flat_games) -> tuple[list[dict], dict]:
+    """
+    Converts raw GameFlat documents back into raw Game documents.
+
+    Returns
+    -------
+    tuple[list[dict], dict]
+        The games and the embedded TeamRef of every team that played or
+        hosted one of them, by team id.
+    """
+    refs = {}
+    games = [from_flat_record(flat, refs) for flat in flat_games]
+    return games, refs
+
+def write_flat_games(games, refs: dict, batch_size: int = 1000) -> int:
+    """
+    Upserts raw Game documents into the GameFlat collection.
+
+    Returns
+    -------
+    int
+        Number of games written.
+    """
+    collection = GameFlat._get_collection()
+    written = 0
+    batch = []
+    for game in games:
+        flat = to_flat_record(game, refs)
+        batch.append(ReplaceOne({"_id": flat["_id"]}, flat, upsert=True))
+        if len(batch) >= batch_size:
+            collection.bulk_write(batch, ordered=False)
+            written += len(batch)
+            batch.clear()
+    if batch:
+        collection.bulk_write(batch, ordered=False)
+        written += len(batch)
+    return written
+
+def refresh_team_refs(team_records) -> int:
+    """
+    Copies the ticker and coordinates of every team into the GameFlat
+    documents that embed it. Run it after a team is moved or renamed, the
+    games keep the old location until then.
+
+    Returns
+    -------
+    int
+        Number of games modified.
+    """
+    updates = [
+        UpdateMany({f"{field}.team_id": ref["team_id"]},
+                   {"$set": {f"{field}.{name}": ref[name] for name in TEAM_REF_FIELDS}})
+        for ref in team_refs(team_records).values() for field in TEAM_FIELDS
+    ]
+    if not updates:
+        return 0
+    return GameFlat._get_collection().bulk_write(updates, ordered=False).modified_count
+
+def migrate(after=None, batch_size: int = 1000) -> int:
+    """
+    Copies the Game collection into the GameFlat collection and creates
+    its (season, week) index. A database connection must already be open.
+
+    Parameters
+    ----------
+    after : ObjectId, optional
+        Only copy the games inserted after the game with this id.
+    batch_size : int
+        Number of games in each bulk write.
+
+    Returns
+    -------
+    int
+        Number of games copied.
+    """
+    GameFlat.ensure_indexes()
+    refs = team_refs(Team.objects.as_pymongo())
+    games = Game.objects
+    if after is not None:
+        games = games(id__gt=after)
+    games = games.order_by("id").as_pymongo().batch_size(batch_size)
+    return write_flat_games(games, refs, batch_size)
+
+def run(incremental: bool = False):
+    """
+    Migrates the Game collection to GameFlat.
+
+    Parameters
+    ----------
+    incremental : bool
+        Only copy the games added since the newest GameFlat document and
+        refresh the teams embedded in the games copied before.
+    """
+    connect_to_database()
+
+    after = None
+    if incremental:
+        latest = GameFlat.objects.order_by("-id").only("id").as_pymongo().first()
+        after = latest and latest["_id"]
+    written = migrate(after=after)
+    print(f"{written} games copied to the {GameFlat._get_collection_name()} collection.")
+    if incremental:
+        refreshed = refresh_team_refs(Team.objects.as_pymongo())
+        print(f"Teams refreshed in {refreshed} games.")
+
+if __name__ == "__main__":
+    run()
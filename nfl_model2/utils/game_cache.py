@@ -0,0 +1,189 @@
+"""
+This module contains a local columnar snapshot of the game history.
+
+Every column of GameArrays and TeamArrays is stored as a .npy file so the
+snapshot can be memory mapped, next to a meta.json file holding the snapshot
+format version and a hash of the source it was built from. Scripts read the
+snapshot instead of pulling the whole Game collection from the database and
+the snapshot is only rebuilt when the source changes.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+from bson import ObjectId
+
+from ..storage import Storage, get_storage
+from ..elo.elo_engine import TeamArrays, GameArrays, load_game_arrays
+from .ingest import DATA_DIR, season_files, iter_season_records, to_game_arrays
+
+CACHE_DIR = os.path.join(DATA_DIR, "cache")
+
+# bump when the layout of the snapshot changes
+SNAPSHOT_VERSION = 1
+
+TEAM_COLUMNS = ("latitude", "longitude", "elo")
+
+
+def data_files_hash(data_dir: str = DATA_DIR) -> str:
+    "Hashes the contents of the season data files."
+    digest = hashlib.sha256()
+    for path in season_files(data_dir):
+        digest.update(os.path.basename(path).encode())
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def database_fingerprint(storage: Storage = None) -> str:
+    """
+    Fingerprints the Team and Game collections without reading them, see
+    Storage.fingerprint. A database connection must already be open.
+    """
+    return get_storage(storage).fingerprint()
+
+def _id_type(ids) -> str:
+    if ids and isinstance(ids[0], ObjectId):
+        return "objectid"
+    if ids and isinstance(ids[0], int):
+        return "int"
+    return "str"
+
+def _restore_ids(values, id_type):
+    if id_type == "objectid":
+        return [ObjectId(value) for value in values]
+    if id_type == "int":
+        return [int(value) for value in values]
+    return [str(value) for value in values]
+
+def save_snapshot(games: GameArrays, source_hash: str, path: str = CACHE_DIR) -> None:
+    """
+    Writes a snapshot of the games and their teams. The snapshot is written
+    to a temporary directory first and then moved into place so readers
+    never see a half written snapshot.
+
+    Parameters
+    ----------
+    games : GameArrays
+        Games to be stored.
+    source_hash : str
+        Hash of the source the games were loaded from.
+    path : str
+        Snapshot directory.
+    """
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    teams = games.teams
+    for column in GameArrays.COLUMNS:
+        np.save(os.path.join(tmp_path, f"game_{column}.npy"), getattr(games, column))
+    for column in TEAM_COLUMNS:
+        np.save(os.path.join(tmp_path, f"team_{column}.npy"), getattr(teams, column))
+    np.save(os.path.join(tmp_path, "game_ids.npy"), np.array([str(i) for i in games.ids]))
+
+    meta = {
+        "version": SNAPSHOT_VERSION,
+        "source_hash": source_hash,
+        "n_games": len(games),
+        "game_id_type": _id_type(games.ids),
+        "team_id_type": _id_type(teams.ids),
+        "team_ids": [str(i) for i in teams.ids],
+        "team_names": teams.names,
+        "team_tickers": teams.tickers,
+    }
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+def read_meta(path: str = CACHE_DIR):
+    "Reads the snapshot metadata or returns None if there is no usable snapshot."
+    try:
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != SNAPSHOT_VERSION:
+        return None
+    return meta
+
+def load_snapshot(path: str = CACHE_DIR, mmap_mode: str = "r") -> GameArrays:
+    """
+    Loads a snapshot written by save_snapshot.
+
+    Parameters
+    ----------
+    path : str
+        Snapshot directory.
+    mmap_mode : str, optional
+        Passed to np.load, use None to read the columns into memory.
+
+    Raises
+    ------
+    FileNotFoundError
+        If there is no snapshot with the current version at path.
+    """
+    meta = read_meta(path)
+    if meta is None:
+        raise FileNotFoundError(f"no snapshot found at {path}")
+
+    def column(name):
+        return np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+
+    teams = TeamArrays(
+        ids=_restore_ids(meta["team_ids"], meta["team_id_type"]),
+        names=meta["team_names"],
+        tickers=meta["team_tickers"],
+        **{name: column(f"team_{name}") for name in TEAM_COLUMNS}
+    )
+    game_ids = _restore_ids(column("game_ids").tolist(), meta["game_id_type"])
+    return GameArrays(teams, game_ids,
+                      **{name: column(f"game_{name}") for name in GameArrays.COLUMNS})
+
+def load_games(source: str = "files", path: str = None, refresh: bool = False,
+               storage: Storage = None) -> GameArrays:
+    """
+    Loads the game history from the local snapshot, rebuilding the snapshot
+    first if its source has changed.
+
+    Parameters
+    ----------
+    source : str
+        'files' to build the snapshot from the season data files or
+        'database' to build it from the Game collection. The database
+        source needs an open connection.
+    path : str, optional
+        Snapshot directory. Defaults to a directory per source in CACHE_DIR.
+    refresh : bool
+        Rebuild the snapshot even if the source hasn't changed.
+    storage : Storage, optional
+        Storage read by the database source, defaults to the database.
+        Storage that isn't cacheable, like MemoryStorage, is read directly
+        without a snapshot.
+    """
+    if source == "files":
+        source_hash = data_files_hash()
+    elif source == "database":
+        storage = get_storage(storage)
+        if not storage.cacheable:
+            return load_game_arrays(storage=storage)
+        source_hash = database_fingerprint(storage)
+    else:
+        raise ValueError(f"unknown source {source!r}")
+    if path is None:
+        path = os.path.join(CACHE_DIR, source)
+
+    meta = read_meta(path)
+    if refresh or meta is None or meta["source_hash"] != source_hash:
+        if source == "files":
+            games = to_game_arrays(record for season in iter_season_records() for record in season)
+        else:
+            games = load_game_arrays(storage=storage)
+        save_snapshot(games, source_hash, path)
+        print(f"Snapshot of {len(games)} games written to {path}")
+
+    return load_snapshot(path)
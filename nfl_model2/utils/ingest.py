@@ -0,0 +1,303 @@
+"""
+This module contains a streaming ingest pipeline for the season data files.
+
+Every nfl_model2/data/NFL_*.txt file is parsed with a csv reader into
+lightweight GameRecord tuples, team names are resolved through a single
+normalization table and every row is validated. Files are parsed in a
+process pool and the records are upserted into the Game collection in bulk
+batches keyed by season, week, home team and away team, so running the
+ingest twice doesn't create duplicate games.
+"""
+
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from typing import NamedTuple, Iterator
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from ..elo.elo_engine import TeamArrays, GameArrays
+from ..storage import get_storage
+from .init_db import teams, superbowl_locations, normalize_team_name
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+HEADER = "Week"
+N_COLUMNS = 14
+
+
+class GameRecord(NamedTuple):
+    "A single game from a season data file with the home team first."
+    season: str
+    week: str
+    day: str
+    home_team: str
+    away_team: str
+    home_points: int
+    away_points: int
+    home_yards: int
+    away_yards: int
+    home_turnovers: int
+    away_turnovers: int
+    neutral_destination: str
+
+
+def season_from_filename(path: str) -> str:
+    "Converts a data file name like NFL_2022.txt into the season 2022-2023."
+    start_year = int(os.path.basename(path).split("_")[1].split(".")[0])
+    return f"{start_year}-{start_year + 1}"
+
+def parse_row(cols: list, season: str) -> GameRecord:
+    """
+    Converts one row of a season data file into a GameRecord.
+
+    Parameters
+    ----------
+    cols : list
+        Columns of the row.
+    season : str
+        Season that the game is played in ex. 2022-2023
+
+    Raises
+    ------
+    ValueError
+        If the row is malformed.
+    """
+    if len(cols) != N_COLUMNS:
+        raise ValueError(f"expected {N_COLUMNS} columns, got {len(cols)}")
+
+    week, day, date, _, winner, symbol, loser = cols[:7]
+    winner = normalize_team_name(winner)
+    loser = normalize_team_name(loser)
+    for name in (winner, loser):
+        if name not in teams:
+            raise ValueError(f"unknown team {name!r}")
+    if not week:
+        raise ValueError("missing week")
+
+    winner_points, loser_points, winner_yards, winner_turnovers, loser_yards, loser_turnovers = (
+        int(value) for value in cols[8:14]
+    )
+
+    neutral_destination = None
+    if symbol == "@":
+        return GameRecord(season, week, day, loser, winner, loser_points, winner_points,
+                          loser_yards, winner_yards, loser_turnovers, winner_turnovers, None)
+    elif symbol == "N":
+        # default neutral game destination to superbowl destination
+        try:
+            neutral_destination = superbowl_locations[date.split("-")[0]]
+        except KeyError:
+            raise ValueError(f"unknown Super Bowl site of {date!r}") from None
+    elif symbol != "":
+        raise ValueError(f"unknown location symbol {symbol!r}")
+
+    return GameRecord(season, week, day, winner, loser, winner_points, loser_points,
+                      winner_yards, loser_yards, winner_turnovers, loser_turnovers,
+                      neutral_destination)
+
+def parse_season_file(path: str) -> list[GameRecord]:
+    """
+    Parses a season data file. Header rows and the playoffs separator row
+    are skipped.
+
+    Raises
+    ------
+    ValueError
+        If a row is malformed, the message contains the file and line.
+    """
+    season = season_from_filename(path)
+    records = []
+    with open(path, "r", newline="") as f:
+        for line_number, cols in enumerate(csv.reader(f), start=1):
+            if not cols or cols[0] == HEADER or cols[2:3] == ["Playoffs"]:
+                continue
+            try:
+                records.append(parse_row(cols, season))
+            except ValueError as e:
+                raise ValueError(f"{path}:{line_number}: {e}") from None
+    return records
+
+def season_files(data_dir: str = DATA_DIR) -> list[str]:
+    "Lists the season data files in chronological order."
+    files = [file for file in os.listdir(data_dir) if file.startswith("NFL_") and file.endswith(".txt")]
+    return [os.path.join(data_dir, file) for file in sorted(files)]
+
+def iter_season_records(data_dir: str = DATA_DIR, n_workers: int = 1) -> Iterator[list[GameRecord]]:
+    """
+    Parses every season data file and yields the records of one season at
+    a time in chronological order.
+
+    Parameters
+    ----------
+    data_dir : str
+        Directory containing the NFL_*.txt files.
+    n_workers : int
+        Number of processes used to parse the files.
+    """
+    files = season_files(data_dir)
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            yield from executor.map(parse_season_file, files)
+    else:
+        for file in files:
+            yield parse_season_file(file)
+
+def game_upsert_fields(record: GameRecord, team_ids: dict) -> tuple[dict, dict, dict]:
+    """
+    Splits a game record into the fields of an upsert keyed by season,
+    week, home and away team.
+
+    Parameters
+    ----------
+    record : GameRecord
+        Game to be written.
+    team_ids : dict
+        Maps team names to their database ids.
+
+    Returns
+    -------
+    tuple[dict, dict, dict]
+        The key of the game, the fields set on every write and the fields
+        only set when the game is inserted.
+    """
+    key = {
+        "season": record.season,
+        "week": record.week,
+        "home_team": team_ids[record.home_team],
+        "away_team": team_ids[record.away_team],
+    }
+    neutral = record.neutral_destination
+    fields = {
+        "day": record.day,
+        "home_points": record.home_points,
+        "away_points": record.away_points,
+        "home_yards": record.home_yards,
+        "away_yards": record.away_yards,
+        "home_turnovers": record.home_turnovers,
+        "away_turnovers": record.away_turnovers,
+        "neutral_destination": None if neutral is None else team_ids[neutral],
+    }
+    # ids are generated here rather than by the server so that games are
+    # ordered by id in the order they were read, even with unordered writes
+    on_insert = {
+        "_id": ObjectId(),
+        "home_pregame_elo": 0,
+        "away_pregame_elo": 0,
+        "home_bye": False,
+        "away_bye": False,
+    }
+    return key, fields, on_insert
+
+def game_upsert(record: GameRecord, team_ids: dict, updated: datetime = None) -> list[UpdateOne]:
+    """
+    Creates the writes of a game keyed by season, week, home and away team:
+    an upsert that only inserts the game if it is new and an update that
+    only matches the game if one of its fields changed. Both stamp the game
+    with updated, so a corrected game changes Storage.fingerprint. Pregame
+    elos are only set when the game is inserted so that re-running the
+    ingest doesn't reset them.
+
+    Parameters
+    ----------
+    record : GameRecord
+        Game to be written.
+    team_ids : dict
+        Maps team names to their database ids.
+    updated : datetime, optional
+        Time of the write, defaults to now.
+    """
+    if updated is None:
+        updated = datetime.now(timezone.utc)
+    key, fields, on_insert = game_upsert_fields(record, team_ids)
+    changed = {**key, "$or": [{field: {"$ne": value}} for field, value in fields.items()]}
+    return [
+        UpdateOne(key, {"$setOnInsert": {**on_insert, **fields, "updated": updated}}, upsert=True),
+        UpdateOne(changed, {"$set": {**fields, "updated": updated}}),
+    ]
+
+def write_games(records, team_ids: dict, batch_size: int = 500, storage=None,
+                stats=None) -> tuple[int, int]:
+    """
+    Upserts game records in bulk batches.
+
+    Parameters
+    ----------
+    records : iterable of GameRecord
+        Games to be written.
+    team_ids : dict
+        Maps team names to their database ids.
+    batch_size : int
+        Number of upserts sent in each bulk write.
+    storage : Storage, optional
+        Where the games are written, defaults to the Game collection.
+    stats : RunStats, optional
+        Records the time and size of every bulk write, see
+        instrumentation.RunStats.
+
+    Returns
+    -------
+    tuple[int, int]
+        Number of inserted and modified games.
+    """
+    storage = get_storage(storage)
+    inserted = modified = 0
+    batch = []
+
+    def flush():
+        if stats is None:
+            return storage.upsert_games(batch, team_ids)
+        with stats.phase("bulk_write"):
+            result = storage.upsert_games(batch, team_ids)
+        stats.batch("games", len(batch))
+        stats.count("games_inserted", result[0])
+        stats.count("games_modified", result[1])
+        return result
+
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            batch_inserted, batch_modified = flush()
+            inserted += batch_inserted
+            modified += batch_modified
+            batch.clear()
+    if batch:
+        batch_inserted, batch_modified = flush()
+        inserted += batch_inserted
+        modified += batch_modified
+    return inserted, modified
+
+def league_team_arrays(elo_mean: int = 1505) -> TeamArrays:
+    """
+    Builds the teams from the team table in init_db without a database.
+    Former franchise names are skipped and the team names are used as ids.
+    """
+    names = [name for name in teams if normalize_team_name(name) == name]
+    return TeamArrays(
+        ids=names,
+        names=names,
+        tickers=[teams[name][2] for name in names],
+        latitude=[teams[name][0] for name in names],
+        longitude=[teams[name][1] for name in names],
+        elo=[elo_mean] * len(names),
+    )
+
+def to_game_arrays(records, team_arrays: TeamArrays = None) -> GameArrays:
+    """
+    Converts game records into arrays without a database. Games are
+    numbered in the order of the records.
+
+    Parameters
+    ----------
+    records : iterable of GameRecord
+        Games in replay order.
+    team_arrays : TeamArrays, optional
+        Teams with the team names as ids. Defaults to league_team_arrays().
+    """
+    if team_arrays is None:
+        team_arrays = league_team_arrays()
+    return GameArrays.from_records(
+        ({"_id": i, **record._asdict()} for i, record in enumerate(records)), team_arrays
+    )
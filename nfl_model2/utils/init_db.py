@@ -5,10 +5,9 @@ The resulting database contains the core elements of the website data with
 Seasons, Teams, Games, and Weeks, tables. 
 """
 
-import os
-import mongoengine
-
-from ..models import Team, Game, connect_to_database
+from ..models import connect_to_database, create_indexes
+from ..storage import MongoStorage, get_storage
+from .instrumentation import RunStats
 
 teams = {
     "Kansas City Chiefs": [39.099789, -94.578560, "KC"],
@@ -66,177 +65,110 @@ superbowl_locations = {
     '2025': 'New Orleans Saints'
 }
 
-def create_teams(db_teams: dict[str: Team], elo_mean: int) -> None:
+# former names of franchises mapped to the name they are stored under
+team_name_aliases = {
+    "Oakland Raiders": "Las Vegas Raiders",
+    "San Diego Chargers": "Los Angeles Chargers",
+    "St. Louis Rams": "Los Angeles Rams",
+    "Washington Redskins": "Washington Commanders",
+    "Washington Football Team": "Washington Commanders",
+}
+
+# current divisions, conferences are the first and second four divisions
+divisions = {
+    "AFC East": ["BUF", "MIA", "NE", "NYJ"],
+    "AFC North": ["BAL", "CIN", "CLE", "PIT"],
+    "AFC South": ["HOU", "IND", "JAC", "TEN"],
+    "AFC West": ["DEN", "KC", "LV", "LAC"],
+    "NFC East": ["DAL", "NYG", "PHI", "WAS"],
+    "NFC North": ["CHI", "DET", "GB", "MIN"],
+    "NFC South": ["ATL", "CAR", "NO", "TB"],
+    "NFC West": ["ARI", "LAR", "SF", "SEA"],
+}
+
+def normalize_team_name(name: str) -> str:
+    "Resolves former franchise names to the name the team is stored under."
+    return team_name_aliases.get(name, name)
+
+def create_teams(team_ids: dict, elo_mean: int, storage=None) -> None:
     """
     Inserts teams into the database if they don't already exist
     
     Parameters
     ----------
-    db_teams : dict[str: Team]
-        Dictionary of team objects with their team name as keys.
+    team_ids : dict
+        Database ids of the existing teams with their team name as keys.
+        The ids of the inserted teams are added.
     elo_mean : int
         Chosen mean value for elo.
+    storage : Storage, optional
+        Where the teams are inserted, defaults to the database.
     """
-
+    new_teams = {}
     for name, value in teams.items():
-        if name in db_teams.keys():
+        name = normalize_team_name(name)
+        if name in team_ids or name in new_teams:
             print("team exists")
         else:
-            if name == 'Oakland Raiders':
-                name = 'Las Vegas Raiders'
-            elif name == 'San Diego Chargers':
-                name = 'Los Angeles Chargers'
-            elif name == 'St. Louis Rams':
-                name = 'Los Angeles Rams'
-            elif 'Washington' in name:
-                name = 'Washington Commanders'
-
-            Team(name=name, ticker=value[2], latitude=value[0], longitude=value[1], elo=elo_mean).save()
-
-def create_game(cols: list, season: str, db_teams: dict[str: Team]) -> Game:
+            new_teams[name] = dict(name=name, ticker=value[2], latitude=value[0],
+                                   longitude=value[1], elo=elo_mean)
+    ids = get_storage(storage).insert_teams(list(new_teams.values()))
+    team_ids.update(zip(new_teams, ids))
+
+def run(n_workers=1, batch_size=500, storage=None, profile=False, summary_path=None):
     """
-    Creates a game object.
+    Creates the teams and upserts every game from the season data files.
+    Games that are already in the database are updated in place, so the
+    script can be re-run whenever the data files change.
 
     Parameters
-    -----------
-    cols : list
-        List of game data scraped from a data file.
-    season : str
-        Season that the game is played in ex. 2022-2023
-    db_teams : dict[str: Team]
-        Dictionary of team objects with their team name as keys.
+    ----------
+    n_workers : int
+        Number of processes used to parse the data files.
+    batch_size : int
+        Number of games sent to the database in each bulk write.
+    storage : Storage, optional
+        Storage to initialize, for example a MemoryStorage. Defaults to
+        the database.
+    profile : bool
+        Profile the run with cProfile, see instrumentation.RunStats.
+    summary_path : str, optional
+        File the JSON summary of the run is written to.
 
     Returns
     -------
-    Game object    
+    dict
+        Timings and counters of the run.
     """
+    from .ingest import iter_season_records, write_games
 
-    game = Game(season=season, week=cols[0])
-
-    day = cols[1]
-    date = cols[2]
-    winner = cols[4]
-    symbol = cols[5]
-    loser = cols[6]
-    winner_points = cols[8]
-    loser_points = cols[9]
-    winner_yards = cols[10]
-    winner_turnovers = cols[11]
-    loser_yards = cols[12]
-    loser_turnovers = cols[13]
-
-    if winner == 'Oakland Raiders':
-        winner = 'Las Vegas Raiders'
-    if loser == 'Oakland Raiders':
-        loser = 'Las Vegas Raiders'
-    if winner == 'San Diego Chargers':
-        winner = 'Los Angeles Chargers'
-    if loser == 'San Diego Chargers':
-        loser = 'Los Angeles Chargers'
-    if winner == 'St. Louis Rams':
-        winner = 'Los Angeles Rams'
-    if loser == 'St. Louis Rams':
-        loser = 'Los Angeles Rams'
-    if 'Washington' in winner:
-        winner = 'Washington Commanders'
-    elif 'Washington' in loser:
-        loser = 'Washington Commanders'
-
-    if symbol == "":
-        game.home_team = db_teams[winner]
-        game.away_team = db_teams[loser]
-        game.home_points = winner_points
-        game.away_points = loser_points
-        game.home_yards = winner_yards
-        game.away_yards = loser_yards
-        game.home_turnovers = winner_turnovers
-        game.away_turnovers = loser_turnovers
-        game.home_pregame_elo = 0
-        game.away_pregame_elo = 0
-        game.home_bye = False
-        game.away_bye = False
-        game.neutral_destination = None
-        game.day = day
-
-    elif symbol == '@':
-        game.home_team = db_teams[loser]
-        game.away_team = db_teams[winner]
-        game.home_points = loser_points
-        game.away_points = winner_points
-        game.home_yards = loser_yards
-        game.away_yards = winner_yards
-        game.home_turnovers = loser_turnovers
-        game.away_turnovers = winner_turnovers
-        game.home_pregame_elo = 0
-        game.away_pregame_elo = 0
-        game.home_bye = False
-        game.away_bye = False
-        game.neutral_destination = None
-        game.day = day
-
-    elif symbol == 'N':
-        # assign winner to hometeam and loser to awayteam
-        game.home_team = db_teams[winner]
-        game.away_team = db_teams[loser]
-        game.home_points = winner_points
-        game.away_points = loser_points
-        game.home_yards = winner_yards
-        game.away_yards = loser_yards
-        game.home_turnovers = winner_turnovers
-        game.away_turnovers = loser_turnovers
-        game.home_pregame_elo = 0
-        game.away_pregame_elo = 0
-        game.home_bye = False
-        game.away_bye = False
-        # default neutral game destination to superbowl destination
-        game.neutral_destination = db_teams[superbowl_locations[date.split("-")[0]]]
-        game.day = day
-
-    return game
-
-def run():
-    
-    connect_to_database()
+    stats = RunStats("init_db.run", profile=profile)
+    if storage is None:
+        with stats.phase("connect"):
+            connect_to_database()
+            create_indexes()
+        storage = MongoStorage()
 
     elo_mean = 1505
 
     # make team documents if they don't exist
-    db_teams = {team.name: team for team in Team.objects}
-    create_teams(db_teams, elo_mean)
-
-    if db_teams is None:
-        db_teams = {team.name: team for team in Team.objects}
-
-    if Game.objects:
-        print("game collection must be dropped before it can be initialized.")
-        exit()
-
-    games = []
-    cwd = os.getcwd()
-    for file in os.listdir(os.path.join(cwd, "nfl_model2", "data")):
-        start_year = file.split('_')[1].split('.')[0]
-        last_digits = str(int(start_year[-2:])+1)
-        season = start_year + '-20' + last_digits
-
-        with open(os.path.join(cwd, "nfl_model2", "data", file), "r") as f:
-            for line in f:
-                cols = line.split(",")
-
-                if cols[0] == "Week":
-                    continue
-                if cols[2] == "Playoffs":
-                    continue
-                
-                games.append(create_game(cols=cols, season=season, db_teams=db_teams))
-
-        Game.objects.insert(games)
-        games.clear()
-        print(f"Season {season} successfully written to db.")
-
-
-
-
-    
+    with stats.phase("load"):
+        team_ids = {team["name"]: team["_id"] for team in storage.team_records()}
+    stats.count("teams_read", len(team_ids))
+    n_teams = len(team_ids)
+    with stats.phase("bulk_write"):
+        create_teams(team_ids, elo_mean, storage)
+    stats.count("teams_inserted", len(team_ids) - n_teams)
+
+    for records in stats.timed("parse", iter_season_records(n_workers=n_workers)):
+        if not records:
+            continue
+        stats.count("games_parsed", len(records))
+        inserted, modified = write_games(records, team_ids, batch_size=batch_size, storage=storage,
+                                         stats=stats)
+        print(f"Season {records[0].season} successfully written to db. "
+              f"{inserted} games inserted, {modified} updated.")
+    return stats.report(summary_path)
 
 if __name__ == "__main__":
-    run()
\ No newline at end of file
+    run()
@@ -0,0 +1,140 @@
+"""
+This module contains the timers and counters reported by the scripts.
+
+A RunStats object is passed through a script run. It adds up the time spent
+in named phases like load, compute and bulk_write, counts the documents
+read and written, records the size of every bulk write and can profile the
+whole run with cProfile. The scripts print its summary as JSON at the end,
+so a slow run shows whether the time went to the database or to compute.
+"""
+
+import cProfile
+import io
+import json
+import pstats
+import time
+from contextlib import contextmanager
+
+
+class RunStats:
+    """
+    Timers and counters of one script run.
+
+    Parameters
+    ----------
+    name : str
+        Name of the run in the summary ex. elo_sim.run.
+    profile : bool
+        Profile the run with cProfile until stop is called.
+
+    Attributes
+    ----------
+    phases : dict
+        Seconds and number of calls of every phase.
+    counters : dict
+        Value of every counter.
+    batches : dict
+        Number, total and largest size of the batches of every bulk write.
+    """
+
+    def __init__(self, name: str, profile: bool = False):
+        self.name = name
+        self.phases = {}
+        self.counters = {}
+        self.batches = {}
+        self.profiler = cProfile.Profile() if profile else None
+        self.started = time.perf_counter()
+        self.stopped = None
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    @contextmanager
+    def phase(self, name: str):
+        "Adds the time spent in the with block to phase name."
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            phase = self.phases.setdefault(name, {"seconds": 0.0, "calls": 0})
+            phase["seconds"] += time.perf_counter() - start
+            phase["calls"] += 1
+
+    def timed(self, name: str, iterable):
+        "Iterates over iterable and adds the time spent producing each item to phase name."
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name: str, n: int = 1) -> None:
+        "Adds n to counter name."
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def batch(self, name: str, size: int) -> None:
+        "Records a bulk write of size documents."
+        batches = self.batches.setdefault(name, {"count": 0, "total": 0, "max": 0})
+        batches["count"] += 1
+        batches["total"] += int(size)
+        batches["max"] = max(batches["max"], int(size))
+
+    def stop(self) -> None:
+        "Stops the clock and the profiler."
+        if self.stopped is None:
+            self.stopped = time.perf_counter()
+            if self.profiler is not None:
+                self.profiler.disable()
+
+    def profile_stats(self, limit: int = 25) -> list[dict]:
+        "Functions with the most cumulative time, empty if the run isn't profiled."
+        if self.profiler is None:
+            return []
+        stats = pstats.Stats(self.profiler, stream=io.StringIO())
+        stats.sort_stats("cumulative")
+        functions = []
+        for func in stats.fcn_list[:limit]:
+            calls, _, total_time, cumulative_time, _ = stats.stats[func]
+            filename, line, function = func
+            functions.append({
+                "function": f"{filename}:{line}({function})",
+                "calls": calls,
+                "total_seconds": round(total_time, 6),
+                "cumulative_seconds": round(cumulative_time, 6),
+            })
+        return functions
+
+    def summary(self) -> dict:
+        "Summary of the run, stops it first."
+        self.stop()
+        batches = {
+            name: {**batches, "mean": batches["total"] / batches["count"]}
+            for name, batches in self.batches.items()
+        }
+        summary = {
+            "run": self.name,
+            "seconds": self.stopped - self.started,
+            "phases": self.phases,
+            "counters": self.counters,
+            "batches": batches,
+        }
+        if self.profiler is not None:
+            summary["profile"] = self.profile_stats()
+        return summary
+
+    def report(self, path: str = None) -> dict:
+        """
+        Prints the summary as JSON and writes it to path if it is given. The
+        raw profile is written next to it with a .prof extension.
+        """
+        summary = self.summary()
+        text = json.dumps(summary, indent=2)
+        print(text)
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(text)
+            if self.profiler is not None:
+                self.profiler.dump_stats(path + ".prof")
+        return summary
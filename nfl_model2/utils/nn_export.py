@@ -0,0 +1,181 @@
+"""
+This module exports the neural network training data to a compact,
+training-ready format.
+
+An export is a directory holding a float32 features.npy matrix, a float32
+labels.npy vector and a schema.json describing the columns. The arrays are
+written and read through memory maps in chunks, so datasets bigger than RAM
+can be exported and streamed as mini-batches without touching MongoDB.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from ..storage import Storage, get_storage
+from .process_nn_data import NNDataset
+from .rolling_window import STATS, feature_columns
+
+SCHEMA_FILE = "schema.json"
+FEATURES_FILE = "features.npy"
+LABELS_FILE = "labels.npy"
+
+
+def _write_schema(path, columns, n_rows, window, stats, has_labels):
+    schema = {
+        "columns": list(columns),
+        "n_rows": n_rows,
+        "window": window,
+        "stats": list(stats),
+        "dtype": "float32",
+        "labels": "home_margin" if has_labels else None,
+    }
+    with open(os.path.join(path, SCHEMA_FILE), "w") as f:
+        json.dump(schema, f)
+
+def export_nn_dataset(dataset: NNDataset, path: str, chunk_rows: int = 4096) -> None:
+    """
+    Exports a dataset built by process_nn_data.build_nn_dataset.
+
+    Parameters
+    ----------
+    dataset : NNDataset
+        Dataset to be exported.
+    path : str
+        Export directory, created if it doesn't exist.
+    chunk_rows : int
+        Number of rows copied into the memory map at a time.
+    """
+    os.makedirs(path, exist_ok=True)
+    n_rows, n_columns = dataset.matrix.shape
+    features = np.lib.format.open_memmap(os.path.join(path, FEATURES_FILE), mode="w+",
+                                         dtype=np.float32, shape=(n_rows, n_columns))
+    labels = np.lib.format.open_memmap(os.path.join(path, LABELS_FILE), mode="w+",
+                                       dtype=np.float32, shape=(n_rows,))
+    for start in range(0, n_rows, chunk_rows):
+        stop = start + chunk_rows
+        features[start:stop] = dataset.matrix[start:stop]
+        labels[start:stop] = dataset.labels[start:stop]
+    features.flush()
+    labels.flush()
+    del features, labels
+
+    _write_schema(path, dataset.columns, n_rows, dataset.window, dataset.stats, True)
+
+def nndata_row(document: dict, window: int, out: np.ndarray) -> None:
+    """
+    Copies a raw NNData document into a row laid out like
+    rolling_window.feature_columns. Lists are NaN padded to window.
+    """
+    out[:] = np.nan
+    column = 0
+    for side in ("home", "away"):
+        out[column] = document.get(f"{side}_pregame_elo", np.nan)
+        column += 1
+        for stat in STATS:
+            values = document.get(f"{side}_{stat}") or []
+            values = values[-window:]
+            out[column:column + len(values)] = values
+            column += window
+
+def export_nndata_collection(path: str, window: int = 14, chunk_rows: int = 4096,
+                             storage: Storage = None) -> int:
+    """
+    Exports the NNData collection. Documents are read as raw dicts in
+    batches of chunk_rows and written straight into the memory map, so the
+    collection never has to fit in memory. NNData documents don't hold the
+    game result, so the export has no labels file.
+    A database connection must already be open unless storage is given.
+
+    Returns
+    -------
+    int
+        Number of exported rows.
+    """
+    os.makedirs(path, exist_ok=True)
+    columns = feature_columns(window)
+    storage = get_storage(storage)
+    n_rows = storage.nndata_count()
+    features = np.lib.format.open_memmap(os.path.join(path, FEATURES_FILE), mode="w+",
+                                         dtype=np.float32, shape=(n_rows, len(columns)))
+    chunk = np.empty((chunk_rows, len(columns)), dtype=np.float32)
+    row = filled = 0
+    for document in storage.nndata_records(chunk_rows):
+        if row == n_rows:
+            break
+        nndata_row(document, window, chunk[filled])
+        filled += 1
+        if filled == chunk_rows:
+            features[row:row + filled] = chunk
+            row += filled
+            filled = 0
+    features[row:row + filled] = chunk[:filled]
+    row += filled
+    features.flush()
+    del features
+
+    labels_path = os.path.join(path, LABELS_FILE)
+    if os.path.exists(labels_path):
+        os.remove(labels_path)
+    _write_schema(path, columns, row, window, STATS, False)
+    return row
+
+
+class NNDataReader:
+    """
+    Reads an export in mini-batches through memory maps.
+
+    Attributes
+    ----------
+    schema : dict
+        Contents of schema.json.
+    features : np.memmap
+        (rows x columns) float32 feature matrix.
+    labels : np.memmap or None
+        float32 labels, None if the export has no labels.
+    """
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, SCHEMA_FILE), "r") as f:
+            self.schema = json.load(f)
+        self.features = np.load(os.path.join(path, FEATURES_FILE), mmap_mode="r")
+        self.labels = None
+        if self.schema["labels"] is not None:
+            self.labels = np.load(os.path.join(path, LABELS_FILE), mmap_mode="r")
+
+    def __len__(self):
+        return self.schema["n_rows"]
+
+    @property
+    def columns(self) -> list[str]:
+        return self.schema["columns"]
+
+    def iter_batches(self, batch_size: int = 256, shuffle: bool = False, seed=None,
+                     drop_last: bool = False):
+        """
+        Yields (features, labels) mini-batches copied out of the memory maps.
+        labels is None if the export has no labels.
+
+        Parameters
+        ----------
+        batch_size : int
+            Rows per batch.
+        shuffle : bool
+            Visit the batches in random order. Rows within a batch stay
+            contiguous so every batch is a sequential read.
+        seed : int, optional
+            Seed for the shuffle.
+        drop_last : bool
+            Skip the last batch if it is smaller than batch_size.
+        """
+        n_rows = len(self)
+        starts = np.arange(0, n_rows, batch_size)
+        if drop_last and n_rows % batch_size:
+            starts = starts[:-1]
+        if shuffle:
+            starts = np.random.default_rng(seed).permutation(starts)
+        for start in starts.tolist():
+            stop = min(start + batch_size, n_rows)
+            labels = None if self.labels is None else np.array(self.labels[start:stop])
+            yield np.array(self.features[start:stop]), labels
@@ -1,129 +1,138 @@
 """
-This script creates and populates the MLData table in the database.
+This module builds the data for the NNData table in the database.
 
-The data from the MLData table is used for training and testing the 
+The data from the NNData table is used for training and testing the
 neural network used for improving the Elo model spread predictions.
+
+build_nn_dataset turns the game history into feature arrays without
+touching the database, so it can be called repeatedly, for example in a
+hyperparameter search. run() is the script that writes the dataset to the
+NNData collection.
 """
 
-from ..models import Team, Game, NNData, connect_to_database
-
-connect_to_database()
-
-
-# check that there are no nndata objects already in the database
-if NNData.objects.first() is not None:
-    print("There are already nndata objects in the database. Exiting now.")
-    exit()
-
-team_names = Team.objects.only("name")
-
-# build first year lists for every field
-last_14_games = {}
-for team in team_names:
-    print(f"processing: {team.name}")
-    last_14_games[team.name] = {
-        "pregame_elo_for": [],
-        "pregame_elo_against": [],
-        "points_for": [],
-        "points_against": [],
-        "yards_for": [],
-        "yards_against": [],
-        "turnovers_for": [],
-        "turnovers_against": [],
-    }
-
-first_year_games = Game.objects(season="2010-2011").order_by("id").select_related(2)
-
-def add_game_data(game, last_14_games):
-    home_team = game.home_team.name
-    away_team = game.away_team.name
-
-    last_14_games[home_team]["pregame_elo_for"].append(game.home_pregame_elo)
-    last_14_games[home_team]["pregame_elo_against"].append(game.away_pregame_elo)
-    last_14_games[home_team]["points_for"].append(game.home_points)
-    last_14_games[home_team]["points_against"].append(game.away_points)
-    last_14_games[home_team]["yards_for"].append(game.home_yards)
-    last_14_games[home_team]["yards_against"].append(game.away_yards)
-    last_14_games[home_team]["turnovers_for"].append(game.away_turnovers)
-    last_14_games[home_team]["turnovers_against"].append(game.home_turnovers)
-
-    last_14_games[away_team]["pregame_elo_for"].append(game.away_pregame_elo)
-    last_14_games[away_team]["pregame_elo_against"].append(game.home_pregame_elo)
-    last_14_games[away_team]["points_for"].append(game.away_points)
-    last_14_games[away_team]["points_against"].append(game.home_points)
-    last_14_games[away_team]["yards_for"].append(game.away_yards)
-    last_14_games[away_team]["yards_against"].append(game.home_yards)
-    last_14_games[away_team]["turnovers_for"].append(game.home_turnovers)
-    last_14_games[away_team]["turnovers_against"].append(game.away_turnovers)
-
-def pop_game_data(game, last_14_games):
-    home_team = game.home_team.name
-    away_team = game.away_team.name
-
-    last_14_games[home_team]["pregame_elo_for"].pop(0)
-    last_14_games[home_team]["pregame_elo_against"].pop(0)
-    last_14_games[home_team]["points_for"].pop(0)
-    last_14_games[home_team]["points_against"].pop(0)
-    last_14_games[home_team]["yards_for"].pop(0)
-    last_14_games[home_team]["yards_against"].pop(0)
-    last_14_games[home_team]["turnovers_for"].pop(0)
-    last_14_games[home_team]["turnovers_against"].pop(0)
-    last_14_games[away_team]["pregame_elo_for"].pop(0)
-    last_14_games[away_team]["pregame_elo_against"].pop(0)
-    last_14_games[away_team]["points_for"].pop(0)
-    last_14_games[away_team]["points_against"].pop(0)
-    last_14_games[away_team]["yards_for"].pop(0)
-    last_14_games[away_team]["yards_against"].pop(0)
-    last_14_games[away_team]["turnovers_for"].pop(0)
-    last_14_games[away_team]["turnovers_against"].pop(0)
-
-print("processing first year games.")
-for game in first_year_games:
-    
-    add_game_data(game, last_14_games)
-
-    if len(game.week) > 3 or int(game.week) > 14:
-        pop_game_data(game, last_14_games)
-
-rest_of_games = Game.objects(season__ne="2010-2011").order_by("id").select_related(2)
-
-nndata_objects = []
-print("processing rest of the games.")
-for game in rest_of_games:
-    if len(game.week) > 2:
-        week += 1
-    else: 
-        week = int(game.week)
-
-    home_team = game.home_team.name
-    away_team = game.away_team.name
-
-    # make nndata object
-    nndata = NNData(week_number=week)
-    nndata.home_pregame_elo = game.home_pregame_elo
-    nndata.away_pregame_elo = game.away_pregame_elo
-    nndata.home_pregame_elo_for = last_14_games[home_team]["pregame_elo_for"]
-    nndata.home_pregame_elo_against = last_14_games[home_team]["pregame_elo_against"]
-    nndata.home_points_for = last_14_games[home_team]["points_for"]
-    nndata.home_points_against = last_14_games[home_team]["points_against"]
-    nndata.home_yards_for = last_14_games[home_team]["yards_for"]
-    nndata.home_yards_against = last_14_games[home_team]["yards_against"]
-    nndata.home_turnovers_for = last_14_games[home_team]["turnovers_for"]
-    nndata.home_turnovers_against = last_14_games[home_team]["turnovers_against"]
-    nndata.away_pregame_elo_for = last_14_games[away_team]["pregame_elo_for"]
-    nndata.away_pregame_elo_against = last_14_games[away_team]["pregame_elo_against"]
-    nndata.away_points_for = last_14_games[away_team]["points_for"]
-    nndata.away_points_against = last_14_games[away_team]["points_against"]
-    nndata.away_yards_for = last_14_games[away_team]["yards_for"]
-    nndata.away_yards_against = last_14_games[away_team]["yards_against"]
-    nndata.away_turnovers_for = last_14_games[away_team]["turnovers_for"]
-    nndata.away_turnovers_against = last_14_games[away_team]["turnovers_against"]
-
-    nndata_objects.append(nndata)
-
-    add_game_data(game, last_14_games)
-    pop_game_data(game, last_14_games)
-
-# write nndata objects to db
-print("writing objects to db.")
-NNData.objects.insert(nndata_objects)
\ No newline at end of file
+from typing import NamedTuple
+
+import numpy as np
+
+from ..models import NNData, connect_to_database
+from ..storage import Storage, MongoStorage, get_storage
+from ..elo.elo_engine import GameArrays
+from .game_cache import load_games
+from .rolling_window import STATS, build_window_features, build_window_features_by_season
+
+
+class NNDataset(NamedTuple):
+    """
+    Training data built from the game history.
+
+    matrix has one row per game, see rolling_window.WindowFeatures for the
+    column layout. labels is the home team's margin of victory.
+    """
+    matrix: np.ndarray
+    labels: np.ndarray
+    columns: list
+    week_number: np.ndarray
+    game_index: np.ndarray
+    window: int
+    stats: tuple
+
+
+def build_nn_dataset(games: GameArrays, window: int = 14, features=STATS,
+                     warmup_seasons: int = 1, n_workers: int = 1) -> NNDataset:
+    """
+    Builds the neural network training data from the game history.
+
+    Parameters
+    ----------
+    games : GameArrays
+        Games in chronological order with their pregame elos.
+    window : int
+        Number of previous games of each team used as features.
+    features : tuple[str]
+        Subset of rolling_window.STATS used as features.
+    warmup_seasons : int
+        Number of seasons at the start that only fill the windows.
+    n_workers : int
+        Number of processes. Seasons are built in parallel when greater
+        than 1, see rolling_window.build_window_features_by_season.
+
+    Returns
+    -------
+    NNDataset
+    """
+    features = tuple(features)
+    if n_workers > 1:
+        window_features = build_window_features_by_season(
+            games, window=window, warmup_seasons=warmup_seasons, stats=features, n_workers=n_workers)
+    else:
+        window_features = build_window_features(games, window=window, warmup_seasons=warmup_seasons,
+                                                stats=features)
+    index = window_features.game_index
+    labels = (games.home_points[index] - games.away_points[index]).astype(np.float64)
+    return NNDataset(window_features.matrix, labels, window_features.columns,
+                     window_features.week_number, index, window, features)
+
+def to_nndata_documents(dataset: NNDataset) -> list[NNData]:
+    """
+    Converts a dataset into NNData documents. Unfilled window slots are
+    left out of the lists and stats that aren't in the dataset are empty.
+    """
+    window = dataset.window
+    half = dataset.matrix.shape[1] // 2
+    documents = []
+    for row, week in zip(dataset.matrix, dataset.week_number.tolist()):
+        nndata = NNData(week_number=week)
+        for side, side_row in (("home", row[:half]), ("away", row[half:])):
+            setattr(nndata, f"{side}_pregame_elo", int(side_row[0]))
+            for i, stat in enumerate(dataset.stats):
+                values = side_row[1 + i * window:1 + (i + 1) * window]
+                setattr(nndata, f"{side}_{stat}", [int(v) for v in values[~np.isnan(values)]])
+        documents.append(nndata)
+    return documents
+
+def write_nn_dataset(dataset: NNDataset, replace: bool = False, storage: Storage = None) -> int:
+    """
+    Writes a dataset to the NNData collection. A database connection must
+    already be open.
+
+    Parameters
+    ----------
+    dataset : NNDataset
+        Dataset to be written.
+    replace : bool
+        Delete the existing NNData documents first. Otherwise nothing is
+        written if the collection isn't empty.
+    storage : Storage, optional
+        Where the documents are written, defaults to the database.
+
+    Returns
+    -------
+    int
+        Number of documents written.
+    """
+    storage = get_storage(storage)
+    if replace:
+        storage.delete_nndata()
+    elif storage.nndata_count() > 0:
+        print("There are already nndata objects in the database.")
+        return 0
+
+    documents = to_nndata_documents(dataset)
+    storage.insert_nndata(documents)
+    return len(documents)
+
+def run(window: int = 14, replace: bool = False, storage: Storage = None, n_workers: int = 1):
+    if storage is None:
+        connect_to_database()
+        storage = MongoStorage()
+
+    print("processing games.")
+    dataset = build_nn_dataset(load_games(source="database", storage=storage), window=window,
+                               n_workers=n_workers)
+
+    print("writing objects to db.")
+    written = write_nn_dataset(dataset, replace=replace, storage=storage)
+    print(f"{written} nndata objects written.")
+
+if __name__ == "__main__":
+    run()
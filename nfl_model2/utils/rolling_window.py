@@ -0,0 +1,280 @@
+"""
+This module contains the rolling window feature engine used to build the
+neural network training data.
+
+Every team's last games are kept in a fixed-size ring buffer, so adding a
+game overwrites the oldest one instead of shifting lists. Before each game
+a copy of both teams' windows is written into a row of a preallocated
+(games x features) matrix.
+
+The windows at the start of a season only depend on every team's last
+games before it, which window_state finds without replaying the history.
+build_window_features_by_season uses it to build the seasons independently,
+in a process pool if asked, and merges them in order.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
+import numpy as np
+
+from ..elo.elo_engine import GameArrays
+
+# per team statistics kept for every game, from the team's point of view.
+# turnovers_for are the turnovers forced by the team.
+STATS = (
+    "pregame_elo_for",
+    "pregame_elo_against",
+    "points_for",
+    "points_against",
+    "yards_for",
+    "yards_against",
+    "turnovers_for",
+    "turnovers_against",
+)
+
+
+class RollingWindow:
+    """
+    Ring buffer of the last window games of every team.
+
+    Attributes
+    ----------
+    buffer : np.ndarray
+        (teams x window x stats) array. Slots that haven't been filled yet
+        are NaN.
+    count : np.ndarray
+        Number of games added for every team.
+    """
+
+    def __init__(self, n_teams: int, window: int = 14, n_stats: int = len(STATS)):
+        self.window = window
+        self.buffer = np.full((n_teams, window, n_stats), np.nan)
+        self.count = np.zeros(n_teams, dtype=np.int64)
+
+    def push(self, team: int, values) -> None:
+        "Adds a game to a team's window, overwriting its oldest game once the window is full."
+        self.buffer[team, self.count[team] % self.window] = values
+        self.count[team] += 1
+
+    def snapshot(self, team: int) -> np.ndarray:
+        "Copies a team's (window x stats) window in chronological order, oldest game first."
+        if self.count[team] < self.window:
+            # unfilled slots are at the end of the buffer, keep them last
+            return self.buffer[team].copy()
+        order = (self.count[team] + np.arange(self.window)) % self.window
+        return self.buffer[team, order]
+
+
+class WindowFeatures(NamedTuple):
+    """
+    Output of build_window_features.
+
+    matrix has one row per game with the home team's pregame elo and
+    window followed by the away team's. Windows are stored stat by stat,
+    oldest game first, and are NaN padded at the end when a team has played
+    fewer than window games.
+    """
+    matrix: np.ndarray
+    columns: list
+    game_index: np.ndarray
+    week_number: np.ndarray
+
+
+def feature_columns(window: int = 14, stats=STATS) -> list[str]:
+    "Names of the columns of the feature matrix."
+    columns = []
+    for side in ("home", "away"):
+        columns.append(f"{side}_pregame_elo")
+        for stat in stats:
+            columns.extend(f"{side}_{stat}_{i}" for i in range(window))
+    return columns
+
+def week_numbers(games: GameArrays) -> np.ndarray:
+    """
+    Numbers the weeks of every season consecutively. Playoff rounds are
+    numbered after the last regular season week of their season.
+    """
+    week = games.week.astype(np.int64)
+    number = week.copy()
+    for season in np.unique(games.season):
+        in_season = games.season == season
+        regular = in_season & ~games.is_playoff
+        last_week = week[regular].max() if regular.any() else 0
+        playoffs = in_season & games.is_playoff
+        rounds = np.searchsorted(np.unique(week[playoffs]), week[playoffs]) + 1
+        number[playoffs] = last_week + rounds
+    return number
+
+def team_stats(games: GameArrays, stats=STATS) -> tuple[np.ndarray, np.ndarray]:
+    "Per game stats from the home team's and the away team's point of view."
+    columns = [STATS.index(stat) for stat in stats]
+    home = np.stack([
+        games.home_pregame_elo, games.away_pregame_elo,
+        games.home_points, games.away_points,
+        games.home_yards, games.away_yards,
+        games.away_turnovers, games.home_turnovers,
+    ], axis=1).astype(np.float64)
+    away = np.stack([
+        games.away_pregame_elo, games.home_pregame_elo,
+        games.away_points, games.home_points,
+        games.away_yards, games.home_yards,
+        games.home_turnovers, games.away_turnovers,
+    ], axis=1).astype(np.float64)
+    return home[:, columns], away[:, columns]
+
+def _check_stats(stats) -> None:
+    for stat in stats:
+        if stat not in STATS:
+            raise ValueError(f"unknown stat {stat!r}")
+
+def window_states(games: GameArrays, ends, window: int = 14, stats=STATS) -> list[RollingWindow]:
+    """
+    Builds the windows as they are after the first end games for every end
+    in ends, the same as pushing every game before end into new windows.
+    The games are sorted by team once, then every state only reads the last
+    window games of each team.
+
+    Parameters
+    ----------
+    games : GameArrays
+        Games in chronological order.
+    ends : list[int]
+        Number of games at the start of games that are in each state.
+    window : int
+        Number of previous games kept for every team.
+    stats : tuple[str]
+        Subset of STATS kept in the windows.
+    """
+    _check_stats(stats)
+    n_teams, n_games = len(games.teams), len(games)
+    home_stats, away_stats = team_stats(games, stats)
+    teams = np.concatenate([games.home, games.away]).astype(np.int64)
+    position = np.concatenate([np.arange(n_games), np.arange(n_games)])
+    values = np.concatenate([home_stats, away_stats])
+
+    # every team's games in order, the keys are sorted
+    order = np.lexsort((position, teams))
+    keys = teams[order]*(n_games + 1) + position[order]
+    values = values[order]
+    team_start = np.searchsorted(keys, np.arange(n_teams)*(n_games + 1))
+
+    states = []
+    for end in ends:
+        windows = RollingWindow(n_teams, window, len(stats))
+        # one past each team's last game before end
+        team_end = np.searchsorted(keys, np.arange(n_teams)*(n_games + 1) + end)
+        count = team_end - team_start
+        rank = count[:, None] - window + np.arange(window)
+        filled = rank >= 0
+        team = np.nonzero(filled)[0]
+        windows.buffer[team, rank[filled] % window] = values[team_start[team] + rank[filled]]
+        windows.count[:] = count
+        states.append(windows)
+    return states
+
+def window_state(games: GameArrays, end: int, window: int = 14, stats=STATS) -> RollingWindow:
+    "Builds the windows as they are after the first end games, see window_states."
+    return window_states(games, [end], window, stats)[0]
+
+def _season_features(args) -> WindowFeatures:
+    games, windows, stats = args
+    return build_window_features(games, warmup_seasons=0, windows=windows, stats=stats)
+
+def build_window_features_by_season(games: GameArrays, window: int = 14, warmup_seasons: int = 1,
+                                    stats=STATS, n_workers: int = 1) -> WindowFeatures:
+    """
+    Builds the same features as build_window_features one season at a time.
+    Every season starts from the windows left by the seasons before it, see
+    window_state, so the seasons can be built in parallel.
+
+    Parameters
+    ----------
+    games : GameArrays
+        Games in chronological order.
+    window : int
+        Number of previous games kept for every team.
+    warmup_seasons : int
+        Number of seasons at the start that only fill the windows.
+    stats : tuple[str]
+        Subset of STATS kept in the windows.
+    n_workers : int
+        Number of processes. Seasons are built in parallel when greater
+        than 1.
+
+    Returns
+    -------
+    WindowFeatures
+    """
+    positions = [np.flatnonzero(games.season == season)
+                 for season in np.unique(games.season)[warmup_seasons:]]
+    states = window_states(games, [int(season[0]) for season in positions], window, stats)
+    tasks = [(games.subset(season), state, stats) for season, state in zip(positions, states)]
+    if n_workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            parts = list(executor.map(_season_features, tasks))
+    else:
+        parts = [_season_features(task) for task in tasks]
+
+    if not parts:
+        return build_window_features(games.subset(slice(0, 0)), window, 0, stats=stats)
+    return WindowFeatures(
+        np.concatenate([part.matrix for part in parts]),
+        parts[0].columns,
+        np.concatenate([season[part.game_index] for season, part in zip(positions, parts)]),
+        np.concatenate([part.week_number for part in parts]),
+    )
+
+def build_window_features(games: GameArrays, window: int = 14, warmup_seasons: int = 1,
+                          windows: RollingWindow = None, stats=STATS) -> WindowFeatures:
+    """
+    Builds the rolling window features of every game in one pass.
+
+    Parameters
+    ----------
+    games : GameArrays
+        Games in chronological order.
+    window : int
+        Number of previous games kept for every team.
+    warmup_seasons : int
+        Number of seasons at the start that only fill the windows and don't
+        get rows of their own.
+    windows : RollingWindow, optional
+        Windows carried over from earlier games. Updated in place.
+    stats : tuple[str]
+        Subset of STATS kept in the windows.
+
+    Returns
+    -------
+    WindowFeatures
+    """
+    _check_stats(stats)
+    n_teams = len(games.teams)
+    if windows is None:
+        windows = RollingWindow(n_teams, window, len(stats))
+    window = windows.window
+
+    seasons = np.unique(games.season)
+    first_season = seasons[warmup_seasons] if warmup_seasons < len(seasons) else np.inf
+    emit = games.season >= first_season
+    game_index = np.flatnonzero(emit)
+
+    n_window = len(stats) * window
+    matrix = np.empty((len(game_index), 2 * (1 + n_window)))
+    home_stats, away_stats = team_stats(games, stats)
+
+    row = 0
+    for i, (h, a, is_emitted) in enumerate(zip(games.home.tolist(), games.away.tolist(), emit.tolist())):
+        if is_emitted:
+            out = matrix[row]
+            out[0] = games.home_pregame_elo[i]
+            # windows are stored (window x stats), the matrix is stat by stat
+            out[1:1 + n_window].reshape(len(stats), window)[:] = windows.snapshot(h).T
+            out[1 + n_window] = games.away_pregame_elo[i]
+            out[2 + n_window:].reshape(len(stats), window)[:] = windows.snapshot(a).T
+            row += 1
+        windows.push(h, home_stats[i])
+        windows.push(a, away_stats[i])
+
+    return WindowFeatures(matrix, feature_columns(window, stats), game_index,
+                          week_numbers(games)[game_index])
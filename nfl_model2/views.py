@@ -1,5 +1,97 @@
-from django.http import HttpResponse
+import json
+
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from .elo import rating_cache
 
 def index(request):
     return HttpResponse("Hello, world. You're at the polls index.")
 
+async def ratings(request):
+    "Current elo of every team."
+    snapshot = await rating_cache.aget_snapshot()
+    return JsonResponse({"teams": snapshot.ratings()})
+
+def _is_playoff(request) -> bool:
+    "Reads the optional playoff parameter, see rating_cache.playoff_flag."
+    value = request.GET.get("playoff")
+    return rating_cache.playoff_flag(value) if value else False
+
+async def matchup(request):
+    """
+    Win probability and spread of a game between two teams, ex.
+    matchup/?home=KC&away=SEA&neutral=LV&playoff=true
+    """
+    home, away = request.GET.get("home"), request.GET.get("away")
+    if not home or not away:
+        return JsonResponse({"error": "home and away are required"}, status=400)
+    snapshot = await rating_cache.aget_snapshot()
+    try:
+        prediction = snapshot.matchup(home, away, request.GET.get("neutral") or None, _is_playoff(request))
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+    return JsonResponse(prediction)
+
+@csrf_exempt
+@require_POST
+async def matchups(request):
+    """
+    Predicts many games in one request. The body is a JSON list of games or
+    an object with a 'games' list. Games are [home, away, neutral, playoff]
+    lists or objects with 'home', 'away', 'neutral' and 'playoff' keys.
+    """
+    try:
+        games = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({"error": "body must be JSON"}, status=400)
+    if isinstance(games, dict):
+        games = games.get("games")
+    if not isinstance(games, list):
+        return JsonResponse({"error": "games must be a list"}, status=400)
+
+    snapshot = await rating_cache.aget_snapshot()
+    try:
+        predictions = snapshot.matchups(games)
+    except (ValueError, TypeError) as error:
+        return JsonResponse({"error": str(error)}, status=400)
+    return JsonResponse({"games": predictions})
+
+async def power_matrix(request):
+    "Home win probability and spread of every pairing of teams, ex. power-matrix/?playoff=true"
+    try:
+        is_playoff = _is_playoff(request)
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+    snapshot = await rating_cache.aget_snapshot()
+    return JsonResponse(snapshot.power_matrix(is_playoff))
+
+async def team_history(request, ticker):
+    "Elo of a team after every week, ex. history/KC/?start=2018-2019&end=2022-2023"
+    try:
+        history = await rating_cache.ateam_history(ticker, request.GET.get("start") or None,
+                                                   request.GET.get("end") or None)
+    except (ValueError, KeyError) as error:
+        return JsonResponse({"error": str(error)}, status=400)
+    return JsonResponse(history)
+
+async def week_spreads(request, season, week):
+    "Spreads and margin distributions of every game of a week, ex. spreads/2022-2023/5/"
+    try:
+        spreads = await rating_cache.aweek_spreads(season, week)
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=404)
+    if not spreads["games"]:
+        return JsonResponse({"error": f"no games in week {week} of {season}"}, status=404)
+    return JsonResponse({"season": season, "week": week, **spreads})
+
+async def week_predictions(request, season, week):
+    "Predictions of every game of a week, ex. predictions/2022-2023/5/"
+    try:
+        games = await rating_cache.aweek_predictions(season, week)
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=404)
+    if not games:
+        return JsonResponse({"error": f"no games in week {week} of {season}"}, status=404)
+    return JsonResponse({"season": season, "week": week, "games": games})